@@ -1,26 +1,500 @@
-from flask import Flask, request, jsonify, abort
+import json
+import math
+import os
+import re
+import time
+from itertools import islice
+from urllib.parse import parse_qs
+
+from flask import Flask, Response, request, jsonify, abort, g
+
+import local_server_codec as codec
+import local_server_compression as compression
+from local_server_auth import DEFAULT_TOKENS, TokenRegistry, parse_rate_limits, parse_tokens
+from local_server_cache import DEFAULT_CACHE_BYTES, ResponseCache
+from local_server_feed import DEFAULT_FEED_SIZE, FeedGap, FeedWait
+from local_server_index import FILTER_OPERATORS, RANGE_OPERATORS, Filter, sort_key, value_key
+from local_server_metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Metrics
+from local_server_patch import (JSON_PATCH_MIMETYPE, MERGE_PATCH_MIMETYPE, PatchConflict, PatchError,
+                                apply_json_patch, merge_patch, parse_json_patch)
+from local_server_profile import (DEFAULT_PROFILE_DIR, MODE_CPROFILE, PROFILE_HEADER, PhaseTimer, RequestProfiler,
+                                  busy_seconds, format_slow_request, slow_log)
+from local_server_shared import SOCKET_ENV, RemoteStore
+from local_server_store import EVICT_LRU, MISSING, RecordStore, RevisionMismatch
+from local_server_wal import FSYNC_BATCHED, WriteAheadLog
+
+
+def optional_int(name):
+    # The integer set in environment variable name, or None for a limit left unset
+    value = os.environ.get(name)
+    return int(value) if value else None
+
 
 app = Flask(__name__)
+# Requests are parsed and responses encoded with the codec picked by LOCAL_SERVER_JSON_CODEC
+app.json = codec.CodecJSONProvider(app)
+
+# A simple in-memory storage for POST data. Worker processes started with
+# LOCAL_SERVER_STORE_SOCKET share the store of the owner process listening there.
+SHARED_STORE = bool(os.environ.get(SOCKET_ENV))
+if SHARED_STORE:
+    data_storage = RemoteStore(os.environ[SOCKET_ENV])
+else:
+    # Memory limits are opt-in; see RecordStore for how records are evicted
+    data_storage = RecordStore(feed_size=int(os.environ.get('LOCAL_SERVER_FEED_SIZE', DEFAULT_FEED_SIZE)),
+                               max_records=optional_int('LOCAL_SERVER_MAX_RECORDS'),
+                               max_bytes=optional_int('LOCAL_SERVER_MAX_BYTES'),
+                               eviction=os.environ.get('LOCAL_SERVER_EVICTION', EVICT_LRU))
+
+# Encoded /get bodies for the current store version, up to LOCAL_SERVER_CACHE_BYTES in total
+response_cache = ResponseCache(max_bytes=int(os.environ.get('LOCAL_SERVER_CACHE_BYTES', DEFAULT_CACHE_BYTES)))
+
+# Request counts, latencies and sizes per route, served at /metrics
+metrics = Metrics()
+
+# Keep records as the validated JSON bytes they arrived as, decoding them only when needed
+RAW_RECORDS = os.environ.get('LOCAL_SERVER_RAW_RECORDS', '').lower() in ('1', 'true', 'yes')
+
 
-# A simple in-memory storage for POST data
-data_storage = []
+def create_indexes(spec):
+    # spec is a comma separated list of field[:kind], e.g. "status,age:sorted"
+    for item in spec.split(','):
+        field, _, kind = item.strip().partition(':')
+        if field:
+            data_storage.create_index(field, kind or 'hash')
+
+
+# Indexes are declared up front so recovery below fills them as it loads.
+# A shared store is configured, and persisted, by its owner process.
+if os.environ.get('LOCAL_SERVER_INDEXES') and not SHARED_STORE:
+    create_indexes(os.environ['LOCAL_SERVER_INDEXES'])
+
+
+def enable_persistence(directory, fsync=FSYNC_BATCHED):
+    # Recovers data_storage from directory and journals every later change there
+    return WriteAheadLog(directory, fsync=fsync, raw_records=RAW_RECORDS).recover(data_storage)
+
+
+# Persistence is opt-in: set LOCAL_SERVER_DATA_DIR to keep data across restarts
+if os.environ.get('LOCAL_SERVER_DATA_DIR') and not SHARED_STORE:
+    enable_persistence(os.environ['LOCAL_SERVER_DATA_DIR'], os.environ.get('LOCAL_SERVER_FSYNC', FSYNC_BATCHED))
 
 REQUIRED_HEADERS = {
     'X-Requested-With': 'XMLHttpRequest',
-    'Authorization': 'Bearer your_token'
 }
 
+# Bearer tokens accepted in the Authorization header, and the request rate
+# each may send per route, e.g. LOCAL_SERVER_RATE_LIMITS="*=100:200,post_data=10"
+token_registry = TokenRegistry(parse_tokens(os.environ.get('LOCAL_SERVER_TOKENS', ','.join(DEFAULT_TOKENS))),
+                               parse_rate_limits(os.environ.get('LOCAL_SERVER_RATE_LIMITS', '')))
+
+# Upper bound on the page size a client may request from /get
+MAX_PAGE_LIMIT = 1000
+
+# Methods that never change the store
+READ_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+STREAM_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+
+BATCH_OPERATIONS = ('insert', 'put', 'patch', 'delete')
+
+# Long-poll waits on /changes, in seconds
+DEFAULT_FEED_WAIT = 30
+MAX_FEED_WAIT = 60
+
+# Idle interval after which an SSE subscription gets a comment line, so dead
+# connections are noticed and proxies keep the stream open
+SSE_HEARTBEAT = 15
+
+# WSGI environ key an event-loop server sets when it can await FeedWait
+# chunks, so /changes waits for writes without holding a thread
+ASYNC_FEED_ENVIRON = 'local_server.async_feed'
+
+# Content codings offered on responses, most preferred first, and the smallest
+# response worth compressing. LOCAL_SERVER_COMPRESSION=off sends every body as it is.
+RESPONSE_ENCODINGS = compression.parse_encodings(
+    os.environ.get('LOCAL_SERVER_COMPRESSION', ','.join(compression.available_encodings())))
+COMPRESS_MIN_BYTES = int(os.environ.get('LOCAL_SERVER_COMPRESS_MIN_BYTES', compression.DEFAULT_MIN_BYTES))
+
+# Largest request body accepted, once any Content-Encoding is undone
+MAX_BODY_BYTES = int(os.environ.get('LOCAL_SERVER_MAX_BODY_BYTES', compression.DEFAULT_MAX_BODY_BYTES))
+
+# filter[field]=value or filter[field][op]=value
+FILTER_PARAM_RE = re.compile(r'^filter\[([^\]]+)\](?:\[([^\]]*)\])?$')
+
+# Profiling is opt-in: LOCAL_SERVER_PROFILE_RATE samples a fraction of requests,
+# and LOCAL_SERVER_PROFILE_KEY lets a request ask for itself with the X-Profile header
+PROFILE_RATE = float(os.environ.get('LOCAL_SERVER_PROFILE_RATE', 0))
+PROFILE_KEY = os.environ.get('LOCAL_SERVER_PROFILE_KEY')
+profiler = RequestProfiler(os.environ.get('LOCAL_SERVER_PROFILE_DIR', DEFAULT_PROFILE_DIR), PROFILE_RATE,
+                           PROFILE_KEY, os.environ.get('LOCAL_SERVER_PROFILE_MODE', MODE_CPROFILE)) \
+    if PROFILE_RATE or PROFILE_KEY else None
+
+# Requests taking longer than this are logged with the time spent in each phase
+SLOW_REQUEST_MS = os.environ.get('LOCAL_SERVER_SLOW_REQUEST_MS')
+SLOW_REQUEST_SECONDS = float(SLOW_REQUEST_MS) / 1000 if SLOW_REQUEST_MS else None
+
+
+@app.before_request
+def start_profiling():
+    # Registered ahead of the metrics hooks, so profiles and slow-request
+    # timings cover them too. With both features off this is two comparisons.
+    if SLOW_REQUEST_SECONDS is not None:
+        g.phases = PhaseTimer()
+    if profiler is not None and profiler.wanted(request.headers.get(PROFILE_HEADER)):
+        g.profile = profiler.start(request.endpoint or 'unmatched')
+
+
+@app.after_request
+def log_slow_request(response):
+    if SLOW_REQUEST_SECONDS is not None and 'phases' in g:
+        phases = g.phases.breakdown(time.perf_counter())
+        if busy_seconds(phases) >= SLOW_REQUEST_SECONDS:
+            slow_log.warning(format_slow_request(request.method, request.path, request.endpoint or 'unmatched',
+                                                 response.status_code, phases))
+    return response
+
+
+@app.teardown_request
+def finish_profiling(exc):
+    # Teardown runs even when the view raised, so a profiled request always releases the profiler
+    handle = g.pop('profile', None)
+    if handle is not None:
+        profiler.stop(handle)
+
+
+def mark_phase(name):
+    # Ends phase name of the current request for the slow-request log: headers,
+    # body, parse, store and wait; whatever follows the last mark is respond
+    if SLOW_REQUEST_SECONDS is not None and 'phases' in g:
+        g.phases.mark(name)
+
+
+@app.before_request
+def start_request_metrics():
+    metrics.started()
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed responses have no length yet; only their count and latency are recorded
+    metrics.observe(request.endpoint or 'unmatched', response.status_code,
+                    time.perf_counter() - g.started, request.content_length or 0,
+                    None if response.is_streamed else response.content_length)
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    metrics.finished()
+
+
+@app.after_request
+def compress_response(response):
+    # /get compresses and caches its own bodies; this covers every other large
+    # response. Registered after the metrics hook so it runs first and the
+    # metrics see the size actually sent.
+    if (not RESPONSE_ENCODINGS or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.status_code in (204, 304)):
+        return response
+    length = response.content_length
+    if length is None or length < COMPRESS_MIN_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = compression.choose_encoding(request.accept_encodings, RESPONSE_ENCODINGS)
+    if encoding is not None:
+        response.set_data(RESPONSE_ENCODINGS[encoding](response.get_data()))
+        response.headers['Content-Encoding'] = encoding
+        # Each coding is its own representation; see etag_matches()
+        etag, weak = response.get_etag()
+        if etag is not None:
+            response.set_etag(f'{etag}-{encoding}', weak)
+    return response
+
+
+def abort_json(status, message, headers=None):
+    response = jsonify({"error": message})
+    response.status_code = status
+    if headers:
+        response.headers.update(headers)
+    abort(response)
+
 
 def check_headers(required_headers):
+    # Runs before a route touches the body, so rejected clients never cost a JSON parse
     for header, value in required_headers.items():
         if request.headers.get(header) != value:
+            metrics.reject(request.endpoint, header)
             abort(400, description=f'Missing or invalid header: {header}')
+    client = token_registry.authenticate(request.headers.get('Authorization'))
+    if client is None:
+        metrics.reject(request.endpoint, 'Authorization')
+        abort(400, description='Missing or invalid header: Authorization')
+    retry_after = token_registry.acquire(client, request.endpoint)
+    if retry_after:
+        abort_json(429, "Too many requests", {'Retry-After': str(math.ceil(retry_after))})
+    mark_phase('headers')
+
+
+def request_body():
+    # The request body with any Content-Encoding undone. Call it outside the
+    # route's own error handling, since it aborts with a response of its own.
+    body = request.get_data()
+    encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+    if encoding == 'identity':
+        if len(body) > MAX_BODY_BYTES:
+            abort_json(413, "Request body too large")
+    else:
+        try:
+            body = compression.decompress(body, encoding, MAX_BODY_BYTES)
+        except KeyError:
+            abort_json(415, "Unsupported Content-Encoding")
+        except compression.BodyTooLarge:
+            abort_json(413, "Request body too large")
+        except ValueError:
+            abort_json(400, "Invalid compressed body")
+    mark_phase('body')
+    return body
+
+
+def parse_pagination(args):
+    # Returns (cursor, limit); limit is None when the client did not ask for a page
+    cursor = int(args.get('cursor', 0))
+    limit = args.get('limit')
+    if cursor < 0:
+        raise ValueError('cursor')
+    if limit is not None:
+        limit = int(limit)
+        if limit <= 0:
+            raise ValueError('limit')
+        limit = min(limit, MAX_PAGE_LIMIT)
+    return cursor, limit
+
+
+def parse_ttl(value):
+    # Seconds a new record lives for, or None to keep it until deleted
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = float(value)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 < value < float('inf'):
+        raise ValueError('ttl')
+    return value
+
+
+def parse_filter_value(text):
+    # Values are read as JSON where possible, so 18 is a number and "18" a string
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def parse_filters(args):
+    # Returns a list of Filter conditions taken from the filter[...] query parameters
+    filters = []
+    for name, text in args.items(multi=True):
+        match = FILTER_PARAM_RE.match(name)
+        if match is None:
+            continue
+        field, op = match.group(1), match.group(2) or 'eq'
+        if op not in FILTER_OPERATORS:
+            raise ValueError(op)
+        if op == 'in':
+            value = [parse_filter_value(item) for item in text.split(',')]
+        else:
+            value = parse_filter_value(text)
+            if op in RANGE_OPERATORS and sort_key(value) is None:
+                raise ValueError(text)
+        filters.append(Filter(field, op, value))
+    return filters
+
+
+def cache_key(filters, cursor, limit, paginated):
+    # Built from what the request parsed to, so parameters /get ignores, such
+    # as an XHR cache-buster, do not each get a copy of the body. Conditions
+    # are ANDed, so their order does not matter.
+    conditions = tuple(sorted((condition.field, condition.op, value_key(condition.value)) for condition in filters))
+    return cursor, limit, paginated, conditions
+
+
+def iter_records(filters, cursor, limit):
+    # Walk the store lazily so a response never holds more than one record at a time
+    for _, record in islice(data_storage.query(filters, cursor), limit):
+        yield record
+
+
+def stream_records(mode, filters, cursor, limit):
+    encode_record = codec.encode_record
+    if mode == 'ndjson':
+        for record in iter_records(filters, cursor, limit):
+            yield encode_record(record) + b'\n'
+        return
+
+    # Incrementally encoded {"data": [...]} document
+    yield b'{"data":['
+    separator = b''
+    for record in iter_records(filters, cursor, limit):
+        yield separator + encode_record(record)
+        separator = b','
+    yield b']}'
+
+
+def encode_records(filters, cursor, limit, paginated):
+    # Records are encoded one by one and joined, so raw records are copied out as they are
+    encode_record = codec.encode_record
+    if not paginated:
+        records = b','.join(encode_record(record) for _, record in data_storage.query(filters))
+        return b'{"data":[' + records + b']}'
+
+    # Fetch one record past the page to learn whether another page exists
+    page = list(islice(data_storage.query(filters, cursor), None if limit is None else limit + 1))
+    next_cursor = None
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        next_cursor = page[-1][0] + 1
+    records = b','.join(encode_record(record) for _, record in page)
+    return b'{"data":[' + records + b'],"next_cursor":' + codec.dumps(next_cursor) + b'}'
+
+
+def parse_record(body):
+    # (data, raw) for a request body holding one record; raw is the body
+    # when raw mode may keep it as it is, see stored_form()
+    if not RAW_RECORDS:
+        return codec.loads(body), None
+    return codec.loads_record(body)
+
+
+def stored_form(data, raw=None):
+    # What goes into the store for a parsed request body: the object itself,
+    # or in raw mode its JSON text. raw is the request body it was parsed from
+    # when parse_record() found it strict UTF-8 JSON, reused unless it spans
+    # several lines, which would break NDJSON and the log.
+    if not RAW_RECORDS:
+        return data
+    if raw is None or b'\n' in raw or b'\r' in raw:
+        return codec.dumps(data)
+    return raw.strip()
+
+
+def record_response(fields, record, status, etag=None):
+    # jsonify(dict(fields, data=record)), splicing raw records in without decoding them
+    if isinstance(record, bytes):
+        body = codec.dumps(fields)[:-1] + (b',"data":' if fields else b'"data":') + record + b'}'
+        response = Response(body, status=status, mimetype='application/json')
+    else:
+        response = jsonify(dict(fields, data=record))
+        response.status_code = status
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+def record_etag(record_id, revision):
+    return f'{data_storage.epoch}-{record_id}-{revision}'
+
+
+def etag_matches(etags, etag):
+    # A record's ETag gains a -<coding> suffix when its response is compressed;
+    # every coding of the same revision counts as a match
+    return etag in etags or any(f'{etag}-{encoding}' in etags for encoding in RESPONSE_ENCODINGS)
+
+
+def if_match_revision(record_id):
+    # The revision a write must still find the record at, or None without If-Match.
+    # Like request_body(), call it outside the route's own error handling.
+    if not request.if_match:
+        return None
+    found = data_storage.get_with_revision(record_id)
+    if found is None:
+        abort_json(404, "Not found")
+    if not etag_matches(request.if_match, record_etag(record_id, found[1])):
+        abort_json(412, "Precondition failed")
+    return found[1]
 
 
 @app.route('/get', methods=['GET'])
 def get_data():
     check_headers(REQUIRED_HEADERS)
-    return jsonify({"data": data_storage}), 200
+
+    try:
+        cursor, limit = parse_pagination(request.args)
+    except ValueError:
+        return jsonify({"error": "Invalid pagination parameters"}), 400
+
+    try:
+        filters = parse_filters(request.args)
+    except ValueError:
+        return jsonify({"error": "Invalid filter"}), 400
+
+    # Removing due records first bumps the version, so neither the ETag nor
+    # a cached body outlives a record that has expired
+    data_storage.expire_due()
+
+    stream = request.args.get('stream')
+    if stream is not None:
+        if stream not in STREAM_MIMETYPES:
+            return jsonify({"error": "Invalid stream mode"}), 400
+        return Response(stream_records(stream, filters, cursor, limit), status=200,
+                        mimetype=STREAM_MIMETYPES[stream])
+
+    # Each coding is its own representation, with its own ETag
+    encoding = compression.choose_encoding(request.accept_encodings, RESPONSE_ENCODINGS)
+    version = data_storage.version
+    etag = f'{data_storage.epoch}-{version}' + (f'-{encoding}' if encoding else '')
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        if RESPONSE_ENCODINGS:
+            response.vary.add('Accept-Encoding')
+        return response
+
+    # Pollers mostly ask for the same thing, so reuse the body while the store is unchanged
+    paginated = limit is not None or 'cursor' in request.args
+    key = cache_key(filters, cursor, limit, paginated)
+    body = response_cache.get(version, key)
+    if body is None:
+        body = encode_records(filters, cursor, limit, paginated)
+        response_cache.put(version, key, body)
+    mark_phase('store')
+
+    # Compressed bodies are cached alongside, so each coding is compressed once per version
+    content_encoding = None
+    if encoding is not None and len(body) >= COMPRESS_MIN_BYTES:
+        compressed = response_cache.get(version, (key, encoding))
+        if compressed is None:
+            compressed = RESPONSE_ENCODINGS[encoding](body)
+            response_cache.put(version, (key, encoding), compressed)
+        body, content_encoding = compressed, encoding
+
+    response = Response(body, status=200, mimetype='application/json')
+    response.set_etag(etag)
+    if RESPONSE_ENCODINGS:
+        response.vary.add('Accept-Encoding')
+    if content_encoding is not None:
+        response.headers['Content-Encoding'] = content_encoding
+    return response
+
+
+@app.route('/get/<int:record_id>', methods=['GET'])
+def get_record(record_id):
+    check_headers(REQUIRED_HEADERS)
+
+    found = data_storage.get_with_revision(record_id)
+    mark_phase('store')
+    if found is None:
+        return jsonify({"error": "Not found"}), 404
+    record, revision = found
+    etag = record_etag(record_id, revision)
+    if etag_matches(request.if_none_match, etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return record_response({"id": record_id}, record, 200, etag)
 
 
 @app.route('/post', methods=['POST'])
@@ -32,58 +506,318 @@ def post_data():
     if request.content_type != 'application/json':
         return jsonify({"error": "Invalid Content-Type"}), 400
 
+    try:
+        ttl = parse_ttl(request.args.get('ttl'))
+    except ValueError:
+        return jsonify({"error": "Invalid TTL"}), 400
+
+    body = request_body()
     try:
         # Attempt to parse the JSON
-        data = request.get_json(force=True)
-        data_storage.append(data)
-        return jsonify({"message": "Data received", "data": data}), 201
+        data, raw = parse_record(body)
+        record = stored_form(data, raw)
     except Exception:
         return jsonify({"error": "Invalid JSON"}), 400
+    mark_phase('parse')
+    # Outside the try above: once the record is stored, a failure is not the body's fault
+    record_id = data_storage.add(record, ttl)
+    mark_phase('store')
+    return jsonify({"message": "Data received", "id": record_id, "data": data}), 201
 
 
-@app.route('/put/<int:index>', methods=['PUT'])
-def put_data(index):
+@app.route('/put/<int:record_id>', methods=['PUT'])
+def put_data(record_id):
     # Check for required headers
     check_headers(REQUIRED_HEADERS)
 
-    if index < 0 or index >= len(data_storage):
+    if record_id not in data_storage:
         return jsonify({"error": "Not found"}), 404
 
+    revision = if_match_revision(record_id)
+    body = request_body()
     try:
-        data = request.get_json(force=True)
-        data_storage[index] = data  # Update the item at the specified index
-        return jsonify({"message": "Data updated", "data": data}), 200
+        data, raw = parse_record(body)
+        record = stored_form(data, raw)
     except Exception:
         return jsonify({"error": "Invalid JSON"}), 400
+    mark_phase('parse')
+    try:
+        # Update the record with the specified ID, if it is still at the revision If-Match named
+        revision = data_storage.replace(record_id, record, revision)
+    except KeyError:
+        return jsonify({"error": "Not found"}), 404
+    except RevisionMismatch:
+        return jsonify({"error": "Precondition failed"}), 412
+    mark_phase('store')
+    return record_response({"message": "Data updated"}, data, 200, record_etag(record_id, revision))
+
+
+def merge_fields(record, data):
+    # Records are replaced rather than modified so concurrent readers never see a partial update
+    merged = dict(codec.decode_record(record))
+    merged.update(data)
+    return stored_form(merged)
+
 
+def patch_function(mimetype, data):
+    # How a PATCH body changes a record, by its Content-Type. Any type other
+    # than the two patch formats keeps the original shallow merge of fields.
+    if mimetype == MERGE_PATCH_MIMETYPE:
+        return lambda current: stored_form(merge_patch(codec.decode_record(current), data))
+    if mimetype == JSON_PATCH_MIMETYPE:
+        operations = parse_json_patch(data)
+        return lambda current: stored_form(apply_json_patch(codec.decode_record(current), operations))
+    return lambda current: merge_fields(current, data)
 
-@app.route('/patch/<int:index>', methods=['PATCH'])
-def patch_data(index):
+
+@app.route('/patch/<int:record_id>', methods=['PATCH'])
+def patch_data(record_id):
     # Check for required headers
     check_headers(REQUIRED_HEADERS)
 
-    if index < 0 or index >= len(data_storage):
+    if record_id not in data_storage:
         return jsonify({"error": "Not found"}), 404
 
+    revision = if_match_revision(record_id)
+    body = request_body()
     try:
-        data = request.get_json(force=True)
-        # Assuming we want to update only certain fields and not replace the entire item
-        data_storage[index].update(data)  # Update the item at the specified index
-        return jsonify({"message": "Data patched/partially updated", "data": data_storage[index]}), 200
+        data = codec.loads(body)
+        mark_phase('parse')
+        # The patch is applied under the record's lock, to a copy of only the parts it changes
+        record, revision = data_storage.update_with_revision(record_id, patch_function(request.mimetype, data),
+                                                             revision)
+        mark_phase('store')
+        return record_response({"message": "Data patched/partially updated"}, record, 200,
+                               record_etag(record_id, revision))
+    except KeyError:
+        return jsonify({"error": "Not found"}), 404
+    except RevisionMismatch:
+        return jsonify({"error": "Precondition failed"}), 412
+    except PatchConflict as exc:
+        return jsonify({"error": "Patch does not apply", "detail": str(exc)}), 409
+    except PatchError as exc:
+        return jsonify({"error": "Invalid patch", "detail": str(exc)}), 400
     except Exception:
         return jsonify({"error": "Invalid JSON"}), 400
 
 
-@app.route('/delete/<int:index>', methods=['DELETE'])
-def delete_data(index):
+@app.route('/delete/<int:record_id>', methods=['DELETE'])
+def delete_data(record_id):
     # Check for required headers
     check_headers(REQUIRED_HEADERS)
 
-    if index < 0 or index >= len(data_storage):
+    revision = if_match_revision(record_id)
+    try:
+        deleted_item = data_storage.pop(record_id, revision)  # Remove the record with the specified ID
+    except KeyError:
         return jsonify({"error": "Not found"}), 404
+    except RevisionMismatch:
+        return jsonify({"error": "Precondition failed"}), 412
+    mark_phase('store')
+    return record_response({"message": "Data deleted"}, deleted_item, 200)
+
+
+def parse_batch_operations(body):
+    # A batch is either one JSON array or an NDJSON body with one operation per line
+    loads = codec.loads
+    if request.mimetype == 'application/x-ndjson':
+        return [loads(line) for line in body.splitlines() if line.strip()]
+    operations = loads(body)
+    if not isinstance(operations, list):
+        raise ValueError('batch must be a JSON array')
+    return operations
+
+
+def apply_batch_operation(txn, operation):
+    # Applies one operation inside a store transaction; an atomic batch that
+    # fails is undone with txn.rollback()
+    kind = operation.get('op') if isinstance(operation, dict) else None
+    if kind not in BATCH_OPERATIONS or (kind != 'delete' and 'data' not in operation):
+        return {"status": 400, "error": "Invalid operation"}
+
+    if kind == 'insert':
+        try:
+            ttl = parse_ttl(operation.get('ttl'))
+        except ValueError:
+            return {"status": 400, "error": "Invalid operation"}
+        record_id = txn.add(stored_form(operation['data']), ttl)
+        return {"status": 201, "id": record_id}
+
+    record_id = operation.get('id')
+    if not isinstance(record_id, int) or isinstance(record_id, bool):
+        return {"status": 400, "error": "Invalid operation"}
+    record = txn.get(record_id, MISSING)
+    if record is MISSING:
+        return {"status": 404, "error": "Not found"}
+
+    if kind == 'put':
+        txn.replace(record_id, stored_form(operation['data']))
+    elif kind == 'patch':
+        if not isinstance(codec.decode_record(record), dict) or not isinstance(operation['data'], dict):
+            return {"status": 400, "error": "Invalid operation"}
+        txn.replace(record_id, merge_fields(record, operation['data']))
+    else:
+        txn.pop(record_id)
+    return {"status": 200, "id": record_id}
+
+
+@app.route('/batch', methods=['POST'])
+def batch_data():
+    # Check for required headers
+    check_headers(REQUIRED_HEADERS)
+
+    if request.mimetype not in ('application/json', 'application/x-ndjson'):
+        return jsonify({"error": "Invalid Content-Type"}), 400
+
+    body = request_body()
+    try:
+        operations = parse_batch_operations(body)
+    except Exception:
+        return jsonify({"error": "Invalid JSON"}), 400
+    mark_phase('parse')
+
+    atomic = request.args.get('atomic', 'false').lower() in ('1', 'true', 'yes')
+    results = []
+    # The whole batch runs under a single acquisition of the store locks
+    with data_storage.transaction() as txn:
+        for operation in operations:
+            result = apply_batch_operation(txn, operation)
+            results.append(result)
+            if atomic and result["status"] >= 400:
+                # Nothing of an aborted batch reaches the change feed or the log
+                txn.rollback()
+                mark_phase('store')
+                return jsonify({"error": "Batch aborted", "results": results}), 409
+    mark_phase('store')
+    return jsonify({"results": results}), 200
+
+
+def parse_feed_params(args, headers):
+    # Returns (since, limit, wait); since is None for "from now on"
+    since = headers.get('Last-Event-ID', args.get('since'))
+    if since is not None:
+        since = int(since)
+        if since < 0:
+            raise ValueError('since')
+    limit = args.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if limit <= 0:
+            raise ValueError('limit')
+    wait = float(args.get('wait', DEFAULT_FEED_WAIT))
+    if not 0 <= wait <= MAX_FEED_WAIT:
+        raise ValueError('wait')
+    return since, limit, wait
+
+
+def encode_gap(gap):
+    return codec.dumps({"error": "Changes no longer available", "last_seq": gap.last_seq})
+
+
+def feed_waits_async():
+    # Only the feed of a store in this process can wake an event loop
+    return isinstance(data_storage, RecordStore)
+
+
+def request_blocks(environ):
+    # Whether the request a WSGI environ describes may take more than
+    # microseconds: every call to a shared store is a round trip to its
+    # owner, a /get of the whole store or a stream of it may encode
+    # every record, and a write to a journaled store may wait for fsync.
+    # Other reads only touch memory.
+    if not isinstance(data_storage, RecordStore):
+        return True
+    if environ['PATH_INFO'] == '/get':
+        args = parse_qs(environ.get('QUERY_STRING', ''), keep_blank_values=True)
+        return 'stream' in args or 'limit' not in args
+    return data_storage.journal is not None and environ['REQUEST_METHOD'] not in READ_METHODS
+
+
+def stream_changes(since, limit, async_wait=False):
+    # Server-Sent Events until the client goes away, or until limit events have been sent
+    sent = 0
+    while limit is None or sent < limit:
+        remaining = None if limit is None else limit - sent
+        try:
+            if async_wait:
+                yield FeedWait(data_storage.feed, since, SSE_HEARTBEAT)
+                changes = data_storage.changes(since, remaining)
+            else:
+                changes = data_storage.changes(since, remaining, SSE_HEARTBEAT)
+        except FeedGap as gap:
+            # The client missed events and has to reload before subscribing again
+            yield b'event: reset\ndata: ' + encode_gap(gap) + b'\n\n'
+            return
+        if not changes:
+            yield b': keep-alive\n\n'
+            continue
+        for change in changes:
+            yield b'id: %d\nevent: change\ndata: ' % change.seq + change.encoded() + b'\n\n'
+        since = changes[-1].seq
+        sent += len(changes)
+
+
+def encode_changes(changes, since):
+    last_seq = changes[-1].seq if changes else since
+    return (b'{"changes":[' + b','.join(change.encoded() for change in changes) +
+            b'],"last_seq":' + codec.dumps(last_seq) + b'}')
+
+
+def long_poll_later(since, limit, wait):
+    # A long-poll body for an event-loop server, which waits out the FeedWait on the loop
+    yield FeedWait(data_storage.feed, since, wait)
+    try:
+        changes = data_storage.changes(since, limit)
+    except FeedGap:
+        # The status has gone out already; report nothing new and the next poll gets the 410
+        changes = []
+    yield encode_changes(changes, since)
+
+
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    check_headers(REQUIRED_HEADERS)
+
+    try:
+        since, limit, wait = parse_feed_params(request.args, request.headers)
+    except ValueError:
+        return jsonify({"error": "Invalid feed parameters"}), 400
+
+    if since is None:
+        # Only changes from now on; pinned here so the client can be told where it started
+        since = data_storage.last_seq
+
+    async_wait = request.environ.get(ASYNC_FEED_ENVIRON, False) and feed_waits_async()
+    if request.args.get('stream') == 'sse' or request.accept_mimetypes.best == 'text/event-stream':
+        return Response(stream_changes(since, limit, async_wait), status=200, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+
+    # Long-poll: answer as soon as anything after since exists, or after wait seconds
+    limit = min(limit or MAX_PAGE_LIMIT, MAX_PAGE_LIMIT)
+    try:
+        changes = data_storage.changes(since, limit, 0 if async_wait else wait)
+    except FeedGap as gap:
+        return Response(encode_gap(gap), status=410, mimetype='application/json')
+    if not changes and wait and async_wait:
+        # Nothing yet; the event loop waits for a change instead of this thread
+        return Response(long_poll_later(since, limit, wait), status=200, mimetype='application/json')
+    # Time spent waiting for a change is not the server being slow
+    mark_phase('wait')
+    return Response(encode_changes(changes, since), status=200, mimetype='application/json')
+
 
-    deleted_item = data_storage.pop(index)  # Remove the item at the specified index
-    return jsonify({"message": "Data deleted", "data": deleted_item}), 200
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus scrape target. It exposes no records, so it takes no headers.
+    body = metrics.render([
+        ('local_server_records', 'Records in the store.', len(data_storage)),
+        ('local_server_store_bytes', 'Approximate memory held by the store.', data_storage.approximate_bytes()),
+    ], counters=[
+        ('local_server_evicted_records_total', 'Records evicted to stay within the store limits.',
+         data_storage.evicted),
+        ('local_server_expired_records_total', 'Records removed when their TTL ran out.', data_storage.expired),
+    ])
+    return Response(body, status=200, content_type=METRICS_CONTENT_TYPE)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,289 @@
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.wrappers import Response as WerkzeugResponse
+
+from local_server import ASYNC_FEED_ENVIRON, app as flask_app, feed_waits_async, request_blocks
+from local_server_feed import FeedWait
+
+# Routes that wait for changes and must not block the event loop
+BLOCKING_PATHS = frozenset(('/changes',))
+
+# Threads available to those routes when their waits cannot be awaited on the
+# loop, i.e. concurrent long-polls and SSE subscriptions on a shared store
+BLOCKING_THREADS = 256
+
+# Threads for ordinary requests that may wait on I/O, e.g. writes that fsync
+# the journal or calls to a shared store, kept apart from the feed's threads
+# so that subscribers cannot starve them
+STORE_THREADS = 32
+
+
+def build_environ(scope, body):
+    # Translate an ASGI HTTP scope into the WSGI environ Flask expects
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        # The body is read in full, so its end is known even when it came chunked
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = name
+        else:
+            key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+class AsgiApp:
+    """ASGI entry point serving the same Flask routes on an event loop.
+
+    The loop holds any number of idle keep-alive connections without a
+    thread per connection, which is what the threaded WSGI server runs out
+    of. Routes, the header contract and response shapes are exactly those
+    of local_server.app.
+
+    A request that only touches the in-memory store finishes in
+    microseconds, so it is dispatched to the Flask app inline on the loop.
+    One for which offload(environ) is true, e.g. a write that waits for the
+    journal's fsync, a /get that encodes the whole store or any call to a
+    shared store, runs, and has its body pulled, on a pool of store_threads
+    threads instead, so that it does not stall every other connection.
+
+    The change feed's requests wait for writes, and are handled apart. When
+    async_feed() says so, they run inline and their bodies yield a
+    FeedWait for each wait, which the loop awaits, so a waiting subscriber
+    costs a future rather than a thread. Otherwise, e.g. on a shared store
+    whose feed lives in another process, they run, and their bodies are
+    pulled, on a pool of blocking_threads threads. Either way the client's
+    disconnect is watched for, and ends the body.
+    """
+
+    def __init__(self, wsgi_app, blocking_paths=BLOCKING_PATHS, blocking_threads=BLOCKING_THREADS,
+                 async_feed=None, offload=None, store_threads=STORE_THREADS):
+        self.wsgi_app = wsgi_app
+        self.blocking_paths = blocking_paths
+        self.async_feed = async_feed
+        self.offload = offload
+        self._executor = ThreadPoolExecutor(max_workers=blocking_threads, thread_name_prefix='asgi-blocking')
+        self._store_executor = ThreadPoolExecutor(max_workers=store_threads, thread_name_prefix='asgi-store')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported scope type: {scope['type']}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                  for name, value in headers]
+
+        environ = build_environ(scope, b''.join(chunks))
+        if scope['path'] in self.blocking_paths:
+            if self.async_feed is not None and self.async_feed():
+                environ[ASYNC_FEED_ENVIRON] = True
+                body = self.wsgi_app(environ, start_response)
+                await self._send_watched(body, self._pull_async, body.close, started, send, receive)
+            else:
+                await self._send_blocking(self._executor, environ, start_response, started, send, receive)
+            return
+        if self.offload is not None and self.offload(environ):
+            await self._send_blocking(self._store_executor, environ, start_response, started, send, receive)
+            return
+
+        body = self.wsgi_app(environ, start_response)
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'],
+                        'headers': started['headers']})
+            # Streaming responses go out chunk by chunk, giving the loop a
+            # chance to serve other connections in between
+            for chunk in body:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    async def _send_blocking(self, executor, environ, start_response, started, send, receive):
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(executor, self.wsgi_app, environ, start_response)
+        pulling = None
+
+        def pull(chunks):
+            nonlocal pulling
+            pulling = executor.submit(next, chunks, None)
+            return asyncio.wrap_future(pulling)
+
+        def close():
+            # A body cannot be closed while a thread is still pulling from it
+            if pulling is not None and not pulling.done():
+                pulling.add_done_callback(lambda _: body.close())
+            else:
+                body.close()
+
+        await self._send_watched(body, pull, close, started, send, receive)
+
+    @staticmethod
+    async def _pull_async(chunks):
+        # The next chunk of a body, awaiting on the loop every FeedWait it yields first
+        chunk = next(chunks, None)
+        while isinstance(chunk, FeedWait):
+            await chunk.feed.wait(chunk.seq, chunk.timeout)
+            chunk = next(chunks, None)
+        return chunk
+
+    @staticmethod
+    async def _disconnected(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def _send_watched(self, body, pull, close, started, send, receive):
+        # Sends body until it ends or the client goes away. Servers such as
+        # uvicorn quietly drop what is sent after a disconnect, so an endless
+        # SSE body would never notice on its own; receive() tells us instead.
+        disconnected = asyncio.ensure_future(self._disconnected(receive))
+        chunks = iter(body)
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'],
+                        'headers': started['headers']})
+            while True:
+                pulling = asyncio.ensure_future(pull(chunks))
+                await asyncio.wait((pulling, disconnected), return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    pulling.cancel()
+                    return
+                chunk = pulling.result()
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            disconnected.cancel()
+            close()
+
+
+app = AsgiApp(flask_app, async_feed=feed_waits_async, offload=request_blocks)
+
+
+class TestClient:
+    """Minimal synchronous client that drives an ASGI app in-process.
+
+    Mirrors the parts of Flask's test client the unit tests and benchmarks
+    use, so the same test code runs against either serving mode.
+    """
+
+    def __init__(self, asgi_app):
+        self.asgi_app = asgi_app
+
+    def open(self, path, method='GET', headers=None, data=None):
+        return asyncio.run(self._request(method, path, headers or {}, data))
+
+    def get(self, path, **kwargs):
+        return self.open(path, method='GET', **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, method='POST', **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.open(path, method='PUT', **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.open(path, method='PATCH', **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open(path, method='DELETE', **kwargs)
+
+    async def _request(self, method, path, headers, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        data = data or b''
+        path, _, query = path.partition('?')
+        raw_headers = [(name.lower().encode('latin-1'), str(value).encode('latin-1'))
+                       for name, value in headers.items()]
+        if data:
+            raw_headers.append((b'content-length', str(len(data)).encode()))
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode('utf-8'),
+            'query_string': query.encode('utf-8'),
+            'root_path': '',
+            'headers': raw_headers,
+            'client': ('127.0.0.1', 0),
+            'server': ('localhost', 80),
+        }
+        request_sent = False
+        messages = []
+        # Like a real client, stay connected until the whole response has arrived
+        finished = asyncio.Event()
+
+        async def receive():
+            nonlocal request_sent
+            if request_sent:
+                await finished.wait()
+                return {'type': 'http.disconnect'}
+            request_sent = True
+            return {'type': 'http.request', 'body': data, 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                finished.set()
+
+        await self.asgi_app(scope, receive, send)
+        start = messages[0]
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in start['headers']]
+        return WerkzeugResponse(body, status=start['status'], headers=headers)
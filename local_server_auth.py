@@ -0,0 +1,129 @@
+import hashlib
+import threading
+import time
+from collections import namedtuple
+
+# Tokens accepted when LOCAL_SERVER_TOKENS is not set
+DEFAULT_TOKENS = ('your_token',)
+
+# Route name in a limits table that applies to routes without a limit of their own
+DEFAULT_ROUTE = '*'
+
+BEARER_PREFIX = 'Bearer '
+
+# rate is in requests per second; burst is how many may arrive at once after a quiet spell
+RateLimit = namedtuple('RateLimit', 'rate burst')
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode()).digest()
+
+
+def parse_tokens(spec):
+    # spec is a comma separated list of tokens
+    return [token.strip() for token in spec.split(',') if token.strip()]
+
+
+def parse_rate_limits(spec):
+    """Parse a comma separated list of route=rate[:burst] into {route: RateLimit}.
+
+    The route * applies to every route not listed. burst defaults to the
+    rate, and to 1 for rates below one request per second.
+    """
+    limits = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        route, sep, value = item.partition('=')
+        if not sep or not route:
+            raise ValueError(f'Invalid rate limit: {item}')
+        rate, _, burst = value.partition(':')
+        rate = float(rate)
+        burst = float(burst) if burst else max(rate, 1.0)
+        if not 0 < rate < float('inf') or not 1 <= burst < float('inf'):
+            raise ValueError(f'Invalid rate limit: {item}')
+        limits[route.strip()] = RateLimit(rate, burst)
+    return limits
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class TokenRegistry:
+    """Bearer tokens that clients may present, each rate limited per route.
+
+    Tokens are held as SHA-256 digests and looked up by the digest of the
+    presented token, so checking one is a hash and a set lookup however
+    many are registered. The lookup compares digests, never the token
+    itself, so how long it takes says nothing about how much of a
+    registered token a guess got right.
+
+    Each (token, route) pair has a token bucket that refills at the
+    route's rate up to its burst. acquire() takes one request from it and
+    is a lock acquisition and a little arithmetic; routes without a limit
+    skip even that.
+    """
+
+    def __init__(self, tokens=DEFAULT_TOKENS, limits=None, clock=time.monotonic):
+        self._digests = set()
+        self.limits = dict(limits or {})
+        self._buckets = {}
+        self._clock = clock
+        self._lock = threading.Lock()
+        for token in tokens:
+            self.add(token)
+
+    def __len__(self):
+        return len(self._digests)
+
+    def add(self, token):
+        if not token:
+            raise ValueError('Empty token')
+        self._digests.add(token_digest(token))
+
+    def remove(self, token):
+        digest = token_digest(token)
+        self._digests.discard(digest)
+        with self._lock:
+            for key in [key for key in self._buckets if key[0] == digest]:
+                del self._buckets[key]
+
+    def authenticate(self, authorization):
+        """Return the client key for an Authorization header value, or None if it is not accepted."""
+        if not authorization or not authorization.startswith(BEARER_PREFIX):
+            return None
+        digest = token_digest(authorization[len(BEARER_PREFIX):])
+        return digest if digest in self._digests else None
+
+    def limit_for(self, route):
+        limit = self.limits.get(route)
+        return self.limits.get(DEFAULT_ROUTE) if limit is None else limit
+
+    def acquire(self, client, route):
+        """Count one request by client on route; return 0, or the seconds to wait if it is over its limit."""
+        limit = self.limit_for(route)
+        if limit is None:
+            return 0
+        key = (client, route)
+        with self._lock:
+            now = self._clock()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = _Bucket(limit.burst, now)
+            else:
+                bucket.tokens = min(limit.burst, bucket.tokens + (now - bucket.updated) * limit.rate)
+                bucket.updated = now
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0
+            return (1 - bucket.tokens) / limit.rate
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
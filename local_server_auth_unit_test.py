@@ -0,0 +1,64 @@
+import unittest
+
+from local_server_auth import RateLimit, TokenRegistry, parse_rate_limits
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenRegistryTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.registry = TokenRegistry(['alpha', 'beta'], {'*': RateLimit(1, 2), 'post_data': RateLimit(10, 1)},
+                                      clock=self.clock)
+
+    def test_authenticate(self):
+        """Test that only registered tokens, sent as Bearer tokens, are accepted."""
+        alpha = self.registry.authenticate('Bearer alpha')
+        self.assertIsNotNone(alpha)
+        self.assertNotEqual(alpha, self.registry.authenticate('Bearer beta'))
+        for value in (None, '', 'alpha', 'Bearer alph', 'Bearer alphaa', 'Basic alpha'):
+            self.assertIsNone(self.registry.authenticate(value))
+        self.registry.remove('alpha')
+        self.assertIsNone(self.registry.authenticate('Bearer alpha'))
+        self.assertEqual(len(self.registry), 1)
+
+    def test_bucket_refills_at_rate(self):
+        """Test that a bucket allows its burst, then one request per refill, and says how long to wait."""
+        client = self.registry.authenticate('Bearer alpha')
+        self.assertEqual(self.registry.acquire(client, 'get_data'), 0)
+        self.assertEqual(self.registry.acquire(client, 'get_data'), 0)
+        self.assertAlmostEqual(self.registry.acquire(client, 'get_data'), 1.0)
+        self.clock.now = 0.5
+        self.assertAlmostEqual(self.registry.acquire(client, 'get_data'), 0.5)
+        self.clock.now = 1.0
+        self.assertEqual(self.registry.acquire(client, 'get_data'), 0)
+        # The route's own limit applies instead of the default, and other clients have their own buckets
+        self.assertEqual(self.registry.acquire(client, 'post_data'), 0)
+        self.assertAlmostEqual(self.registry.acquire(client, 'post_data'), 0.1)
+        self.assertEqual(self.registry.acquire(self.registry.authenticate('Bearer beta'), 'get_data'), 0)
+
+    def test_unlimited_routes(self):
+        """Test that routes without a limit, and no default, are never throttled."""
+        registry = TokenRegistry(['alpha'], {'post_data': RateLimit(1, 1)}, clock=self.clock)
+        client = registry.authenticate('Bearer alpha')
+        for _ in range(100):
+            self.assertEqual(registry.acquire(client, 'get_data'), 0)
+
+    def test_parse_rate_limits(self):
+        """Test the LOCAL_SERVER_RATE_LIMITS format and that malformed limits are rejected."""
+        self.assertEqual(parse_rate_limits(''), {})
+        self.assertEqual(parse_rate_limits('*=100:200, post_data=0.5'),
+                         {'*': RateLimit(100.0, 200.0), 'post_data': RateLimit(0.5, 1.0)})
+        for spec in ('post_data', '=5', 'post_data=0', 'post_data=-1', 'post_data=5:0', 'post_data=x'):
+            with self.assertRaises(ValueError):
+                parse_rate_limits(spec)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,426 @@
+import argparse
+import asyncio
+import http.client
+import importlib.util
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from local_server_cache import DEFAULT_CACHE_ENTRIES
+
+HEADERS = {
+    'X-Requested-With': 'XMLHttpRequest',
+    'Authorization': 'Bearer your_token',
+}
+
+# get reads one page over and over, as a poller does, so it measures the
+# response cache; get_page and get_all miss it and measure encoding
+ROUTES = ('get', 'get_page', 'get_all', 'post', 'put', 'patch', 'delete')
+# get_page walks this many cursors in turn, more than the cache holds, so no page is still cached when asked again
+PAGE_CURSORS = 2 * DEFAULT_CACHE_ENTRIES
+# Records a get_all run encodes in total, which caps its requests on large stores
+FULL_READ_RECORDS = 10000000
+DEFAULT_SIZES = '0,1000,100000,1000000'
+# Records per /batch request when filling a server for the routes benchmark
+PREFILL_BATCH = 10000
+
+# How each serving mode is started as its own process on a given port
+SERVER_COMMANDS = {
+    'wsgi': lambda port: [sys.executable, '-c',
+                          f'from local_server import app; app.run(port={port}, threaded=True)'],
+    'asgi': lambda port: [sys.executable, '-m', 'uvicorn', 'local_server_asgi:app',
+                          '--port', str(port), '--log-level', 'warning'],
+}
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def raise_file_limit():
+    # Every client connection needs a file descriptor
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def start_server(mode, port):
+    if mode == 'asgi' and importlib.util.find_spec('uvicorn') is None:
+        raise RuntimeError('the asgi mode needs uvicorn (pip install uvicorn)')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    server = subprocess.Popen(SERVER_COMMANDS[mode](port), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError(f'{mode} server did not start on port {port}')
+
+
+def build_request(method, path, body=b'', content_type=None):
+    lines = [f'{method} {path} HTTP/1.1', 'Host: 127.0.0.1', 'Connection: keep-alive']
+    lines.extend(f'{name}: {value}' for name, value in HEADERS.items())
+    if content_type:
+        lines.append(f'Content-Type: {content_type}')
+    lines.append(f'Content-Length: {len(body)}')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+
+
+async def read_response(reader):
+    # Returns (status, keep_alive)
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    length = 0
+    keep_alive = True
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'content-length':
+            length = int(value)
+        elif name == b'connection' and value.strip().lower() == b'close':
+            keep_alive = False
+    await reader.readexactly(length)
+    return status, keep_alive
+
+
+async def keep_alive_connection(port, request, deadline, think_time, stats):
+    # One mostly idle keep-alive connection that sends a request every think_time seconds.
+    # A server that closes the connection after a response costs a reconnect.
+    writer = None
+    try:
+        while time.monotonic() < deadline:
+            if writer is None:
+                try:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                except OSError:
+                    stats['failed_connections'] += 1
+                    return
+                stats['opened_connections'] += 1
+            started = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status, keep_alive = await read_response(reader)
+            stats['latencies'].append(time.perf_counter() - started)
+            if status >= 400:
+                stats['errors'] += 1
+            if not keep_alive:
+                writer.close()
+                writer = None
+            await asyncio.sleep(think_time)
+    except (OSError, asyncio.IncompleteReadError):
+        stats['errors'] += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def run_connections(port, connections, duration, think_time):
+    stats = {'opened_connections': 0, 'failed_connections': 0, 'errors': 0, 'latencies': []}
+    request = build_request('GET', '/get')
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*(keep_alive_connection(port, request, deadline, think_time, stats)
+                           for _ in range(connections)))
+    return stats
+
+
+def bench_connections(mode, connections, duration, think_time):
+    """Hold many mostly idle keep-alive connections open against one serving mode."""
+    port = free_port()
+    server = start_server(mode, port)
+    try:
+        stats = asyncio.run(run_connections(port, connections, duration, think_time))
+    finally:
+        server.terminate()
+        server.wait()
+    latencies = stats.pop('latencies')
+    stats.update({
+        'mode': mode,
+        'connections': connections,
+        'requests': len(latencies),
+        'throughput': len(latencies) / duration,
+        'p50_ms': None if not latencies else percentile(latencies, 0.50) * 1000,
+        'p99_ms': None if not latencies else percentile(latencies, 0.99) * 1000,
+    })
+    return stats
+
+
+def route_requests(route, size, requests):
+    # A full /get of a million records takes long enough that a few make the point
+    if route == 'get_all':
+        return max(1, min(requests, FULL_READ_RECORDS // max(size, 1)))
+    return requests
+
+
+def filled_record(i):
+    return {"key": f"value_{i}", "n": i}
+
+
+def untimed_request(route, i, size):
+    """(method, path, body) to send, without timing it, before the i-th request, or None.
+
+    get_all rewrites a filled record as it was, which moves the store
+    version on, so the full body that follows is encoded afresh. Latencies
+    leave these writes out; the route's throughput includes them.
+    """
+    if route == 'get_all' and size:
+        record_id = i % size
+        return 'PUT', f'/put/{record_id}', json.dumps(filled_record(record_id)).encode()
+    return None
+
+
+def route_request(route, i, size, requests):
+    """(method, path, body) for the i-th of requests requests against a store of size records.
+
+    Routes run in ROUTES order, so by the time updates start the post phase
+    has added IDs size to size + requests - 1. Updates are spread over every
+    record, and each delete removes one of the posted records, leaving the
+    store as it was filled.
+    """
+    body = json.dumps({"key": f"value_{i}"}).encode()
+    record_id = random.randrange(size + requests)
+    if route == 'get':
+        return 'GET', '/get?limit=100', b''
+    if route == 'get_page':
+        return 'GET', f'/get?limit=100&cursor={i % PAGE_CURSORS * max(size // PAGE_CURSORS, 1)}', b''
+    if route == 'get_all':
+        return 'GET', '/get', b''
+    if route == 'post':
+        return 'POST', '/post', body
+    if route == 'put':
+        return 'PUT', f'/put/{record_id}', body
+    if route == 'patch':
+        return 'PATCH', f'/patch/{record_id}', body
+    return 'DELETE', f'/delete/{size + i}', b''
+
+
+def summarize(latencies, errors, elapsed):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def fill_in_process(data_storage, size):
+    data_storage.clear()
+    data_storage.load({i: filled_record(i) for i in range(size)}, size)
+
+
+def bench_in_process(client_name, size, requests):
+    """Drive the app through a test client in this process, one request at a time."""
+    from local_server import app, data_storage
+    from local_server_asgi import TestClient, app as asgi_app
+
+    client = app.test_client() if client_name == 'flask' else TestClient(asgi_app)
+    headers = dict(HEADERS, **{'Content-Type': 'application/json'})
+    fill_in_process(data_storage, size)
+    results = {}
+    for route in ROUTES:
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        for i in range(route_requests(route, size, requests)):
+            prepare = untimed_request(route, i, size)
+            if prepare is not None:
+                method, path, body = prepare
+                errors += client.open(path, method=method, headers=headers, data=body).status_code >= 400
+            method, path, body = route_request(route, i, size, requests)
+            begin = time.perf_counter()
+            response = client.open(path, method=method, headers=headers, data=body)
+            latencies.append(time.perf_counter() - begin)
+            errors += response.status_code >= 400
+        results[route] = summarize(latencies, errors, time.perf_counter() - started)
+    data_storage.clear()
+    return results
+
+
+def fill_server(port, size):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    headers = dict(HEADERS, **{'Content-Type': 'application/x-ndjson'})
+    for start in range(0, size, PREFILL_BATCH):
+        lines = (json.dumps({"op": "insert", "data": filled_record(i)})
+                 for i in range(start, min(size, start + PREFILL_BATCH)))
+        connection.request('POST', '/batch', body='\n'.join(lines).encode(), headers=headers)
+        connection.getresponse().read()
+    connection.close()
+
+
+def server_worker(port, route, indexes, size, requests, samples):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    headers = dict(HEADERS, **{'Content-Type': 'application/json'})
+    latencies, errors = [], 0
+    for i in indexes:
+        prepare = untimed_request(route, i, size)
+        if prepare is not None:
+            method, path, body = prepare
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            errors += response.status >= 400
+        method, path, body = route_request(route, i, size, requests)
+        begin = time.perf_counter()
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - begin)
+        errors += response.status >= 400
+    connection.close()
+    samples.append((latencies, errors))
+
+
+def bench_server(mode, size, requests, workers):
+    """Drive a real server over localhost with concurrent keep-alive workers."""
+    port = free_port()
+    server = start_server(mode, port)
+    try:
+        fill_server(port, size)
+        results = {}
+        for route in ROUTES:
+            samples = []
+            threads = [threading.Thread(target=server_worker,
+                                        args=(port, route, range(w, route_requests(route, size, requests), workers),
+                                              size, requests, samples))
+                       for w in range(workers)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            latencies = [latency for worker_latencies, _ in samples for latency in worker_latencies]
+            results[route] = summarize(latencies, sum(errors for _, errors in samples), elapsed)
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def failures(results):
+    """Return a description of every result with failed requests, which make its timings meaningless."""
+    return [f"{entry['target']} {entry['route']} at {entry['size']} records: "
+            f"{entry['errors']} of {entry['requests']} requests failed"
+            for entry in results if entry['errors']]
+
+
+def compare(results, baseline, max_regression):
+    """Return a description of every result that regressed against the baseline."""
+    previous = {(entry['target'], entry['size'], entry['route']): entry for entry in baseline['results']}
+    regressions = []
+    for entry in results:
+        before = previous.get((entry['target'], entry['size'], entry['route']))
+        if before is None:
+            continue
+        if before['throughput'] and entry['throughput'] < before['throughput'] * (1 - max_regression):
+            regressions.append(f"{entry['target']} {entry['route']} at {entry['size']} records: "
+                               f"throughput {before['throughput']:.0f} -> {entry['throughput']:.0f} req/s")
+        if before['p99_ms'] and entry['p99_ms'] > before['p99_ms'] * (1 + max_regression):
+            regressions.append(f"{entry['target']} {entry['route']} at {entry['size']} records: "
+                               f"p99 {before['p99_ms']:.2f} -> {entry['p99_ms']:.2f} ms")
+    return regressions
+
+
+def run_routes(args):
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = []
+    for size in sizes:
+        if args.target in ('flask', 'asgi-client'):
+            by_route = bench_in_process('flask' if args.target == 'flask' else 'asgi', size, args.requests)
+        else:
+            by_route = bench_server(args.target, size, args.requests, args.workers)
+        for route, summary in by_route.items():
+            entry = dict(target=args.target, size=size, route=route, **summary)
+            results.append(entry)
+            print(json.dumps(entry))
+
+    report = {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'requests': args.requests,
+            'workers': args.workers,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    status = 0
+    for failure in failures(results):
+        print(f'FAILED: {failure}', file=sys.stderr)
+        status = 1
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}', file=sys.stderr)
+        if regressions:
+            status = 1
+    return status
+
+
+def run_connections_command(args):
+    raise_file_limit()
+    for mode in args.modes.split(','):
+        try:
+            result = bench_connections(mode, args.connections, args.duration, args.think_time)
+        except RuntimeError as error:
+            result = {'mode': mode, 'skipped': str(error)}
+        print(json.dumps(result))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for local_server')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    routes = commands.add_parser('routes', help='throughput and latency of every route as the store grows')
+    routes.add_argument('--target', default='flask', choices=('flask', 'asgi-client', 'wsgi', 'asgi'),
+                        help='flask and asgi-client run in-process through a test client; '
+                             'wsgi and asgi start a real server and drive it over localhost')
+    routes.add_argument('--sizes', default=DEFAULT_SIZES, help='comma separated store sizes')
+    routes.add_argument('--requests', type=int, default=2000, help='requests per route and size')
+    routes.add_argument('--workers', type=int, default=8, help='concurrent connections against a real server')
+    routes.add_argument('--output', help='write the results to this JSON file')
+    routes.add_argument('--baseline', help='compare against results saved by an earlier run')
+    routes.add_argument('--max-regression', type=float, default=0.2,
+                        help='fail if throughput drops or p99 grows by more than this fraction')
+    routes.set_defaults(func=run_routes)
+
+    connections = commands.add_parser('connections', help='many idle keep-alive connections per serving mode')
+    connections.add_argument('--modes', default='wsgi,asgi', help='comma separated serving modes to compare')
+    connections.add_argument('--connections', type=int, default=1000, help='concurrent keep-alive connections')
+    connections.add_argument('--duration', type=float, default=10.0, help='seconds to run each mode')
+    connections.add_argument('--think-time', type=float, default=1.0,
+                             help='idle seconds between requests per connection')
+    connections.set_defaults(func=run_connections_command)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
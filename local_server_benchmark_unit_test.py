@@ -0,0 +1,67 @@
+import unittest
+
+from local_server_benchmark import (FULL_READ_RECORDS, PAGE_CURSORS, ROUTES, bench_in_process, compare, failures,
+                                    percentile, route_request, route_requests, untimed_request)
+from local_server_cache import DEFAULT_CACHE_ENTRIES
+
+
+class BenchmarkTests(unittest.TestCase):
+    def test_bench_in_process_covers_every_route(self):
+        """Test that an in-process run reports every route without errors, on an empty store too."""
+        for size in (0, 20):
+            results = bench_in_process('flask', size, 10)
+            self.assertEqual(sorted(results), sorted(ROUTES))
+            for summary in results.values():
+                self.assertEqual(summary['requests'], 10)
+                self.assertEqual(summary['errors'], 0)
+                self.assertLessEqual(summary['p50_ms'], summary['p99_ms'])
+
+    def test_deletes_remove_posted_records(self):
+        """Test that every delete targets a distinct record created by the post phase."""
+        paths = [route_request('delete', i, 20, 10)[1] for i in range(10)]
+        self.assertEqual(paths, [f'/delete/{record_id}' for record_id in range(20, 30)])
+
+    def test_uncached_reads_miss_the_cache(self):
+        """Test that get_page cycles through more pages than the cache holds, and get_all writes before each read."""
+        paths = [route_request('get_page', i, 1000000, 1000)[1] for i in range(PAGE_CURSORS + 1)]
+        self.assertGreater(len(set(paths)), DEFAULT_CACHE_ENTRIES)
+        self.assertEqual(paths[0], paths[-1])
+        self.assertEqual(route_request('get_all', 0, 1000, 10)[:2], ('GET', '/get'))
+        self.assertEqual(untimed_request('get_all', 1005, 1000)[:2], ('PUT', '/put/5'))
+        self.assertIsNone(untimed_request('get_page', 0, 1000))
+        self.assertEqual(route_requests('get_all', 1000000, 2000), FULL_READ_RECORDS // 1000000)
+        self.assertEqual(route_requests('get_page', 1000000, 2000), 2000)
+
+    def test_failures_flag_errors(self):
+        """Test that every result with failed requests is reported."""
+        results = [
+            {'target': 'flask', 'size': 0, 'route': 'get', 'requests': 10, 'errors': 0},
+            {'target': 'flask', 'size': 0, 'route': 'delete', 'requests': 10, 'errors': 9},
+        ]
+        self.assertEqual(failures(results), ['flask delete at 0 records: 9 of 10 requests failed'])
+
+    def test_compare_flags_regressions(self):
+        """Test that only results beyond the allowed regression are reported."""
+        baseline = {'results': [
+            {'target': 'flask', 'size': 0, 'route': 'get', 'throughput': 1000.0, 'p99_ms': 1.0},
+            {'target': 'flask', 'size': 0, 'route': 'post', 'throughput': 1000.0, 'p99_ms': 1.0},
+        ]}
+        results = [
+            {'target': 'flask', 'size': 0, 'route': 'get', 'throughput': 900.0, 'p99_ms': 1.1},
+            {'target': 'flask', 'size': 0, 'route': 'post', 'throughput': 700.0, 'p99_ms': 1.5},
+            {'target': 'flask', 'size': 1000, 'route': 'get', 'throughput': 1.0, 'p99_ms': 100.0},
+        ]
+        regressions = compare(results, baseline, 0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all('post' in regression for regression in regressions))
+
+    def test_percentile(self):
+        """Test nearest-rank percentiles."""
+        samples = list(range(1, 101))
+        self.assertEqual(percentile(samples, 0.5), 51)
+        self.assertEqual(percentile(samples, 0.99), 100)
+        self.assertIsNone(percentile([], 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+
+DEFAULT_CACHE_ENTRIES = 128
+# Bodies are whole pages, or the whole store, so entries alone do not bound the memory held
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class ResponseCache:
+    """LRU cache of encoded response bodies for one version of the store.
+
+    Entries are keyed by (version, key), where key identifies the request,
+    e.g. its pagination parameters. A body only stays valid while the store
+    is at the version it was built from, so storing an entry for a newer
+    version drops everything cached for older ones.
+
+    The cache holds at most max_entries bodies and max_bytes of them in
+    total, evicting the least recently used first; a body larger than
+    max_bytes on its own is not cached at all.
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._version = None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, version, key):
+        with self._lock:
+            if version != self._version:
+                return None
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def put(self, version, key, body):
+        with self._lock:
+            if self._version is not None and version < self._version:
+                # Built from a state that has already been superseded
+                return
+            if version != self._version:
+                self._entries.clear()
+                self._bytes = 0
+                self._version = version
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            if len(body) > self.max_bytes:
+                return
+            self._entries[key] = body
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._version = None
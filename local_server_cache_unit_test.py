@@ -0,0 +1,51 @@
+import unittest
+
+from local_server_cache import ResponseCache
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(max_entries=2)
+
+    def test_evicts_least_recently_used(self):
+        """Test that the least recently used entry is evicted first."""
+        self.cache.put(1, 'a', b'a')
+        self.cache.put(1, 'b', b'b')
+        self.cache.get(1, 'a')
+        self.cache.put(1, 'c', b'c')
+        self.assertEqual(self.cache.get(1, 'a'), b'a')
+        self.assertIsNone(self.cache.get(1, 'b'))
+        self.assertEqual(self.cache.get(1, 'c'), b'c')
+
+    def test_evicts_to_byte_limit(self):
+        """Test that entries are evicted until the bodies fit max_bytes, and a body over it is not kept."""
+        cache = ResponseCache(max_entries=8, max_bytes=4)
+        cache.put(1, 'a', b'aa')
+        cache.put(1, 'b', b'bb')
+        cache.put(1, 'c', b'c')
+        self.assertIsNone(cache.get(1, 'a'))
+        self.assertEqual(cache.get(1, 'b'), b'bb')
+        self.assertEqual(cache.bytes, 3)
+        cache.put(1, 'b', b'large')
+        self.assertIsNone(cache.get(1, 'b'))
+        self.assertEqual(cache.get(1, 'c'), b'c')
+        self.assertEqual(cache.bytes, 1)
+
+    def test_ignores_superseded_versions(self):
+        """Test that a body built from an older version is never stored."""
+        self.cache.put(2, 'a', b'new')
+        self.cache.put(1, 'a', b'old')
+        self.assertEqual(self.cache.get(2, 'a'), b'new')
+        self.assertIsNone(self.cache.get(1, 'a'))
+
+    def test_new_version_drops_old_entries(self):
+        """Test that storing a newer version drops every entry for older ones."""
+        self.cache.put(1, 'a', b'a')
+        self.cache.put(2, 'b', b'b')
+        self.assertEqual(len(self.cache), 1)
+        self.assertIsNone(self.cache.get(1, 'a'))
+        self.assertIsNone(self.cache.get(2, 'a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import codecs
+import json
+import math
+import os
+import re
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the stdlib codec is always available
+    orjson = None
+
+
+def _reject_constant(name):
+    raise ValueError(f'Non-finite number: {name}')
+
+
+def _finite_float(text):
+    value = float(text)
+    if not math.isfinite(value):
+        raise ValueError(f'Number out of range: {text}')
+    return value
+
+
+# \u escapes of surrogates, and the surrogates json.loads() lets through
+# undecoded from UTF-8 bytes; valid pairs match as well
+_SURROGATE_BYTES = re.compile(rb'\\u[dD][89a-fA-F]|\xed[\xa0-\xbf]')
+_SURROGATE_TEXT = re.compile(r'\\u[dD][89a-fA-F]|[\ud800-\udfff]')
+
+
+def _may_hold_surrogates(data):
+    if isinstance(data, str):
+        return _SURROGATE_TEXT.search(data) is not None
+    # UTF-16 and UTF-32 have a zero byte among the first four, and cannot be searched byte-wise
+    return b'\x00' in data[:4] or _SURROGATE_BYTES.search(data) is not None
+
+
+class StdlibCodec:
+    name = 'stdlib'
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def loads(self, data):
+        return self._checked(data, json.loads(data))
+
+    def loads_strict(self, data):
+        # json.loads() alone also takes UTF-16/32, a BOM, NaN and Infinity
+        if isinstance(data, bytes):
+            if data.startswith(codecs.BOM_UTF8):
+                raise ValueError('Byte order mark')
+            data = data.decode('utf-8')
+        return self._checked(data, json.loads(data, parse_constant=_reject_constant, parse_float=_finite_float))
+
+    def _checked(self, data, obj):
+        # json.loads() accepts lone surrogates, which no UTF-8 output can
+        # hold; a record with one could be stored but never sent or logged
+        if _may_hold_surrogates(data):
+            try:
+                self.dumps(obj)
+            except UnicodeEncodeError:
+                raise ValueError('Lone surrogate') from None
+        return obj
+
+
+class OrjsonCodec:
+    name = 'orjson'
+
+    def __init__(self):
+        self._fallback = StdlibCodec()
+
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # orjson refuses integers wider than 64 bits, which the stdlib handles
+            return self._fallback.dumps(obj)
+
+    def loads(self, data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # Same reason; input that is really invalid fails here as well
+            return self._fallback.loads(data)
+
+    def loads_strict(self, data):
+        # orjson is strict already, so only the wide integers it refuses reach the fallback
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return self._fallback.loads_strict(data)
+
+
+CODECS = {
+    StdlibCodec.name: StdlibCodec,
+    OrjsonCodec.name: OrjsonCodec,
+}
+
+
+def use_codec(name='auto'):
+    """Select the codec behind dumps() and loads(): 'orjson', 'stdlib' or 'auto'."""
+    global active
+    if name == 'auto':
+        name = 'stdlib' if orjson is None else 'orjson'
+    if name not in CODECS:
+        raise ValueError(f'Invalid JSON codec: {name}')
+    if name == 'orjson' and orjson is None:
+        raise ValueError('The orjson codec needs the orjson package')
+    active = CODECS[name]()
+    return active
+
+
+active = use_codec(os.environ.get('LOCAL_SERVER_JSON_CODEC', 'auto'))
+
+
+def dumps(obj):
+    # Compact UTF-8 encoded JSON
+    return active.dumps(obj)
+
+
+def loads(data):
+    return active.loads(data)
+
+
+def loads_record(data):
+    """Parse a request body into (obj, raw).
+
+    raw is data itself when it is strict UTF-8 JSON text, which can be
+    stored and sent on as it is; otherwise it is None and the record has to
+    be encoded again. Lenient input, such as UTF-16 or NaN, costs a second
+    parse; strict input is parsed once.
+    """
+    try:
+        return active.loads_strict(data), data
+    except ValueError:
+        return active.loads(data), None
+
+
+# A record stored as bytes is raw, already validated JSON text. Parsing JSON
+# never produces bytes, so the type alone tells the two forms apart.
+
+def encode_record(record):
+    if isinstance(record, bytes):
+        return record
+    return active.dumps(record)
+
+
+def decode_record(record):
+    if isinstance(record, bytes):
+        return active.loads(record)
+    return record
+
+
+class CodecJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that parses requests and encodes responses with the active codec."""
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return active.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return active.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(active.dumps(obj), mimetype=self.mimetype)
@@ -0,0 +1,73 @@
+import unittest
+
+import local_server_codec as codec
+from local_server import app
+
+
+class CodecTests(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(codec.use_codec, codec.active.name)
+
+    def test_app_uses_codec_provider(self):
+        """Test that Flask parses and encodes JSON through the codec layer."""
+        self.assertIsInstance(app.json, codec.CodecJSONProvider)
+        with app.app_context():
+            self.assertEqual(app.json.loads(app.json.dumps({"key": "välue"})), {"key": "välue"})
+
+    def test_codecs_round_trip(self):
+        """Test that every available codec round-trips JSON, including integers beyond 64 bits."""
+        document = {"key": "value", "list": [1, 2.5, None, True], "big": 2 ** 70, "text": "ü"}
+        for name in codec.CODECS:
+            if name == 'orjson' and codec.orjson is None:
+                continue
+            codec.use_codec(name)
+            self.assertEqual(codec.loads(codec.dumps(document)), document)
+            with self.assertRaises(ValueError):
+                codec.loads(b'{"key": "value"')
+
+    def test_loads_record_keeps_only_strict_text(self):
+        """Test that only strict UTF-8 JSON is kept as raw text, and lenient input is still parsed."""
+        for name in codec.CODECS:
+            if name == 'orjson' and codec.orjson is None:
+                continue
+            codec.use_codec(name)
+            self.assertEqual(codec.loads_record(b'{"a":1}'), ({"a": 1}, b'{"a":1}'))
+            self.assertEqual(codec.loads_record(b'{"a":%d}' % 2 ** 70), ({"a": 2 ** 70}, b'{"a":%d}' % 2 ** 70))
+            for body in ('{"a":1}'.encode('utf-16'), '{"a":1}'.encode('utf-32'), b'\xef\xbb\xbf{"a":1}'):
+                self.assertEqual(codec.loads_record(body), ({"a": 1}, None))
+            for body in (b'{"a":NaN}', b'{"a":Infinity}', b'{"a":1e400}'):
+                data, raw = codec.loads_record(body)
+                self.assertIsNone(raw)
+            with self.assertRaises(ValueError):
+                codec.loads_record(b'{"a":')
+
+    def test_invalid_codec(self):
+        """Test that an unknown codec name is rejected."""
+        with self.assertRaises(ValueError):
+            codec.use_codec('yaml')
+
+    def test_lone_surrogates_are_rejected(self):
+        """Test that every codec rejects lone surrogates, escaped or not, in UTF-8 or UTF-16, and keeps valid pairs."""
+        bodies = (b'{"a":"\\ud800"}', b'["x", "\\udfff"]', b'{"a":"\xed\xa0\x80"}',
+                  '{"a":"\\ud800"}'.encode('utf-16'), '{"a":"\ud800"}'.encode('utf-16-le', 'surrogatepass'))
+        for name in codec.CODECS:
+            if name == 'orjson' and codec.orjson is None:
+                continue
+            codec.use_codec(name)
+            for body in bodies:
+                with self.assertRaises(ValueError):
+                    codec.loads(body)
+                with self.assertRaises(ValueError):
+                    codec.loads_record(body)
+            self.assertEqual(codec.loads(b'{"a":"\\ud83d\\ude00"}'), {"a": "\U0001f600"})
+            self.assertEqual(codec.loads_record(b'"\\ud83d\\ude00"'), ("\U0001f600", b'"\\ud83d\\ude00"'))
+
+    def test_raw_records_pass_through(self):
+        """Test that raw records are encoded as they are and decoded on demand."""
+        self.assertEqual(codec.encode_record(b'{"a":1}'), b'{"a":1}')
+        self.assertEqual(codec.decode_record(b'{"a":1}'), {"a": 1})
+        self.assertEqual(codec.decode_record({"a": 1}), {"a": 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
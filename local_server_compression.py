@@ -0,0 +1,125 @@
+import gzip
+import io
+import zlib
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # as is zstandard
+    zstandard = None
+
+# Responses smaller than this go out as they are; compressing them saves too little
+DEFAULT_MIN_BYTES = 1024
+
+# Largest request body accepted once decompressed, so a small upload cannot expand without bound
+DEFAULT_MAX_BODY_BYTES = 64 * 1024 * 1024
+
+# Levels that favour speed over ratio, since compression runs on the request path
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+def _gzip(data):
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _brotli(data):
+    return brotli.compress(data, quality=BROTLI_QUALITY)
+
+
+def _zstd(data):
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def available_encodings():
+    """Content codings this process can produce, most preferred first."""
+    encodings = {}
+    if zstandard is not None:
+        encodings['zstd'] = _zstd
+    if brotli is not None:
+        encodings['br'] = _brotli
+    encodings['gzip'] = _gzip
+    return encodings
+
+
+def parse_encodings(spec):
+    # spec is a comma separated list of codings to offer, or empty/off for none
+    offered = available_encodings()
+    names = [name.strip().lower() for name in spec.split(',') if name.strip()]
+    if names == ['off']:
+        return {}
+    for name in names:
+        if name not in offered:
+            raise ValueError(f'Unavailable content coding: {name}')
+    return {name: compress for name, compress in offered.items() if name in names}
+
+
+def choose_encoding(accept_encodings, encodings):
+    """Pick the coding to send, or None for the body as it is.
+
+    accept_encodings is the request's parsed Accept-Encoding header; among
+    the codings the client accepts at its highest quality, the server's own
+    preference decides.
+    """
+    best, best_quality = None, 0
+    for name in encodings:
+        quality = accept_encodings.quality(name)
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+def _inflate(data, max_bytes):
+    # wbits=47 accepts both gzip and zlib framing
+    decompressor = zlib.decompressobj(wbits=47)
+    try:
+        body = decompressor.decompress(data, max_bytes + 1)
+    except zlib.error as exc:
+        raise ValueError(str(exc)) from None
+    if len(body) > max_bytes:
+        raise BodyTooLarge(max_bytes)
+    if not decompressor.eof:
+        raise ValueError('Truncated compressed body')
+    return body
+
+
+def _unzstd(data, max_bytes):
+    try:
+        with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)) as reader:
+            body = reader.read(max_bytes + 1)
+    except zstandard.ZstdError as exc:
+        raise ValueError(str(exc)) from None
+    if len(body) > max_bytes:
+        raise BodyTooLarge(max_bytes)
+    return body
+
+
+def request_decoders():
+    """Content codings accepted on request bodies.
+
+    Brotli is left out: its decoder cannot stop at a size limit, so one
+    small body could expand into gigabytes before it was rejected.
+    """
+    decoders = {'gzip': _inflate, 'x-gzip': _inflate, 'deflate': _inflate}
+    if zstandard is not None:
+        decoders['zstd'] = _unzstd
+    return decoders
+
+
+def decompress(data, encoding, max_bytes=DEFAULT_MAX_BODY_BYTES):
+    """Decode a request body sent with Content-Encoding encoding.
+
+    Raises KeyError for a coding that is not accepted, BodyTooLarge when
+    the decoded body would exceed max_bytes and ValueError when it is not
+    valid for its coding.
+    """
+    return request_decoders()[encoding](data, max_bytes)
@@ -0,0 +1,51 @@
+import gzip
+import unittest
+import zlib
+
+from werkzeug.http import parse_accept_header
+
+import local_server_compression as compression
+
+
+def accept(value):
+    return parse_accept_header(value)
+
+
+class CompressionTests(unittest.TestCase):
+    def test_choose_encoding(self):
+        """Test that the client's quality values rank codings first and the server's preference breaks ties."""
+        encodings = {'br': None, 'gzip': None}
+        self.assertEqual(compression.choose_encoding(accept('gzip, br'), encodings), 'br')
+        self.assertEqual(compression.choose_encoding(accept('gzip;q=1, br;q=0.5'), encodings), 'gzip')
+        self.assertEqual(compression.choose_encoding(accept('*'), encodings), 'br')
+        self.assertEqual(compression.choose_encoding(accept('br;q=0, gzip'), encodings), 'gzip')
+        self.assertIsNone(compression.choose_encoding(accept('deflate'), encodings))
+        self.assertIsNone(compression.choose_encoding(accept(''), encodings))
+        self.assertIsNone(compression.choose_encoding(accept('gzip'), {}))
+
+    def test_decompress_limits_size(self):
+        """Test that a body is decoded only up to the size limit, and malformed bodies are rejected."""
+        body = b'{"key": "value"}' * 1000
+        self.assertEqual(compression.decompress(gzip.compress(body), 'gzip'), body)
+        self.assertEqual(compression.decompress(zlib.compress(body), 'deflate'), body)
+        with self.assertRaises(compression.BodyTooLarge):
+            compression.decompress(gzip.compress(body), 'gzip', max_bytes=len(body) - 1)
+        for data in (b'not gzip', gzip.compress(body)[:-20]):
+            with self.assertRaises(ValueError):
+                compression.decompress(data, 'gzip')
+        with self.assertRaises(KeyError):
+            compression.decompress(body, 'br')
+
+    def test_parse_encodings(self):
+        """Test that only available codings can be offered, in the server's order, and off offers none."""
+        self.assertEqual(list(compression.parse_encodings('gzip')), ['gzip'])
+        self.assertEqual(compression.parse_encodings('off'), {})
+        self.assertEqual(compression.parse_encodings(''), {})
+        with self.assertRaises(ValueError):
+            compression.parse_encodings('gzip,lzma')
+        body = b'x' * 4096
+        self.assertEqual(gzip.decompress(compression.parse_encodings('gzip')['gzip'](body)), body)
+
+
+if __name__ == '__main__':
+    unittest.main()
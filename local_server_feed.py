@@ -0,0 +1,172 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+import local_server_codec as codec
+
+DEFAULT_FEED_SIZE = 10000
+
+# Event names for the store's journal entry kinds; expiry times ('x') are not published
+CHANGE_OPS = {'s': 'set', 'd': 'delete', 'c': 'clear'}
+
+
+class FeedGap(Exception):
+    """The requested position is no longer, or not yet, covered by the feed.
+
+    Raised when events after it have been dropped from the ring buffer, or
+    when it lies beyond the last event, e.g. after a restart. The client
+    has to reload the records and carry on from last_seq.
+    """
+
+    def __init__(self, last_seq):
+        super().__init__(last_seq)
+        self.last_seq = last_seq
+
+
+class FeedWait:
+    """Yielded by a response body that has to wait for the feed to move past seq.
+
+    A server running on an event loop awaits feed.wait(seq, timeout) and
+    then resumes the body, so the wait holds no thread. Bodies only yield
+    it when the server asked for that; see local_server.ASYNC_FEED_ENVIRON.
+    """
+
+    __slots__ = ('feed', 'seq', 'timeout')
+
+    def __init__(self, feed, seq, timeout):
+        self.feed = feed
+        self.seq = seq
+        self.timeout = timeout
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Change:
+    """One change to the store: a record set, a record deleted, or the store cleared.
+
+    reason tells deletes made by the store itself ('evicted' or 'expired')
+    apart from those a client asked for, where it is None.
+    """
+
+    __slots__ = ('seq', 'op', 'id', 'record', 'reason', '_encoded')
+
+    def __init__(self, seq, op, record_id=None, record=None, reason=None):
+        self.seq = seq
+        self.op = op
+        self.id = record_id
+        self.record = record
+        self.reason = reason
+        self._encoded = None
+
+    def encoded(self):
+        # Encoded on first use by a reader rather than by the writer that published it
+        if self._encoded is None:
+            fields = {"seq": self.seq, "op": self.op}
+            if self.id is not None:
+                fields["id"] = self.id
+            if self.reason is not None:
+                fields["reason"] = self.reason
+            body = codec.dumps(fields)
+            if self.op == 'set':
+                body = body[:-1] + b',"data":' + codec.encode_record(self.record) + b'}'
+            self._encoded = body
+        return self._encoded
+
+    def __reduce__(self):
+        return Change, (self.seq, self.op, self.id, self.record, self.reason)
+
+
+class ChangeFeed:
+    """Bounded, ordered log of recent changes that readers can wait on.
+
+    The store publishes every journal entry here while it still holds the
+    locks that ordered the change, so events for one record arrive in the
+    order the record was changed. Publishing is an append to a fixed-size
+    deque; the oldest events fall off the end, so a reader that falls too
+    far behind gets a FeedGap instead of holding writers back.
+
+    Threads wait in since(); coroutines wait in wait(), which costs a future
+    on their event loop rather than a thread.
+    """
+
+    def __init__(self, size=DEFAULT_FEED_SIZE):
+        self._events = deque(maxlen=size)
+        self.last_seq = 0
+        self._changed = threading.Condition()
+        # Callbacks that wake a coroutine in wait(); each is called once, on the next publish
+        self._waiters = set()
+
+    def publish(self, entries):
+        with self._changed:
+            for entry in entries:
+                kind = entry[0]
+                if kind not in CHANGE_OPS:
+                    continue
+                self.last_seq += 1
+                if kind == 's':
+                    change = Change(self.last_seq, 'set', entry[1], entry[2])
+                elif kind == 'd':
+                    change = Change(self.last_seq, 'delete', entry[1], reason=entry[2] if len(entry) > 2 else None)
+                else:
+                    change = Change(self.last_seq, 'clear')
+                self._events.append(change)
+            self._changed.notify_all()
+            waiters, self._waiters = self._waiters, set()
+            for wake in waiters:
+                wake()
+
+    async def wait(self, seq, timeout):
+        """Return once there is a change after seq, or after timeout seconds.
+
+        Reads nothing; call since() afterwards for the changes themselves.
+        """
+        loop = asyncio.get_running_loop()
+        woken = loop.create_future()
+
+        def wake():
+            # Called by publish() on the writer's thread
+            try:
+                loop.call_soon_threadsafe(_wake, woken)
+            except RuntimeError:
+                pass  # The loop has closed, and the waiter with it
+
+        with self._changed:
+            if seq != self.last_seq:
+                return
+            self._waiters.add(wake)
+        try:
+            await asyncio.wait_for(woken, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._changed:
+                self._waiters.discard(wake)
+
+    def since(self, seq=None, limit=None, timeout=0):
+        """Return the changes after seq, oldest first, waiting up to timeout seconds for one.
+
+        seq None means the current end of the feed, i.e. only new changes.
+        Returns an empty list if nothing changed in time.
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            if seq is None:
+                seq = self.last_seq
+            while seq == self.last_seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._changed.wait(remaining)
+            if seq > self.last_seq:
+                raise FeedGap(self.last_seq)
+            events = self._events
+            first_seq = events[0].seq if events else self.last_seq + 1
+            if seq + 1 < first_seq:
+                raise FeedGap(self.last_seq)
+            start = seq + 1 - first_seq
+            stop = len(events) if limit is None else min(len(events), start + limit)
+            return [events[i] for i in range(start, stop)]
@@ -0,0 +1,83 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from local_server_feed import ChangeFeed, FeedGap
+from local_server_store import RecordStore
+
+
+class ChangeFeedTests(unittest.TestCase):
+    def test_dropped_events_raise_gap(self):
+        """Test that a reader behind the ring buffer is told to reload instead of getting a partial history."""
+        feed = ChangeFeed(size=3)
+        feed.publish([('s', i, {"n": i}) for i in range(5)])
+        self.assertEqual([change.seq for change in feed.since(2)], [3, 4, 5])
+        with self.assertRaises(FeedGap) as raised:
+            feed.since(1)
+        self.assertEqual(raised.exception.last_seq, 5)
+
+    def test_encoded_changes(self):
+        """Test that each kind of change encodes to JSON, with raw records copied in as they are."""
+        feed = ChangeFeed()
+        feed.publish([('s', 0, {"key": "value"}), ('s', 1, b'{"raw":true}'), ('d', 0), ('c',)])
+        self.assertEqual([change.encoded() for change in feed.since(0)], [
+            b'{"seq":1,"op":"set","id":0,"data":{"key":"value"}}',
+            b'{"seq":2,"op":"set","id":1,"data":{"raw":true}}',
+            b'{"seq":3,"op":"delete","id":0}',
+            b'{"seq":4,"op":"clear"}',
+        ])
+
+    def test_since_waits_for_publish(self):
+        """Test that a waiting reader wakes up on the next change and times out without one."""
+        feed = ChangeFeed()
+        self.assertEqual(feed.since(None, timeout=0.01), [])
+
+        timer = threading.Timer(0.05, feed.publish, args=([('s', 0, {"n": 0})],))
+        timer.start()
+        self.addCleanup(timer.join)
+        started = time.monotonic()
+        changes = feed.since(0, timeout=10)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual([(change.op, change.id) for change in changes], [('set', 0)])
+
+    def test_wait_wakes_coroutines(self):
+        """Test that wait() returns on the next publish from another thread, at once if past seq, and times out."""
+        feed = ChangeFeed()
+
+        async def wait():
+            started = time.monotonic()
+            await feed.wait(0, 0.01)
+            waiters = [asyncio.ensure_future(feed.wait(0, 10)) for _ in range(3)]
+            await asyncio.sleep(0.01)
+            timer = threading.Timer(0.05, feed.publish, args=([('s', 0, {"n": 0})],))
+            timer.start()
+            self.addCleanup(timer.join)
+            await asyncio.wait_for(asyncio.gather(*waiters), 5)
+            await asyncio.wait_for(feed.wait(0, 10), 1)
+            return time.monotonic() - started
+
+        self.assertLess(asyncio.run(wait()), 5)
+        self.assertEqual(feed._waiters, set())
+
+    def test_store_publishes_every_change(self):
+        """Test that single-record operations and transactions all reach the feed in order."""
+        store = RecordStore()
+        store.add({"n": 0})
+        store.update(0, lambda record: dict(record, n=1))
+        with store.transaction() as txn:
+            txn.add({"n": 2})
+            txn.pop(0)
+        store.clear()
+        self.assertEqual([(change.seq, change.op, change.id) for change in store.changes(0)], [
+            (1, 'set', 0),
+            (2, 'set', 0),
+            (3, 'set', 1),
+            (4, 'delete', 0),
+            (5, 'clear', None),
+        ])
+        self.assertEqual(store.last_seq, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import json
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple
+
+from local_server_codec import decode_record
+
+FILTER_OPERATORS = ('eq', 'in', 'gt', 'gte', 'lt', 'lte')
+RANGE_OPERATORS = ('gt', 'gte', 'lt', 'lte')
+
+# One condition on a top-level field; value is a list for 'in'
+Filter = namedtuple('Filter', 'field op value')
+
+_ABSENT = object()
+_RANK_NUMBER = 0
+_RANK_STRING = 1
+_AFTER_ALL_IDS = float('inf')
+
+
+def value_key(value):
+    # Hashable form of a JSON value with JSON equality: 1 and true differ,
+    # 1 and 1.0 do not, and objects compare by content
+    if isinstance(value, bool):
+        return ('b', value)
+    if isinstance(value, (int, float)):
+        return ('n', value)
+    if isinstance(value, str):
+        return ('s', value)
+    if value is None:
+        return ('z', None)
+    return ('j', json.dumps(value, sort_keys=True, separators=(',', ':')))
+
+
+def sort_key(value):
+    # (rank, value) for values that have a natural order, otherwise None
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return _RANK_NUMBER, value
+    if isinstance(value, str):
+        return _RANK_STRING, value
+    return None
+
+
+def field_value(record, field):
+    record = decode_record(record)
+    if not isinstance(record, dict):
+        return _ABSENT
+    return record.get(field, _ABSENT)
+
+
+def matches(record, filters):
+    record = decode_record(record)
+    for field, op, expected in filters:
+        value = field_value(record, field)
+        if value is _ABSENT:
+            return False
+        if op == 'eq':
+            if value_key(value) != value_key(expected):
+                return False
+        elif op == 'in':
+            if value_key(value) not in {value_key(item) for item in expected}:
+                return False
+        else:
+            actual, bound = sort_key(value), sort_key(expected)
+            if actual is None or bound is None or actual[0] != bound[0]:
+                return False
+            if op == 'gt' and not actual > bound:
+                return False
+            if op == 'gte' and not actual >= bound:
+                return False
+            if op == 'lt' and not actual < bound:
+                return False
+            if op == 'lte' and not actual <= bound:
+                return False
+    return True
+
+
+class HashIndex:
+    """Record IDs grouped by the exact value of one field; answers eq and in."""
+
+    kind = 'hash'
+
+    def __init__(self, field):
+        self.field = field
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def add(self, record_id, record):
+        value = field_value(record, self.field)
+        if value is _ABSENT:
+            return
+        with self._lock:
+            self._buckets.setdefault(value_key(value), set()).add(record_id)
+
+    def remove(self, record_id, record):
+        value = field_value(record, self.field)
+        if value is _ABSENT:
+            return
+        key = value_key(value)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(record_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def estimate(self, op, value):
+        # Number of candidates lookup() would return, or None if this index cannot help
+        if op == 'eq':
+            return len(self._buckets.get(value_key(value), ()))
+        if op == 'in':
+            return sum(len(self._buckets.get(value_key(item), ())) for item in value)
+        return None
+
+    def lookup(self, op, value):
+        values = value if op == 'in' else [value]
+        with self._lock:
+            ids = []
+            for item in values:
+                ids.extend(self._buckets.get(value_key(item), ()))
+        return ids
+
+
+class SortedIndex:
+    """(value, ID) pairs of one field kept in order; answers ranges as well as eq and in.
+
+    Only numbers and strings are indexed, since other JSON values have no
+    order. A condition on any other value falls back to a scan.
+    """
+
+    kind = 'sorted'
+
+    def __init__(self, field):
+        self.field = field
+        self._entries = []
+        self._lock = threading.Lock()
+
+    def add(self, record_id, record):
+        key = sort_key(field_value(record, self.field))
+        if key is None:
+            return
+        with self._lock:
+            insort(self._entries, key + (record_id,))
+
+    def remove(self, record_id, record):
+        key = sort_key(field_value(record, self.field))
+        if key is None:
+            return
+        entry = key + (record_id,)
+        with self._lock:
+            pos = bisect_left(self._entries, entry)
+            if pos < len(self._entries) and self._entries[pos] == entry:
+                del self._entries[pos]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _bounds(self, op, value):
+        key = sort_key(value)
+        if key is None:
+            return None
+        rank = key[0]
+        entries = self._entries
+        lo = bisect_left(entries, (rank,))
+        hi = bisect_left(entries, (rank + 1,))
+        if op in ('eq', 'gte'):
+            lo = bisect_left(entries, key)
+        elif op == 'gt':
+            lo = bisect_right(entries, key + (_AFTER_ALL_IDS,))
+        if op in ('eq', 'lte'):
+            hi = bisect_right(entries, key + (_AFTER_ALL_IDS,))
+        elif op == 'lt':
+            hi = bisect_left(entries, key)
+        return lo, max(lo, hi)
+
+    def _ranges(self, op, value):
+        values = value if op == 'in' else [value]
+        op = 'eq' if op == 'in' else op
+        ranges = []
+        for item in values:
+            bounds = self._bounds(op, item)
+            if bounds is None:
+                return None
+            ranges.append(bounds)
+        return ranges
+
+    def estimate(self, op, value):
+        with self._lock:
+            ranges = self._ranges(op, value)
+        if ranges is None:
+            return None
+        return sum(hi - lo for lo, hi in ranges)
+
+    def lookup(self, op, value):
+        with self._lock:
+            ranges = self._ranges(op, value)
+            return [entry[-1] for lo, hi in ranges for entry in self._entries[lo:hi]]
+
+
+INDEX_KINDS = {
+    HashIndex.kind: HashIndex,
+    SortedIndex.kind: SortedIndex,
+}
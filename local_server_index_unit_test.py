@@ -0,0 +1,63 @@
+import unittest
+
+from local_server_index import Filter, HashIndex, SortedIndex, matches
+from local_server_store import RecordStore
+
+
+class IndexTests(unittest.TestCase):
+    def test_hash_index_lookup_and_remove(self):
+        """Test that a hash index finds records by value and forgets removed ones."""
+        index = HashIndex('kind')
+        index.add(0, {"kind": "a"})
+        index.add(1, {"kind": "b"})
+        index.add(2, {"kind": "a"})
+        index.add(3, {"other": "a"})
+        index.remove(0, {"kind": "a"})
+        self.assertEqual(sorted(index.lookup('eq', 'a')), [2])
+        self.assertEqual(sorted(index.lookup('in', ['a', 'b'])), [1, 2])
+        self.assertIsNone(index.estimate('gt', 'a'))
+
+    def test_matches_uses_json_equality(self):
+        """Test that filters treat true and 1 as different values but 1 and 1.0 as equal."""
+        self.assertTrue(matches({"n": 1}, [Filter('n', 'eq', 1.0)]))
+        self.assertFalse(matches({"n": True}, [Filter('n', 'eq', 1)]))
+        self.assertFalse(matches({"n": "2"}, [Filter('n', 'gt', 1)]))
+        self.assertFalse(matches(["not", "an", "object"], [Filter('n', 'eq', 1)]))
+
+    def test_sorted_index_ranges(self):
+        """Test that a sorted index answers every range operator and keeps numbers apart from strings."""
+        index = SortedIndex('age')
+        for record_id, age in enumerate([5, 1, 3, 3, "3", 9, None]):
+            index.add(record_id, {"age": age})
+        self.assertEqual(sorted(index.lookup('eq', 3)), [2, 3])
+        self.assertEqual(sorted(index.lookup('gt', 3)), [0, 5])
+        self.assertEqual(sorted(index.lookup('gte', 3)), [0, 2, 3, 5])
+        self.assertEqual(sorted(index.lookup('lt', 3)), [1])
+        self.assertEqual(sorted(index.lookup('lte', 3)), [1, 2, 3])
+        self.assertEqual(sorted(index.lookup('gte', "0")), [4])
+        self.assertIsNone(index.estimate('eq', None))
+
+    def test_store_query_follows_changes(self):
+        """Test that store indexes stay in step with inserts, updates, deletes and rollbacks."""
+        store = RecordStore()
+        store.add({"kind": "a", "age": 1})
+        store.create_index('kind')
+        store.create_index('age', 'sorted')
+        store.add({"kind": "a", "age": 2})
+        store.add({"kind": "b", "age": 3})
+        store.replace(0, {"kind": "b", "age": 4})
+        store.update(1, lambda record: dict(record, age=5))
+        with store.transaction() as txn:
+            txn.pop(2)
+            txn.rollback()
+
+        self.assertEqual([record_id for record_id, _ in store.query([Filter('kind', 'eq', 'b')])], [0, 2])
+        self.assertEqual([record_id for record_id, _ in store.query([Filter('age', 'gte', 4)])], [0, 1])
+        store.pop(0)
+        self.assertEqual([record_id for record_id, _ in store.query([Filter('age', 'gte', 4)], cursor=1)], [1])
+        with self.assertRaises(ValueError):
+            store.create_index('age', 'fulltext')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+from local_server_metrics import Histogram, Metrics
+from local_server_store import RecordStore
+
+
+class MetricsTests(unittest.TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        """Test that rendered buckets count every value at or below their bound."""
+        histogram = Histogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        self.assertEqual(histogram.render('size', 'route="r"'), [
+            'size_bucket{route="r",le="1"} 2',
+            'size_bucket{route="r",le="10"} 3',
+            'size_bucket{route="r",le="+Inf"} 4',
+            'size_sum{route="r"} 56.5',
+            'size_count{route="r"} 4',
+        ])
+
+    def test_render_counts_and_gauges(self):
+        """Test that counters, rejections and gauges all appear in the exposition."""
+        metrics = Metrics()
+        metrics.started()
+        metrics.observe('get_data', 200, 0.001, 0, 100)
+        metrics.observe('get_data', 200, 0.002, 0, None)
+        metrics.observe('get_data', 304, 0.001, 0, 0)
+        metrics.reject('post_data', 'Authorization')
+
+        lines = metrics.render([('store_records', 'Records.', 7)]).splitlines()
+        self.assertIn('local_server_requests_total{route="get_data",status="200"} 2', lines)
+        self.assertIn('local_server_requests_total{route="get_data",status="304"} 1', lines)
+        self.assertIn('local_server_request_duration_seconds_count{route="get_data"} 3', lines)
+        self.assertIn('local_server_response_size_bytes_count{route="get_data"} 2', lines)
+        self.assertIn('local_server_header_rejections_total{route="post_data",header="Authorization"} 1', lines)
+        self.assertIn('local_server_in_flight_requests 1', lines)
+        self.assertIn('store_records 7', lines)
+
+    def test_store_approximate_bytes(self):
+        """Test that the store size estimate grows with the records held."""
+        store = RecordStore()
+        empty = store.approximate_bytes()
+        for i in range(1000):
+            store.add({"key": "x" * 100, "n": i})
+        self.assertGreater(store.approximate_bytes(), empty + 1000 * 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+MERGE_PATCH_MIMETYPE = 'application/merge-patch+json'
+JSON_PATCH_MIMETYPE = 'application/json-patch+json'
+
+JSON_PATCH_OPS = ('add', 'remove', 'replace', 'move', 'copy', 'test')
+
+
+class PatchError(ValueError):
+    """The patch document itself is malformed."""
+
+
+class PatchConflict(PatchError):
+    """The patch is well formed but cannot be applied to the record, e.g. a test failed."""
+
+
+def merge_patch(target, patch):
+    """Apply an RFC 7396 merge patch to target and return the result.
+
+    Only the objects on the paths the patch touches are copied; everything
+    else is shared with target, which is left as it was.
+    """
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+def parse_pointer(pointer):
+    # RFC 6901: "" is the whole document, otherwise /-separated tokens with ~1 for / and ~0 for ~
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith('/')):
+        raise PatchError(f'Invalid JSON pointer: {pointer!r}')
+    if not pointer:
+        return ()
+    return tuple(token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/'))
+
+
+def parse_json_patch(operations):
+    """Check an RFC 6902 patch document and return its operations as (op, path, from, value) tuples.
+
+    Everything that can be checked without the record is checked here, so a
+    malformed patch is rejected before the store is touched.
+    """
+    if not isinstance(operations, list):
+        raise PatchError('A JSON patch must be an array of operations')
+    parsed = []
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get('op') not in JSON_PATCH_OPS:
+            raise PatchError(f'Invalid operation: {operation!r}')
+        op = operation['op']
+        path = parse_pointer(operation.get('path'))
+        source = parse_pointer(operation.get('from')) if op in ('move', 'copy') else None
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise PatchError(f'Missing value: {operation!r}')
+        if op == 'move' and path[:len(source)] == source and path != source:
+            raise PatchError('Cannot move a value into itself')
+        parsed.append((op, path, source, operation.get('value')))
+    return parsed
+
+
+def apply_json_patch(document, operations):
+    """Apply operations from parse_json_patch() to document and return the result.
+
+    Either every operation applies or PatchConflict is raised, and document
+    is left as it was in both cases. The first change to a container copies
+    it; the copy is new to this patch, so later operations change it in
+    place rather than copying it again.
+    """
+    return _JsonPatch(document).apply(operations)
+
+
+def _clone(value):
+    if isinstance(value, dict):
+        return {key: _clone(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_clone(item) for item in value]
+    return value
+
+
+def _json_equal(a, b):
+    # Like Python, RFC 6902 counts 1 and 1.0 as equal, but unlike Python not true and 1
+    if isinstance(a, bool) or isinstance(b, bool):
+        return isinstance(a, bool) and isinstance(b, bool) and a == b
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(_json_equal(a[key], b[key]) for key in a)
+    if isinstance(a, list):
+        return isinstance(b, list) and len(a) == len(b) and all(map(_json_equal, a, b))
+    if isinstance(b, (dict, list)):
+        return False
+    return a == b
+
+
+def _list_index(container, token, allow_end=False):
+    # Array indices are decimal without leading zeros; "-" and len() address the end when adding
+    size = len(container)
+    if allow_end and token == '-':
+        return size
+    if not token.isdigit() or (token != '0' and token.startswith('0')):
+        raise PatchConflict(f'Invalid array index: {token}')
+    index = int(token)
+    if index > size or (index == size and not allow_end):
+        raise PatchConflict(f'Array index out of range: {token}')
+    return index
+
+
+class _JsonPatch:
+    __slots__ = ('document', '_owned')
+
+    def __init__(self, document):
+        self.document = document
+        # Containers created by this patch, by id; held so the ids stay unique
+        self._owned = {}
+
+    def apply(self, operations):
+        for op, path, source, value in operations:
+            if op == 'add':
+                self._add(path, value)
+            elif op == 'remove':
+                self._remove(path)
+            elif op == 'replace':
+                if path:
+                    self._remove(path)
+                self._add(path, value)
+            elif op == 'move':
+                if source != path:
+                    self._add(path, self._remove(source))
+                else:
+                    # A move onto itself changes nothing, but from must still exist
+                    self._get(source)
+            elif op == 'copy':
+                # A deep copy, so later operations on either copy cannot reach the other
+                self._add(path, _clone(self._get(source)))
+            elif not _json_equal(self._get(path), value):
+                raise PatchConflict(f'Test failed at /{"/".join(path)}')
+        return self.document
+
+    def _own(self, container):
+        if id(container) in self._owned:
+            return container
+        copy = dict(container) if isinstance(container, dict) else list(container)
+        self._owned[id(copy)] = copy
+        return copy
+
+    def _get(self, path):
+        value = self.document
+        for token in path:
+            value = self._child(value, token)
+        return value
+
+    @staticmethod
+    def _child(container, token):
+        if isinstance(container, dict):
+            if token not in container:
+                raise PatchConflict(f'No such member: {token}')
+            return container[token]
+        if isinstance(container, list):
+            return container[_list_index(container, token)]
+        raise PatchConflict(f'Cannot descend into a scalar at {token}')
+
+    def _parent(self, path):
+        # The container holding path's last token, copied along the way where needed
+        if not isinstance(self.document, (dict, list)):
+            raise PatchConflict('The document has no members')
+        self.document = parent = self._own(self.document)
+        for token in path[:-1]:
+            child = self._child(parent, token)
+            if not isinstance(child, (dict, list)):
+                raise PatchConflict(f'Cannot descend into a scalar at {token}')
+            child = self._own(child)
+            if isinstance(parent, dict):
+                parent[token] = child
+            else:
+                parent[_list_index(parent, token)] = child
+            parent = child
+        return parent
+
+    def _add(self, path, value):
+        if not path:
+            self.document = value
+            return
+        parent = self._parent(path)
+        if isinstance(parent, dict):
+            parent[path[-1]] = value
+        else:
+            parent.insert(_list_index(parent, path[-1], allow_end=True), value)
+
+    def _remove(self, path):
+        if not path:
+            raise PatchConflict('Cannot remove the whole document')
+        parent = self._parent(path)
+        if isinstance(parent, dict):
+            if path[-1] not in parent:
+                raise PatchConflict(f'No such member: {path[-1]}')
+            return parent.pop(path[-1])
+        return parent.pop(_list_index(parent, path[-1]))
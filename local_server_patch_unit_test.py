@@ -0,0 +1,98 @@
+import unittest
+
+from local_server_patch import PatchConflict, PatchError, apply_json_patch, merge_patch, parse_json_patch
+
+
+def json_patch(document, operations):
+    return apply_json_patch(document, parse_json_patch(operations))
+
+
+class MergePatchTests(unittest.TestCase):
+    def test_rfc_7396_examples(self):
+        """Test the examples from RFC 7396, appendix A."""
+        for target, patch, result in (
+                ({"a": "b"}, {"a": "c"}, {"a": "c"}),
+                ({"a": "b"}, {"b": "c"}, {"a": "b", "b": "c"}),
+                ({"a": "b"}, {"a": None}, {}),
+                ({"a": "b", "b": "c"}, {"a": None}, {"b": "c"}),
+                ({"a": ["b"]}, {"a": "c"}, {"a": "c"}),
+                ({"a": "c"}, {"a": ["b"]}, {"a": ["b"]}),
+                ({"a": {"b": "c"}}, {"a": {"b": "d", "c": None}}, {"a": {"b": "d"}}),
+                ({"a": [{"b": "c"}]}, {"a": [1]}, {"a": [1]}),
+                (["a", "b"], ["c", "d"], ["c", "d"]),
+                ({"a": "b"}, ["c"], ["c"]),
+                ({"a": "foo"}, None, None),
+                ({"a": "foo"}, "bar", "bar"),
+                ({"e": None}, {"a": 1}, {"e": None, "a": 1}),
+                ([1, 2], {"a": "b", "c": None}, {"a": "b"}),
+                ({}, {"a": {"bb": {"ccc": None}}}, {"a": {"bb": {}}}),
+        ):
+            self.assertEqual(merge_patch(target, patch), result)
+
+    def test_untouched_parts_are_shared(self):
+        """Test that only the objects on patched paths are copied and the target is left as it was."""
+        target = {"a": {"b": 1}, "big": {"list": list(range(100))}}
+        result = merge_patch(target, {"a": {"b": 2}})
+        self.assertEqual(target, {"a": {"b": 1}, "big": {"list": list(range(100))}})
+        self.assertEqual(result["a"], {"b": 2})
+        self.assertIs(result["big"], target["big"])
+
+
+class JsonPatchTests(unittest.TestCase):
+    def test_operations(self):
+        """Test each RFC 6902 operation, including array positions and escaped pointer tokens."""
+        document = {"a": {"b": [1, 2]}, "x": 1, "c/d": True, "e~f": 0}
+        result = json_patch(document, [
+            {"op": "add", "path": "/a/b/-", "value": 3},
+            {"op": "add", "path": "/a/b/0", "value": 0},
+            {"op": "replace", "path": "/x", "value": {"nested": []}},
+            {"op": "add", "path": "/x/nested/0", "value": "v"},
+            {"op": "remove", "path": "/c~1d"},
+            {"op": "move", "from": "/e~0f", "path": "/moved"},
+            {"op": "copy", "from": "/a/b", "path": "/copy"},
+            {"op": "remove", "path": "/copy/0"},
+            {"op": "test", "path": "/a/b", "value": [0, 1, 2, 3]},
+            {"op": "test", "path": "/moved", "value": 0.0},
+        ])
+        self.assertEqual(result, {"a": {"b": [0, 1, 2, 3]}, "x": {"nested": ["v"]}, "moved": 0, "copy": [1, 2, 3]})
+        self.assertEqual(document, {"a": {"b": [1, 2]}, "x": 1, "c/d": True, "e~f": 0})
+        self.assertEqual(json_patch([1], [{"op": "replace", "path": "", "value": {"k": 1}}]), {"k": 1})
+
+    def test_failed_patch_changes_nothing(self):
+        """Test that a patch that cannot be applied raises PatchConflict and leaves the document alone."""
+        document = {"a": [1, 2], "flag": True, "n": 1}
+        for operation in (
+                {"op": "test", "path": "/a/0", "value": 2},
+                {"op": "test", "path": "/flag", "value": 1},
+                {"op": "test", "path": "/n", "value": True},
+                {"op": "remove", "path": "/missing"},
+                {"op": "replace", "path": "/a/3", "value": 0},
+                {"op": "add", "path": "/a/5", "value": 0},
+                {"op": "add", "path": "/a/01", "value": 0},
+                {"op": "add", "path": "/n/child", "value": 0},
+                {"op": "move", "from": "/missing", "path": "/b"},
+                {"op": "move", "from": "/missing", "path": "/missing"},
+                {"op": "move", "from": "/a/5", "path": "/a/5"},
+        ):
+            with self.assertRaises(PatchConflict):
+                json_patch(document, [{"op": "add", "path": "/a/-", "value": 3}, operation])
+        self.assertEqual(document, {"a": [1, 2], "flag": True, "n": 1})
+        # Moving a value that exists onto itself is allowed, and changes nothing
+        self.assertEqual(json_patch(document, [{"op": "move", "from": "/n", "path": "/n"}]), document)
+
+    def test_malformed_patches_are_rejected(self):
+        """Test that malformed patch documents are rejected before being applied."""
+        for operations in (
+                {"op": "add", "path": "/a", "value": 1},
+                [{"op": "append", "path": "/a"}],
+                [{"op": "add", "path": "a", "value": 1}],
+                [{"op": "add", "path": "/a"}],
+                [{"op": "copy", "path": "/a"}],
+                [{"op": "move", "from": "/a", "path": "/a/b"}],
+        ):
+            with self.assertRaises(PatchError):
+                parse_json_patch(operations)
+
+
+if __name__ == '__main__':
+    unittest.main()
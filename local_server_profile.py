@@ -0,0 +1,215 @@
+import cProfile
+import hmac
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+
+MODE_CPROFILE = 'cprofile'
+MODE_STACK = 'stack'
+PROFILE_MODES = (MODE_CPROFILE, MODE_STACK)
+
+# Header that asks for one request to be profiled; its value must be the configured key
+PROFILE_HEADER = 'X-Profile'
+
+DEFAULT_PROFILE_DIR = 'profiles'
+
+# How often the stack sampler looks at the requests it is profiling, in seconds
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# Phases spent waiting on purpose, e.g. a /changes long poll, which do not make a request slow
+IDLE_PHASES = ('wait',)
+
+# Where slow requests are reported; with no logging configured they go to stderr
+slow_log = logging.getLogger('local_server.slow')
+
+
+class PhaseTimer:
+    """Times the phases of one request for the slow-request log.
+
+    mark(name) ends the phase called name at the current time; the phase
+    began at the previous mark, or when the timer was created. Whatever
+    follows the last mark is reported as respond.
+    """
+
+    __slots__ = ('started', 'marks')
+
+    def __init__(self, clock=time.perf_counter):
+        self.started = clock()
+        self.marks = []
+
+    def mark(self, name, clock=time.perf_counter):
+        self.marks.append((name, clock()))
+
+    def breakdown(self, now):
+        # {phase: seconds} in the order the phases first ended; a phase marked twice is summed
+        phases = {}
+        previous = self.started
+        for name, at in self.marks:
+            phases[name] = phases.get(name, 0) + at - previous
+            previous = at
+        phases['respond'] = phases.get('respond', 0) + now - previous
+        return phases
+
+
+def busy_seconds(phases):
+    return sum(seconds for name, seconds in phases.items() if name not in IDLE_PHASES)
+
+
+def format_slow_request(method, path, route, status, phases):
+    timings = ' '.join(f'{name}={seconds * 1000:.1f}ms' for name, seconds in phases.items())
+    return (f'slow request: {method} {path} route={route} status={status} '
+            f'total={sum(phases.values()) * 1000:.1f}ms {timings}')
+
+
+def collapse_stack(frame):
+    # One line of the collapsed format flamegraph.pl and speedscope read: outermost frame first
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class _StackSampler:
+    # A daemon thread that, while any thread is registered, records the stack
+    # of each registered thread every interval seconds. It sleeps on the
+    # condition while nothing is registered, so when idle it costs nothing.
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._stacks = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def register(self):
+        ident = threading.get_ident()
+        with self._cond:
+            if ident in self._stacks:
+                return False
+            self._stacks[ident] = {}
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return True
+
+    def unregister(self):
+        # The stacks counted for the calling thread, as {collapsed stack: samples}
+        with self._cond:
+            return self._stacks.pop(threading.get_ident())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stacks:
+                    self._cond.wait()
+                # Sampled under the lock, so unregister() never returns counts that are still changing
+                frames = sys._current_frames()
+                for ident, counts in self._stacks.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stack = collapse_stack(frame)
+                        counts[stack] = counts.get(stack, 0) + 1
+                del frames
+            time.sleep(self.interval)
+
+
+class RequestProfiler:
+    """Profiles a sample of requests and keeps the results per route in directory.
+
+    A random rate fraction of requests is profiled, as is any request whose
+    PROFILE_HEADER carries key; with no key the header is ignored.
+
+    In cprofile mode every function call of a profiled request is counted
+    and the route's totals are rewritten to <route>.pstats, for pstats or
+    snakeviz. cProfile can only follow one request at a time, so a request
+    picked while another is being profiled runs without it.
+
+    In stack mode a background thread samples the stacks of the requests
+    being profiled every interval seconds, and each route's counts are
+    rewritten to <route>.folded for flamegraph.pl or speedscope. This costs
+    the request almost nothing however many calls it makes, and any number
+    of requests can be profiled at once.
+    """
+
+    def __init__(self, directory=DEFAULT_PROFILE_DIR, rate=0.0, key=None, mode=MODE_CPROFILE,
+                 interval=DEFAULT_SAMPLE_INTERVAL, random=random.random):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'Unknown profile mode: {mode}')
+        if not 0 <= rate <= 1:
+            raise ValueError(f'Invalid profile rate: {rate}')
+        self.directory = directory
+        self.rate = rate
+        self.key = key.encode() if key else None
+        self.mode = mode
+        self._random = random
+        self._profiling = threading.Lock()
+        self._sampler = _StackSampler(interval) if mode == MODE_STACK else None
+        self._results = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def wanted(self, header):
+        """Whether to profile a request, given the value of its PROFILE_HEADER (or None)."""
+        if header and self.key is not None and hmac.compare_digest(header.encode(), self.key):
+            return True
+        return self.rate > 0 and self._random() < self.rate
+
+    def start(self, route):
+        # Returns a handle for stop(), or None when the request cannot be profiled
+        if self._sampler is not None:
+            return (route, None) if self._sampler.register() else None
+        if not self._profiling.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler, such as a debugger's, already owns the interpreter
+            self._profiling.release()
+            return None
+        return route, profile
+
+    def stop(self, handle):
+        route, profile = handle
+        if profile is None:
+            self._save_stacks(route, self._sampler.unregister())
+        else:
+            profile.disable()
+            self._profiling.release()
+            self._save_stats(route, profile)
+
+    def path(self, route):
+        suffix = '.folded' if self.mode == MODE_STACK else '.pstats'
+        return os.path.join(self.directory, route + suffix)
+
+    def _save_stats(self, route, profile):
+        with self._lock:
+            stats = self._results.get(route)
+            if stats is None:
+                stats = self._results[route] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self._replace(route, stats.dump_stats)
+
+    def _save_stacks(self, route, counts):
+        with self._lock:
+            totals = self._results.setdefault(route, {})
+            for stack, samples in counts.items():
+                totals[stack] = totals.get(stack, 0) + samples
+
+            def write(path):
+                with open(path, 'w') as f:
+                    f.writelines(f'{stack} {samples}\n' for stack, samples in sorted(totals.items()))
+            self._replace(route, write)
+
+    def _replace(self, route, write):
+        # Written aside and renamed into place, so a reader never sees half a file
+        path = self.path(route)
+        write(path + '.tmp')
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,88 @@
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from local_server_profile import (MODE_STACK, PhaseTimer, RequestProfiler, busy_seconds, collapse_stack,
+                                  format_slow_request)
+
+
+def busy_work(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+class PhaseTimerTests(unittest.TestCase):
+    def test_breakdown(self):
+        """Test that each phase runs from the previous mark, repeats are summed and the rest is respond."""
+        timer = PhaseTimer(clock=lambda: 1.0)
+        timer.mark('headers', clock=lambda: 1.5)
+        timer.mark('store', clock=lambda: 2.0)
+        timer.mark('wait', clock=lambda: 7.0)
+        timer.mark('store', clock=lambda: 7.25)
+        phases = timer.breakdown(8.0)
+        self.assertEqual(list(phases), ['headers', 'store', 'wait', 'respond'])
+        self.assertEqual(phases, {'headers': 0.5, 'store': 0.75, 'wait': 5.0, 'respond': 0.75})
+        self.assertEqual(busy_seconds(phases), 2.0)
+        self.assertEqual(format_slow_request('GET', '/changes', 'get_changes', 200, phases),
+                         'slow request: GET /changes route=get_changes status=200 total=7000.0ms '
+                         'headers=500.0ms store=750.0ms wait=5000.0ms respond=750.0ms')
+
+
+class RequestProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_wanted(self):
+        """Test that requests are sampled at the rate, and the key picks a request whatever the rate."""
+        profiler = RequestProfiler(self.directory, rate=0.25, key='secret', random=iter([0.1, 0.3]).__next__)
+        self.assertTrue(profiler.wanted(None))
+        self.assertFalse(profiler.wanted('wrong'))
+        self.assertTrue(profiler.wanted('secret'))
+        keyless = RequestProfiler(self.directory)
+        self.assertFalse(keyless.wanted('secret'))
+        self.assertFalse(keyless.wanted(''))
+        with self.assertRaises(ValueError):
+            RequestProfiler(self.directory, mode='perf')
+        with self.assertRaises(ValueError):
+            RequestProfiler(self.directory, rate=1.5)
+
+    def test_cprofile_stats_per_route(self):
+        """Test that cProfile results accumulate per route, one request profiled at a time."""
+        profiler = RequestProfiler(self.directory, rate=1)
+        for _ in range(2):
+            handle = profiler.start('get_data')
+            self.assertIsNone(profiler.start('post_data'))
+            busy_work(0.001)
+            profiler.stop(handle)
+        stats = pstats.Stats(profiler.path('get_data'))
+        calls = [entry[1] for (_, _, name), entry in stats.stats.items() if name == 'busy_work']
+        self.assertEqual(calls, [2])
+        self.assertEqual(os.listdir(self.directory), ['get_data.pstats'])
+
+    def test_stack_samples_per_route(self):
+        """Test that the stack sampler writes collapsed stacks, outermost frame first, per route."""
+        profiler = RequestProfiler(self.directory, rate=1, mode=MODE_STACK, interval=0.001)
+        handle = profiler.start('get_data')
+        self.assertIsNone(profiler.start('get_data'))
+        busy_work(0.05)
+        profiler.stop(handle)
+        with open(profiler.path('get_data')) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(any(';busy_work (' in line for line in lines))
+        for line in lines:
+            stack, _, samples = line.rpartition(' ')
+            self.assertGreater(int(samples), 0)
+        here = self.test_stack_samples_per_route.__code__.co_firstlineno
+        self.assertTrue(collapse_stack(sys._getframe()).endswith(
+            f';test_stack_samples_per_route (local_server_profile_unit_test.py:{here})'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,445 @@
+import argparse
+import mmap
+import os
+import signal
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from local_server_store import MISSING, RevisionMismatch
+
+# Records fetched per round trip while a RemoteStore walks a query
+QUERY_PAGE_SIZE = 1000
+
+# Records a worker keeps from single-record reads of the current version
+READ_CACHE_ENTRIES = 10000
+
+SOCKET_ENV = 'LOCAL_SERVER_STORE_SOCKET'
+
+# Store version and next expiry time, as published by the owner
+_PUBLISHED = struct.Struct('<Qd')
+
+# Bytes of the random key workers must prove they hold before any request is read
+AUTHKEY_BYTES = 32
+
+
+def version_path(address):
+    # The owner publishes the store version and next expiry here for workers
+    # to read without a round trip
+    return address + '.version'
+
+
+def key_path(address):
+    # The owner writes the connection key here, readable only by its own user
+    return address + '.key'
+
+
+def write_key(address):
+    # Created with its final mode, so there is no moment at which another user could read it
+    path = key_path(address)
+    if os.path.exists(path):
+        os.unlink(path)
+    authkey = os.urandom(AUTHKEY_BYTES)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+    return authkey
+
+
+def read_key(address):
+    with open(key_path(address), 'rb') as f:
+        return f.read()
+
+
+class StoreServer:
+    """Serves one RecordStore to worker processes over a Unix socket.
+
+    The owner process holds the only copy of the records. Each worker
+    connection gets its own thread, and every request is a call on the
+    store, so concurrency between workers is exactly that of a threaded
+    single-process server. After each request the store version, and the
+    time the next record expires, are written to a small memory-mapped
+    file; workers compare the version with that of what they have cached
+    and skip the round trip while it is unchanged and nothing is due.
+
+    Requests are pickled, so a connection is only served once the client
+    has proved, through multiprocessing's authkey handshake, that it holds
+    the random key the owner writes to key_path(address) for its own user.
+    """
+
+    def __init__(self, store, address):
+        self.store = store
+        self.address = address
+        self._closed = False
+        with open(version_path(address), 'wb') as f:
+            f.write(bytes(_PUBLISHED.size))
+        self._version_file = open(version_path(address), 'r+b')
+        self._version_map = mmap.mmap(self._version_file.fileno(), _PUBLISHED.size)
+        self._publish_lock = threading.Lock()
+        self._publish()
+        self._listener = Listener(address, family='AF_UNIX', authkey=write_key(address))
+
+    def serve_forever(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                continue  # a client that failed the handshake, or the listener was closed
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self._closed = True
+        self._listener.close()
+        self._version_map.close()
+        self._version_file.close()
+        for path in (self.address, version_path(self.address), key_path(self.address)):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _publish(self):
+        # Read under the lock so a slower thread can never write an older version back
+        with self._publish_lock:
+            _PUBLISHED.pack_into(self._version_map, 0, self.store.version, self.store.next_expiry)
+
+    def _serve(self, conn):
+        try:
+            while True:
+                request = conn.recv()
+                if request[0] == 'begin':
+                    self._serve_transaction(conn)
+                else:
+                    conn.send(self._handle(self.store, request))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _serve_transaction(self, conn):
+        # The store locks stay held until the worker sends 'end', exactly as
+        # they would around the body of RecordStore.transaction()
+        with self.store.transaction() as txn:
+            while True:
+                request = conn.recv()
+                if request[0] == 'end':
+                    break
+                conn.send(self._handle(txn, request))
+        self._publish()
+        conn.send(('ok', None))
+
+    def _handle(self, target, request):
+        op, args = request[0], request[1:]
+        handler = getattr(self, f'_op_{op}', None)
+        if handler is None:
+            return 'error', ValueError(f'Unknown store request: {op}')
+        try:
+            result = handler(target, *args)
+        except Exception as exc:
+            return 'error', exc
+        finally:
+            # Even reads can change the store, by removing expired records
+            self._publish()
+        return 'ok', result
+
+    # Each _op_ method answers one request; target is the store or an open transaction
+
+    def _op_epoch(self, target):
+        return self.store.epoch
+
+    def _op_get(self, target, record_id):
+        record = target.get(record_id, MISSING)
+        if record is MISSING:
+            return False, None
+        return True, record
+
+    def _op_get_with_revision(self, target, record_id):
+        found = target.get_with_revision(record_id, MISSING)
+        if found is MISSING:
+            return False, None, None
+        return (True,) + found
+
+    def _op_len(self, target):
+        return len(target)
+
+    def _op_query(self, target, filters, cursor, limit):
+        return list(islice(target.query(filters, cursor), limit))
+
+    def _op_expire_due(self, target):
+        target.expire_due()
+
+    def _op_changes(self, target, since, limit, timeout):
+        # Waiting holds up only this worker thread's own connection
+        return target.changes(since, limit, timeout)
+
+    def _op_last_seq(self, target):
+        return target.last_seq
+
+    def _op_add(self, target, record, ttl):
+        return target.add(record, ttl)
+
+    def _op_replace(self, target, record_id, record, revision):
+        return target.replace(record_id, record, revision)
+
+    def _op_pop(self, target, record_id, revision):
+        return target.pop(record_id, revision)
+
+    def _op_rollback(self, target):
+        target.rollback()
+
+    def _op_clear(self, target):
+        target.clear()
+
+    def _op_load(self, target, records, next_id, expires):
+        target.load(records, next_id, expires)
+
+    def _op_snapshot(self, target):
+        return target.snapshot()
+
+    def _op_create_index(self, target, field, kind):
+        target.create_index(field, kind)
+
+    def _op_drop_index(self, target, field):
+        target.drop_index(field)
+
+    def _op_indexes(self, target):
+        return target.indexes
+
+    def _op_approximate_bytes(self, target):
+        return target.approximate_bytes()
+
+    def _op_removal_counts(self, target):
+        return target.evicted, target.expired
+
+
+class RemoteStore:
+    """Stand-in for RecordStore that forwards every call to a StoreServer.
+
+    Used by worker processes, so all of them see one set of records. Each
+    thread has its own connection. The store version is read from the
+    owner's memory-mapped version file, and single-record reads are cached
+    for as long as it does not change, so read-heavy workers mostly avoid
+    the round trip and scale with their number.
+
+    update() reads the record, applies func locally and writes the result
+    back only if the record is still at the revision read, retrying
+    otherwise.
+    """
+
+    journal = None
+
+    def __init__(self, address, page_size=QUERY_PAGE_SIZE):
+        self.address = address
+        self.page_size = page_size
+        self._authkey = read_key(address)
+        self._local = threading.local()
+        with open(version_path(address), 'rb') as f:
+            self._version_map = mmap.mmap(f.fileno(), _PUBLISHED.size, access=mmap.ACCESS_READ)
+        self._read_cache = (None, {})
+        self.epoch = self._call('epoch')
+
+    @property
+    def version(self):
+        return _PUBLISHED.unpack_from(self._version_map)[0]
+
+    @property
+    def next_expiry(self):
+        return _PUBLISHED.unpack_from(self._version_map)[1]
+
+    def expire_due(self):
+        if self.next_expiry <= time.time():
+            self._call('expire_due')
+
+    def _connection(self):
+        # A forked worker must not share its parent's socket
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.conn = Client(self.address, family='AF_UNIX', authkey=self._authkey)
+            self._local.pid = pid
+        return self._local.conn
+
+    def _call(self, *request):
+        conn = self._connection()
+        conn.send(request)
+        status, result = conn.recv()
+        if status == 'error':
+            raise result
+        return result
+
+    def __len__(self):
+        return self._call('len')
+
+    def __contains__(self, record_id):
+        return self.get(record_id, MISSING) is not MISSING
+
+    def get(self, record_id, default=None):
+        found = self.get_with_revision(record_id, MISSING)
+        return default if found is MISSING else found[0]
+
+    def get_with_revision(self, record_id, default=None):
+        # A record read after the version was published is at least that
+        # recent, so it may be served again until the version moves on
+        self.expire_due()
+        version = self.version
+        cache_version, cache = self._read_cache
+        if cache_version != version:
+            cache = {}
+            self._read_cache = (version, cache)
+        entry = cache.get(record_id)
+        if entry is None:
+            entry = self._call('get_with_revision', record_id)
+            if len(cache) >= READ_CACHE_ENTRIES:
+                cache.clear()
+            cache[record_id] = entry
+        found, record, revision = entry
+        return (record, revision) if found else default
+
+    def iter_from(self, cursor=0):
+        return self.query((), cursor)
+
+    def query(self, filters, cursor=0):
+        # Fetched a page at a time; like a local scan, later pages reflect later writes
+        filters = list(filters)
+        while True:
+            page = self._call('query', filters, cursor, self.page_size)
+            yield from page
+            if len(page) < self.page_size:
+                return
+            cursor = page[-1][0] + 1
+
+    def changes(self, since=None, limit=None, timeout=0):
+        return self._call('changes', since, limit, timeout)
+
+    @property
+    def last_seq(self):
+        return self._call('last_seq')
+
+    def add(self, record, ttl=None):
+        return self._call('add', record, ttl)
+
+    def replace(self, record_id, record, revision=None):
+        return self._call('replace', record_id, record, revision)
+
+    def update(self, record_id, func, revision=None):
+        return self.update_with_revision(record_id, func, revision)[0]
+
+    def update_with_revision(self, record_id, func, revision=None):
+        while True:
+            found, record, current = self._call('get_with_revision', record_id)
+            if not found:
+                raise KeyError(record_id)
+            if revision is not None and current != revision:
+                raise RevisionMismatch(record_id)
+            updated = func(record)
+            try:
+                return updated, self._call('replace', record_id, updated, current)
+            except RevisionMismatch:
+                if revision is not None:
+                    raise
+
+    def pop(self, record_id, revision=None):
+        return self._call('pop', record_id, revision)
+
+    def clear(self):
+        self._call('clear')
+
+    def load(self, records, next_id, expires=None):
+        self._call('load', records, next_id, expires)
+
+    def snapshot(self, before=None):
+        if before is not None:
+            raise ValueError('snapshot hooks run in the owner process')
+        return self._call('snapshot')
+
+    def create_index(self, field, kind='hash'):
+        self._call('create_index', field, kind)
+
+    def drop_index(self, field):
+        self._call('drop_index', field)
+
+    @property
+    def indexes(self):
+        return self._call('indexes')
+
+    def approximate_bytes(self):
+        return self._call('approximate_bytes')
+
+    @property
+    def evicted(self):
+        return self._call('removal_counts')[0]
+
+    @property
+    def expired(self):
+        return self._call('removal_counts')[1]
+
+    @contextmanager
+    def transaction(self):
+        """Hold every lock in the owner's store for a group of operations.
+
+        The operations go over this thread's connection while the owner
+        holds the locks, so the rest of the store API must not be used on
+        this thread until the block ends.
+        """
+        self._connection().send(('begin',))
+        try:
+            yield _RemoteTransaction(self)
+        finally:
+            self._call('end')
+
+
+class _RemoteTransaction:
+    __slots__ = ('_store',)
+
+    def __init__(self, store):
+        self._store = store
+
+    def get(self, record_id, default=None):
+        found, record = self._store._call('get', record_id)
+        return record if found else default
+
+    def add(self, record, ttl=None):
+        return self._store._call('add', record, ttl)
+
+    def replace(self, record_id, record, revision=None):
+        return self._store._call('replace', record_id, record, revision)
+
+    def update(self, record_id, func, revision=None):
+        # The owner holds every lock, so nothing can change in between
+        found, record = self._store._call('get', record_id)
+        if not found:
+            raise KeyError(record_id)
+        record = func(record)
+        self._store._call('replace', record_id, record, revision)
+        return record
+
+    def pop(self, record_id, revision=None):
+        return self._store._call('pop', record_id, revision)
+
+    def rollback(self):
+        self._store._call('rollback')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Own the record store shared by local_server worker processes.')
+    parser.add_argument('--socket', required=True, help='path of the Unix socket workers connect to')
+    args = parser.parse_args(argv)
+
+    # The store is built exactly as a single-process server builds it, so
+    # LOCAL_SERVER_INDEXES, LOCAL_SERVER_DATA_DIR and the rest apply here
+    os.environ.pop(SOCKET_ENV, None)
+    from local_server import data_storage
+
+    server = StoreServer(data_storage, args.socket)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
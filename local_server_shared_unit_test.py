@@ -0,0 +1,143 @@
+import json
+import os
+import stat
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+from local_server_index import Filter
+from local_server_shared import SOCKET_ENV, RemoteStore, StoreServer, key_path
+from local_server_store import RecordStore, RevisionMismatch
+
+
+class SharedStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.server = StoreServer(RecordStore(), os.path.join(self.directory, 'store.sock'))
+        self.addCleanup(self.server.close)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.store = RemoteStore(self.server.address)
+
+    def test_changes_are_seen_by_every_client(self):
+        """Test that a write through one client is visible to another, past its read cache."""
+        other = RemoteStore(self.server.address)
+        record_id = self.store.add({"key": "value"})
+        self.assertEqual(other.get(record_id), {"key": "value"})
+
+        self.store.replace(record_id, {"key": "new_value"})
+        self.assertEqual(other.version, self.server.store.version)
+        self.assertEqual(other.get(record_id), {"key": "new_value"})
+        self.assertEqual(other.pop(record_id), {"key": "new_value"})
+        self.assertNotIn(record_id, self.store)
+        self.assertEqual(len(self.store), 0)
+
+    def test_clients_without_the_key_are_refused(self):
+        """Test that a client without the owner's key is refused before any request is read, and serving goes on."""
+        self.assertEqual(stat.S_IMODE(os.stat(key_path(self.server.address)).st_mode), 0o600)
+        with self.assertRaises(AuthenticationError):
+            Client(self.server.address, family='AF_UNIX', authkey=b'wrong key')
+        self.assertEqual(RemoteStore(self.server.address).add({"key": "value"}), 0)
+
+    def test_errors_are_raised_in_the_worker(self):
+        """Test that store errors, including revision mismatches, cross the socket as the same exceptions."""
+        with self.assertRaises(KeyError):
+            self.store.pop(5)
+        with self.assertRaises(KeyError):
+            self.store.update(5, lambda record: record)
+        with self.assertRaises(ValueError):
+            self.store.create_index('key', 'btree')
+        record_id = self.store.add({"key": "value"})
+        revision = self.store.get_with_revision(record_id)[1]
+        self.store.replace(record_id, {"key": "new_value"})
+        with self.assertRaises(RevisionMismatch):
+            self.store.update(record_id, lambda record: record, revision)
+        with self.assertRaises(RevisionMismatch):
+            self.store.pop(record_id, revision)
+
+    def test_query_is_fetched_in_pages(self):
+        """Test that queries longer than a page are walked to the end, with filters applied by the owner."""
+        self.store.page_size = 3
+        for i in range(10):
+            self.store.add({"n": i})
+        self.assertEqual([record_id for record_id, _ in self.store.iter_from(2)], list(range(2, 10)))
+        self.assertEqual([record["n"] for _, record in self.store.query([Filter('n', 'gte', 7)])], [7, 8, 9])
+
+    def test_transaction_runs_under_owner_locks(self):
+        """Test that a transaction sees its own changes, and can undo them with rollback()."""
+        self.store.add({"key": "value"})
+        version = self.store.version
+        with self.store.transaction() as txn:
+            record_id = txn.add({"key": "inserted"})
+            self.assertEqual(txn.update(record_id, lambda current: dict(current, extra=True)),
+                             {"key": "inserted", "extra": True})
+        self.assertGreater(self.store.version, version)
+        self.assertEqual(list(self.store.iter_from()), [
+            (0, {"key": "value"}),
+            (1, {"key": "inserted", "extra": True}),
+        ])
+
+        # rollback() undoes the transaction in the owner, which publishes nothing
+        last_seq = self.store.last_seq
+        with self.store.transaction() as txn:
+            txn.add({"key": "ghost"})
+            txn.pop(0)
+            txn.rollback()
+        self.assertEqual(self.store.last_seq, last_seq)
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual(self.store.get(0), {"key": "value"})
+
+    def test_update_retries_after_conflict(self):
+        """Test that update() applies func again when another client changed the record in between."""
+        other = RemoteStore(self.server.address)
+        record_id = self.store.add({"count": 0})
+        calls = []
+
+        def increment(record):
+            calls.append(record)
+            if len(calls) == 1:
+                other.replace(record_id, {"count": 10})
+            return dict(record, count=record["count"] + 1)
+
+        self.assertEqual(self.store.update(record_id, increment), {"count": 11})
+        self.assertEqual(len(calls), 2)
+
+    def test_worker_processes_share_store(self):
+        """Test that separate worker processes of the app read and write one store."""
+        address = os.path.join(self.directory, 'owner.sock')
+        owner = subprocess.Popen([sys.executable, 'local_server_shared.py', '--socket', address],
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.addCleanup(owner.wait)
+        self.addCleanup(owner.terminate)
+        deadline = time.monotonic() + 10
+        while not os.path.exists(address) and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        script = (
+            'import json, sys\n'
+            'from local_server import app\n'
+            'headers = {"X-Requested-With": "XMLHttpRequest", "Authorization": "Bearer your_token"}\n'
+            'client = app.test_client()\n'
+            'client.post("/post", headers=dict(headers, **{"Content-Type": "application/json"}),\n'
+            '            data=json.dumps({"worker": int(sys.argv[1])}))\n'
+        )
+        env = dict(os.environ, **{SOCKET_ENV: address})
+        workers = [subprocess.Popen([sys.executable, '-c', script, str(i)], env=env,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+                   for i in range(2)]
+        for worker in workers:
+            self.assertEqual(worker.wait(timeout=30), 0)
+
+        store = RemoteStore(address)
+        self.assertEqual(sorted(json.dumps(record) for _, record in store.iter_from()),
+                         ['{"worker": 0}', '{"worker": 1}'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,702 @@
+import itertools
+import math
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from heapq import heapify, heappop, heappush
+
+from local_server_feed import DEFAULT_FEED_SIZE, ChangeFeed
+from local_server_index import INDEX_KINDS, matches
+
+# Sentinel for "no record", since a stored record may itself be JSON null
+MISSING = object()
+
+DEFAULT_SHARDS = 16
+
+# Records looked at by approximate_bytes()
+DEFAULT_SIZE_SAMPLE = 100
+
+EVICT_LRU = 'lru'
+EVICT_FIFO = 'fifo'
+EVICTION_POLICIES = (EVICT_LRU, EVICT_FIFO)
+
+# Due expiries handled after each write, so expiry costs constant work per
+# operation instead of periodic scans of the whole store
+EXPIRE_PER_WRITE = 4
+
+# Stale entries the expiry heap may hold beyond twice its live ones before it is rebuilt
+EXPIRY_HEAP_SLACK = 64
+
+
+def _deep_size(value):
+    # Bytes held by a parsed JSON value, or by a raw record
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_deep_size(key) + _deep_size(item) for key, item in value.items())
+    elif isinstance(value, list):
+        size += sum(_deep_size(item) for item in value)
+    return size
+
+
+class RevisionMismatch(Exception):
+    """A conditional write found the record at a different revision than expected."""
+
+
+class _Shard:
+    __slots__ = ('records', 'lock')
+
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+
+class RecordStore:
+    """In-memory records keyed by a stable ID assigned on insert.
+
+    IDs are handed out in increasing order, so ID order is also insertion
+    order, and a record keeps its ID for its whole lifetime regardless of
+    what happens to the records around it. Each record also has a
+    revision that changes with every write to it, and replace(), update()
+    and pop() can be made conditional on it.
+
+    Records are spread over shards by ID and every shard has its own lock,
+    so writers to different records rarely contend. Reads never lock:
+    records are only ever replaced, never mutated in place, and a single
+    dict lookup is atomic, so a reader always sees a complete record.
+
+    Memory can be bounded with max_records and max_bytes: once either is
+    exceeded, the least recently read or written records (eviction='lru')
+    or the oldest ones (eviction='fifo') are evicted. A record added with
+    a ttl expires that many seconds later. Expired records are invisible
+    at once and are removed a few at a time after each write. Evictions
+    and expiries are journaled and published like any other delete.
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS, journal=None, feed_size=DEFAULT_FEED_SIZE,
+                 max_records=None, max_bytes=None, eviction=EVICT_LRU):
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(f'Invalid eviction policy: {eviction}')
+        self._shards = [_Shard() for _ in range(shards)]
+        # Optional write-ahead log; see local_server_wal.WriteAheadLog
+        self.journal = journal
+        # Recent changes for subscribers; sees the same entries as the journal
+        self.feed = ChangeFeed(feed_size)
+        self._next_id = 0
+        # Lowest ID that may still be live; lets scans skip deleted prefixes
+        self._first_id = 0
+        # Serializes ID allocation and moves of _first_id
+        self._id_lock = threading.Lock()
+        # Bumped after every change; never goes backwards, even across clear()
+        self.version = 0
+        # Tells versions of this store apart from those of an earlier process
+        self.epoch = os.urandom(4).hex()
+        self._version_lock = threading.Lock()
+        # Secondary indexes by field name, kept in step with every change
+        self._indexes = {}
+        # Revision of every live record. Each write to a record gives it the
+        # next value of a counter that only goes up, so two states of a
+        # record never share a revision.
+        self._revisions = {}
+        self._revision_counter = itertools.count(1)
+
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self._bounded = max_records is not None or max_bytes is not None
+        # Live IDs in eviction order, kept only when bounded, and record sizes when max_bytes is set
+        self._order = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        # Expiry times (time.time()) by ID for live records, and a heap of
+        # (time, ID) to find the next one due. Removing a record drops its
+        # time; the heap entry stays until it is popped or the heap is rebuilt.
+        self._expires = {}
+        self._expiry_heap = []
+        self._limits_lock = threading.Lock()
+        # Records removed by eviction and by expiry
+        self.evicted = 0
+        self.expired = 0
+
+    def _shard(self, record_id):
+        return self._shards[record_id % len(self._shards)]
+
+    def __len__(self):
+        return sum(len(shard.records) for shard in self._shards)
+
+    def __contains__(self, record_id):
+        return self._peek(record_id) is not MISSING
+
+    def get(self, record_id, default=None):
+        record = self._shard(record_id).records.get(record_id, MISSING)
+        if record is MISSING:
+            return default
+        if self._expires and self._is_expired(record_id):
+            self._discard(record_id, 'expired')
+            return default
+        if self._bounded and self.eviction == EVICT_LRU:
+            self._touch(record_id)
+        return record
+
+    def get_with_revision(self, record_id, default=None):
+        """Return (record, revision), or default if there is no such record.
+
+        Writers store the record before its revision and this reads them
+        the other way round, so the revision is never newer than the
+        record. A write landing in between can only make a conditional
+        request on the old revision fail, never let one succeed.
+        """
+        revision = self._revisions.get(record_id, 0)
+        record = self.get(record_id, MISSING)
+        if record is MISSING:
+            return default
+        return record, revision
+
+    def iter_from(self, cursor=0):
+        # Yields (record_id, record) pairs in insertion order, starting at cursor.
+        # Each step is a dict lookup, so the cost is bounded by the ID range walked.
+        # Scans do not count as use for LRU eviction.
+        record_id = max(cursor, self._first_id)
+        expires = self._expires
+        now = time.time()
+        while record_id < self._next_id:
+            record = self._shard(record_id).records.get(record_id, MISSING)
+            if record is not MISSING and not (expires and self._is_expired(record_id, now)):
+                yield record_id, record
+            record_id += 1
+
+    def query(self, filters, cursor=0):
+        """Yield (record_id, record) pairs matching every filter, in insertion order.
+
+        When an index covers one of the filters, the most selective one
+        supplies the candidates and the rest are checked per candidate, so
+        the cost follows the number of matches rather than the store size.
+        Without a usable index the store is scanned.
+        """
+        if not filters:
+            yield from self.iter_from(cursor)
+            return
+
+        best, best_size = None, None
+        for condition in filters:
+            index = self._indexes.get(condition.field)
+            if index is None:
+                continue
+            size = index.estimate(condition.op, condition.value)
+            if size is not None and (best_size is None or size < best_size):
+                best, best_size = (index, condition), size
+
+        if best is None:
+            for record_id, record in self.iter_from(cursor):
+                if matches(record, filters):
+                    yield record_id, record
+            return
+
+        index, condition = best
+        candidates = sorted(set(index.lookup(condition.op, condition.value)))
+        for record_id in candidates[bisect_left(candidates, cursor):]:
+            record = self._peek(record_id)
+            # The index may briefly lag a concurrent write, so the record decides
+            if record is not MISSING and matches(record, filters):
+                yield record_id, record
+
+    def create_index(self, field, kind='hash'):
+        """Index a top-level field; kind is 'hash' (eq, in) or 'sorted' (also ranges)."""
+        if kind not in INDEX_KINDS:
+            raise ValueError(f'Invalid index kind: {kind}')
+        index = INDEX_KINDS[kind](field)
+        with self._locked():
+            for record_id, record in self.iter_from():
+                index.add(record_id, record)
+            self._indexes[field] = index
+        return index
+
+    def drop_index(self, field):
+        with self._locked():
+            del self._indexes[field]
+
+    def approximate_bytes(self, sample=DEFAULT_SIZE_SAMPLE):
+        """Estimate the memory held by the records and the shard tables.
+
+        Measures up to sample records spread evenly over the ID range and
+        scales their average size by the record count, so the cost does not
+        grow with the store.
+        """
+        first_id, next_id = self._first_id, self._next_id
+        step = max(1, (next_id - first_id) // sample)
+        sizes = []
+        for record_id in range(first_id, next_id, step):
+            record = self._peek(record_id)
+            if record is not MISSING:
+                sizes.append(_deep_size(record))
+        count = len(self)
+        tables = sum(sys.getsizeof(shard.records) for shard in self._shards)
+        if not sizes:
+            return tables
+        return tables + count * sum(sizes) // len(sizes)
+
+    def expire_due(self):
+        """Remove every record whose TTL has passed; a single comparison when none has.
+
+        Expired records are hidden from reads straight away, but only their
+        removal bumps the version, so call this before relying on it.
+        """
+        if self.next_expiry <= time.time():
+            self._expire_due()
+
+    @property
+    def next_expiry(self):
+        # Earliest time.time() at which a record may expire, or infinity
+        try:
+            return self._expiry_heap[0][0]
+        except IndexError:
+            return math.inf
+
+    def changes(self, since=None, limit=None, timeout=0):
+        """Changes published after sequence number since; see ChangeFeed.since()."""
+        return self.feed.since(since, limit, timeout)
+
+    @property
+    def last_seq(self):
+        # Sequence number of the latest change in the feed
+        return self.feed.last_seq
+
+    @property
+    def indexes(self):
+        return {field: index.kind for field, index in self._indexes.items()}
+
+    def add(self, record, ttl=None):
+        """Insert a record and return its ID; with ttl it expires after that many seconds."""
+        with self._id_lock:
+            record_id = self._add(record)
+            entries = [('s', record_id, record)]
+            if ttl is not None:
+                entries.append(('x', record_id, self._set_expiry(record_id, time.time() + ttl)))
+            self._bump()
+            ticket = self._log(*entries)
+        self._sync(ticket)
+        self._enforce_limits()
+        return record_id
+
+    def replace(self, record_id, record, revision=None):
+        """Replace a record and return its new revision.
+
+        With revision, the record is replaced only if that is still its
+        revision, and RevisionMismatch is raised otherwise. The same goes
+        for update() and pop().
+        """
+        with self._shard(record_id).lock:
+            self._require_live(record_id)
+            self._check_revision(record_id, revision)
+            self._replace(record_id, record)
+            revision = self._revisions[record_id]
+            self._bump()
+            ticket = self._log(('s', record_id, record))
+        self._sync(ticket)
+        self._enforce_limits()
+        return revision
+
+    def update(self, record_id, func, revision=None):
+        """Replace a record with func(record) atomically and return the result.
+
+        Raises KeyError if the record does not exist. func must build a new
+        object rather than modify its argument, which concurrent readers may
+        still be holding.
+        """
+        return self.update_with_revision(record_id, func, revision)[0]
+
+    def update_with_revision(self, record_id, func, revision=None):
+        # update() that also returns the new revision: (record, revision)
+        with self._shard(record_id).lock:
+            self._require_live(record_id)
+            self._check_revision(record_id, revision)
+            record = self._update(record_id, func)
+            revision = self._revisions[record_id]
+            self._bump()
+            ticket = self._log(('s', record_id, record))
+        self._sync(ticket)
+        self._enforce_limits()
+        return record, revision
+
+    def pop(self, record_id, revision=None):
+        with self._shard(record_id).lock:
+            self._require_live(record_id)
+            self._check_revision(record_id, revision)
+            record = self._remove(record_id)
+            self._bump()
+            ticket = self._log(('d', record_id))
+        if record_id == self._first_id:
+            with self._id_lock:
+                self._advance_first_id()
+        self._sync(ticket)
+        return record
+
+    def clear(self):
+        with self._locked():
+            for shard in self._shards:
+                shard.records.clear()
+            for index in self._indexes.values():
+                index.clear()
+            self._revisions.clear()
+            self._clear_limits()
+            self._next_id = 0
+            self._first_id = 0
+            self._bump()
+            ticket = self._log(('c',))
+        self._sync(ticket)
+
+    def load(self, records, next_id, expires=None):
+        """Replace the whole contents of the store, e.g. after recovery.
+
+        expires maps record IDs to the time.time() at which they expire.
+        Nothing is written to the journal, and limits are enforced from the
+        next write on.
+        """
+        with self._locked():
+            for shard in self._shards:
+                shard.records.clear()
+            for index in self._indexes.values():
+                index.clear()
+            self._revisions.clear()
+            self._clear_limits()
+            for record_id, record in records.items():
+                self._shard(record_id).records[record_id] = record
+                self._reindex(record_id, MISSING, record)
+            for record_id, expires_at in (expires or {}).items():
+                if record_id in records:
+                    self._set_expiry(record_id, expires_at)
+            self._next_id = next_id
+            self._first_id = min(records, default=next_id)
+            self._bump()
+
+    def snapshot(self, before=None):
+        """Return (next_id, records, expires) as they stand at a single instant.
+
+        before is called while every lock is held, which lets the journal
+        start a new log segment at exactly the point the snapshot covers.
+        Copying only references is enough because records are never
+        modified in place.
+        """
+        with self._locked():
+            if before is not None:
+                before()
+            copies = [dict(shard.records) for shard in self._shards]
+            next_id = self._next_id
+            expires = dict(self._expires)
+        records = {}
+        for copy in copies:
+            records.update(copy)
+        return next_id, records, {record_id: expires[record_id] for record_id in records if record_id in expires}
+
+    @contextmanager
+    def transaction(self):
+        """Hold every lock in the store once for a group of operations.
+
+        Yields a view with the same mutating methods as the store that skips
+        per-operation locking. All of its changes reach the journal as one
+        entry, so a crash never leaves half a transaction behind.
+        """
+        with self._locked():
+            txn = _Transaction(self)
+            try:
+                yield txn
+            finally:
+                # A rolled back transaction still bumps the version: readers take
+                # no locks, so one may have cached a body built from its changes
+                if txn.entries or txn.rolled_back:
+                    self._bump()
+                ticket = self._log(*txn.entries)
+        self._sync(ticket)
+        self._enforce_limits()
+
+    def _bump(self):
+        # Called after a change is applied, so a reader that sees the new
+        # version is guaranteed to see the change as well
+        with self._version_lock:
+            self.version += 1
+
+    def _log(self, *entries):
+        if not entries:
+            return None
+        self.feed.publish(entries)
+        if self.journal is None:
+            return None
+        return self.journal.append(entries)
+
+    def _sync(self, ticket):
+        if ticket is not None:
+            self.journal.wait(ticket)
+
+    @contextmanager
+    def _locked(self):
+        # Locks are always taken in the same order, so this cannot deadlock
+        # against single-record operations or another transaction
+        with self._id_lock:
+            for shard in self._shards:
+                shard.lock.acquire()
+            try:
+                yield
+            finally:
+                for shard in reversed(self._shards):
+                    shard.lock.release()
+
+    # Limits and expiry
+
+    def _peek(self, record_id):
+        # get() without counting as use or removing anything, for internal reads
+        record = self._shard(record_id).records.get(record_id, MISSING)
+        if record is not MISSING and self._expires and self._is_expired(record_id):
+            return MISSING
+        return record
+
+    def _is_expired(self, record_id, now=None):
+        expires_at = self._expires.get(record_id)
+        return expires_at is not None and expires_at <= (time.time() if now is None else now)
+
+    def _require_live(self, record_id):
+        # An expired record that is still stored is treated as already gone
+        if self._expires and self._is_expired(record_id):
+            raise KeyError(record_id)
+
+    def _check_revision(self, record_id, revision):
+        if revision is not None and self._revisions.get(record_id) != revision:
+            raise RevisionMismatch(record_id)
+
+    def _set_expiry(self, record_id, expires_at):
+        with self._limits_lock:
+            self._expires[record_id] = expires_at
+            heappush(self._expiry_heap, (expires_at, record_id))
+        return expires_at
+
+    def _forget_expiry(self, record_id):
+        # Once stale heap entries outnumber live ones the heap is rebuilt, so
+        # its size stays proportional to the records that can still expire
+        with self._limits_lock:
+            self._expires.pop(record_id, None)
+            if len(self._expiry_heap) > 2 * len(self._expires) + EXPIRY_HEAP_SLACK:
+                self._expiry_heap = [(expires_at, live_id) for live_id, expires_at in self._expires.items()]
+                heapify(self._expiry_heap)
+
+    def _touch(self, record_id):
+        with self._limits_lock:
+            if record_id in self._order:
+                self._order.move_to_end(record_id)
+
+    def _account(self, record_id, previous, record):
+        # Keeps eviction order and byte counts in step with a change
+        size = _deep_size(record) if self.max_bytes is not None and record is not MISSING else 0
+        with self._limits_lock:
+            if self.max_bytes is not None:
+                self._bytes += size - self._sizes.pop(record_id, 0)
+                if record is not MISSING:
+                    self._sizes[record_id] = size
+            if record is MISSING:
+                self._order.pop(record_id, None)
+            elif previous is MISSING:
+                self._order[record_id] = None
+            elif self.eviction == EVICT_LRU:
+                self._order.move_to_end(record_id)
+
+    def _over_limit(self):
+        return ((self.max_records is not None and len(self._order) > self.max_records) or
+                (self.max_bytes is not None and self._bytes > self.max_bytes))
+
+    def _clear_limits(self):
+        with self._limits_lock:
+            self._order.clear()
+            self._sizes.clear()
+            self._bytes = 0
+            self._expires.clear()
+            self._expiry_heap.clear()
+
+    def _enforce_limits(self):
+        # Runs after a write has released its locks. Each record is evicted
+        # or expired once, so the work is constant per write when amortized.
+        if self._expiry_heap:
+            self._expire_due(EXPIRE_PER_WRITE)
+        if self._bounded:
+            while True:
+                with self._limits_lock:
+                    if not self._order or not self._over_limit():
+                        return
+                    record_id = next(iter(self._order))
+                self._discard(record_id, 'evicted')
+
+    def _expire_due(self, limit=None):
+        now = time.time()
+        done = 0
+        while limit is None or done < limit:
+            done += 1
+            with self._limits_lock:
+                heap = self._expiry_heap
+                if not heap or heap[0][0] > now:
+                    return
+                expires_at, record_id = heappop(heap)
+                if self._expires.get(record_id) != expires_at:
+                    continue  # superseded, or the store was cleared
+                del self._expires[record_id]
+            self._discard(record_id, 'expired')
+
+    def _discard(self, record_id, reason):
+        # Removes a record on the store's own initiative; reason is 'evicted' or 'expired'
+        with self._shard(record_id).lock:
+            if record_id not in self._shard(record_id).records:
+                return
+            self._remove(record_id)
+            self._bump()
+            ticket = self._log(('d', record_id, reason))
+        with self._limits_lock:
+            if reason == 'evicted':
+                self.evicted += 1
+            else:
+                self.expired += 1
+        if record_id == self._first_id:
+            with self._id_lock:
+                self._advance_first_id()
+        self._sync(ticket)
+
+    # The methods below expect the caller to hold the relevant locks
+
+    def _add(self, record):
+        record_id = self._next_id
+        self._shard(record_id).records[record_id] = record
+        self._next_id += 1
+        self._reindex(record_id, MISSING, record)
+        return record_id
+
+    def _replace(self, record_id, record):
+        records = self._shard(record_id).records
+        previous = records[record_id]
+        records[record_id] = record
+        self._reindex(record_id, previous, record)
+
+    def _update(self, record_id, func):
+        records = self._shard(record_id).records
+        previous = records[record_id]
+        record = func(previous)
+        records[record_id] = record
+        self._reindex(record_id, previous, record)
+        return record
+
+    def _remove(self, record_id):
+        record = self._shard(record_id).records.pop(record_id)
+        self._reindex(record_id, record, MISSING)
+        if self._expires:
+            self._forget_expiry(record_id)
+        return record
+
+    def _pop(self, record_id):
+        record = self._remove(record_id)
+        if record_id == self._first_id:
+            self._advance_first_id()
+        return record
+
+    def _restore(self, record_id, record, revision=None):
+        # Puts a record back under an ID it held before, e.g. to undo a delete.
+        # With revision it gets that revision back too, so ETags a client
+        # holds for it are valid again.
+        records = self._shard(record_id).records
+        previous = records.get(record_id, MISSING)
+        records[record_id] = record
+        self._reindex(record_id, previous, record)
+        if revision is not None:
+            self._revisions[record_id] = revision
+        self._first_id = min(self._first_id, record_id)
+
+    def _reindex(self, record_id, previous, record):
+        # Every change to a record passes through here, which also makes it
+        # the place where revisions move on and the limits learn about it
+        if record is MISSING:
+            self._revisions.pop(record_id, None)
+        else:
+            self._revisions[record_id] = next(self._revision_counter)
+        for index in self._indexes.values():
+            if previous is not MISSING:
+                index.remove(record_id, previous)
+            if record is not MISSING:
+                index.add(record_id, record)
+        if self._bounded:
+            self._account(record_id, previous, record)
+
+    def _advance_first_id(self):
+        while self._first_id < self._next_id and self._first_id not in self:
+            self._first_id += 1
+
+
+class _Transaction:
+    # Created with every store lock held. _undo holds (record_id, previous
+    # record, previous revision, previous expiry time) for each change, in
+    # order, so rollback() can put them all back as they were.
+    __slots__ = ('_store', 'entries', '_undo', '_next_id', '_first_id', 'rolled_back')
+
+    def __init__(self, store):
+        self._store = store
+        self.entries = []
+        self._undo = []
+        self._next_id = store._next_id
+        self._first_id = store._first_id
+        self.rolled_back = False
+
+    def _previous(self, record_id):
+        store = self._store
+        return (store._shard(record_id).records.get(record_id, MISSING), store._revisions.get(record_id),
+                store._expires.get(record_id))
+
+    def get(self, record_id, default=None):
+        record = self._store._peek(record_id)
+        return default if record is MISSING else record
+
+    def add(self, record, ttl=None):
+        record_id = self._store._add(record)
+        self._undo.append((record_id, MISSING, None, None))
+        self.entries.append(('s', record_id, record))
+        if ttl is not None:
+            self.entries.append(('x', record_id, self._store._set_expiry(record_id, time.time() + ttl)))
+        return record_id
+
+    def replace(self, record_id, record, revision=None):
+        self._store._check_revision(record_id, revision)
+        previous = self._previous(record_id)
+        self._store._replace(record_id, record)
+        self._undo.append((record_id,) + previous)
+        self.entries.append(('s', record_id, record))
+        return self._store._revisions[record_id]
+
+    def update(self, record_id, func, revision=None):
+        self._store._check_revision(record_id, revision)
+        previous = self._previous(record_id)
+        record = self._store._update(record_id, func)
+        self._undo.append((record_id,) + previous)
+        self.entries.append(('s', record_id, record))
+        return record
+
+    def pop(self, record_id, revision=None):
+        self._store._check_revision(record_id, revision)
+        previous = self._previous(record_id)
+        record = self._store._pop(record_id)
+        self._undo.append((record_id,) + previous)
+        self.entries.append(('d', record_id))
+        return record
+
+    def rollback(self):
+        """Undo every change made so far, as if the transaction had never run.
+
+        Its entries are dropped as well, so neither the journal nor the
+        change feed ever hears of them.
+        """
+        store = self._store
+        for record_id, previous, revision, expires_at in reversed(self._undo):
+            if previous is not MISSING:
+                store._restore(record_id, previous, revision)
+                if expires_at is not None and store._expires.get(record_id) != expires_at:
+                    store._set_expiry(record_id, expires_at)
+            elif record_id in store._shard(record_id).records:
+                store._remove(record_id)
+        store._next_id = self._next_id
+        store._first_id = self._first_id
+        self.rolled_back = self.rolled_back or bool(self._undo)
+        self._undo.clear()
+        self.entries.clear()
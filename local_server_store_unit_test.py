@@ -0,0 +1,238 @@
+import threading
+import time
+import unittest
+
+from local_server_store import EVICT_FIFO, RecordStore, RevisionMismatch
+
+THREADS = 8
+OPERATIONS_PER_THREAD = 500
+
+
+def run_threads(target):
+    threads = [threading.Thread(target=target) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class RecordStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.store = RecordStore(shards=4)
+
+    def test_concurrent_deletes_remove_each_record_once(self):
+        """Test that racing deletes of the same records succeed exactly once per record."""
+        for i in range(OPERATIONS_PER_THREAD):
+            self.store.add({"value": i})
+        deleted = []
+
+        def delete():
+            for record_id in range(OPERATIONS_PER_THREAD):
+                try:
+                    self.store.pop(record_id)
+                    deleted.append(record_id)
+                except KeyError:
+                    pass
+
+        run_threads(delete)
+        self.assertEqual(sorted(deleted), list(range(OPERATIONS_PER_THREAD)))
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(list(self.store.iter_from()), [])
+
+    def test_concurrent_inserts_get_unique_ids(self):
+        """Test that concurrent inserts never hand out the same ID twice."""
+        ids = []
+
+        def insert():
+            for i in range(OPERATIONS_PER_THREAD):
+                ids.append(self.store.add({"value": i}))
+
+        run_threads(insert)
+        self.assertEqual(len(self.store), THREADS * OPERATIONS_PER_THREAD)
+        self.assertEqual(sorted(ids), list(range(THREADS * OPERATIONS_PER_THREAD)))
+
+    def test_concurrent_updates_are_not_lost(self):
+        """Stress test: concurrent read-modify-write updates on shared records lose nothing."""
+        record_ids = [self.store.add({"count": 0}) for _ in range(3)]
+
+        def increment():
+            for i in range(OPERATIONS_PER_THREAD):
+                record_id = record_ids[i % len(record_ids)]
+                self.store.update(record_id, lambda record: {"count": record["count"] + 1})
+
+        run_threads(increment)
+        total = sum(self.store.get(record_id)["count"] for record_id in record_ids)
+        self.assertEqual(total, THREADS * OPERATIONS_PER_THREAD)
+
+    def test_conditional_writes_check_revision(self):
+        """Test that every write moves a record's revision on, and writes made on a stale revision fail."""
+        record_id = self.store.add({"count": 0})
+        other_id = self.store.add({"count": 0})
+        record, revision = self.store.get_with_revision(record_id)
+        self.assertEqual(record, {"count": 0})
+        self.assertNotEqual(revision, self.store.get_with_revision(other_id)[1])
+        self.assertIsNone(self.store.get_with_revision(99))
+
+        new_revision = self.store.replace(record_id, {"count": 1}, revision)
+        self.assertGreater(new_revision, revision)
+        self.assertEqual(self.store.get_with_revision(record_id), ({"count": 1}, new_revision))
+        with self.assertRaises(RevisionMismatch):
+            self.store.replace(record_id, {"count": 2}, revision)
+        with self.assertRaises(RevisionMismatch):
+            self.store.update(record_id, lambda current: {"count": 2}, revision)
+        with self.assertRaises(RevisionMismatch):
+            self.store.pop(record_id, revision)
+        self.assertEqual(self.store.get(record_id), {"count": 1})
+
+        record, revision = self.store.update_with_revision(record_id, lambda current: {"count": 2}, new_revision)
+        self.assertEqual(self.store.get_with_revision(record_id), (record, revision))
+        self.assertEqual(self.store.pop(record_id, revision), {"count": 2})
+
+    def test_expired_records_disappear(self):
+        """Test that a record is hidden once its TTL passes and removed, once, as expired."""
+        self.store.add({"key": "short"}, ttl=0.05)
+        self.store.add({"key": "kept"})
+        self.store.add({"key": "long"}, ttl=60)
+        time.sleep(0.1)
+
+        self.assertNotIn(0, self.store)
+        self.assertEqual([record_id for record_id, _ in self.store.iter_from()], [1, 2])
+        with self.assertRaises(KeyError):
+            self.store.replace(0, {"key": "too late"})
+
+        version = self.store.version
+        self.store.expire_due()
+        self.assertGreater(self.store.version, version)
+        self.assertEqual(self.store.expired, 1)
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual([(change.op, change.id, change.reason) for change in self.store.changes(3)],
+                         [('delete', 0, 'expired')])
+
+    def test_expiry_is_dropped_with_its_record(self):
+        """Test that deleted and evicted records leave no expiry bookkeeping behind."""
+        store = RecordStore(max_records=10)
+        for i in range(1000):
+            store.add({"n": i}, ttl=600)
+        store.pop(995)
+        self.assertEqual(len(store), 9)
+        self.assertEqual(sorted(store._expires), [990, 991, 992, 993, 994, 996, 997, 998, 999])
+        self.assertLess(len(store._expiry_heap), 100)
+
+    def test_fifo_eviction_ignores_reads(self):
+        """Test that fifo eviction removes the oldest record even if it was just read."""
+        store = RecordStore(max_records=2, eviction=EVICT_FIFO)
+        store.add({"n": 0})
+        store.add({"n": 1})
+        store.get(0)
+        store.add({"n": 2})
+        self.assertEqual([record_id for record_id, _ in store.iter_from()], [1, 2])
+
+    def test_invalid_eviction_policy(self):
+        """Test that an unknown eviction policy is rejected."""
+        with self.assertRaises(ValueError):
+            RecordStore(eviction='random')
+
+    def test_iter_from_skips_deleted_records(self):
+        """Test that scans return live records in insertion order."""
+        for i in range(6):
+            self.store.add(i)
+        self.store.pop(0)
+        self.store.pop(3)
+        self.assertEqual(list(self.store.iter_from()), [(1, 1), (2, 2), (4, 4), (5, 5)])
+        self.assertEqual(list(self.store.iter_from(3)), [(4, 4), (5, 5)])
+
+    def test_max_bytes_evicts_until_under_limit(self):
+        """Test that a large record evicts as many older records as it takes to fit."""
+        store = RecordStore(max_bytes=2000)
+        for i in range(4):
+            store.add(b'x' * 300)
+        store.add(b'y' * 1500)
+        self.assertEqual([record_id for record_id, _ in store.iter_from()], [3, 4])
+        self.assertEqual(store.evicted, 3)
+
+    def test_max_records_evicts_least_recently_used(self):
+        """Test that lru eviction removes the record read or written longest ago, and reports it."""
+        store = RecordStore(max_records=3)
+        for i in range(3):
+            store.add({"n": i})
+        store.get(0)
+        store.replace(1, {"n": 10})
+        store.add({"n": 3})
+        self.assertEqual([record_id for record_id, _ in store.iter_from()], [0, 1, 3])
+        self.assertEqual(store.evicted, 1)
+        self.assertEqual([(change.op, change.id, change.reason) for change in store.changes(store.last_seq - 1)],
+                         [('delete', 2, 'evicted')])
+
+    def test_reads_do_not_block_on_writers(self):
+        """Test that reads complete while a writer holds every lock in the store."""
+        record_id = self.store.add({"key": "value"})
+        locked = threading.Event()
+        release = threading.Event()
+
+        def writer():
+            with self.store.transaction():
+                locked.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            locked.wait(5)
+            self.assertEqual(self.store.get(record_id), {"key": "value"})
+            self.assertEqual(list(self.store.iter_from()), [(record_id, {"key": "value"})])
+        finally:
+            release.set()
+            thread.join()
+
+    def test_transaction_rollback_keeps_order(self):
+        """Test that rolling back a delete puts the record back in its original position."""
+        for i in range(3):
+            self.store.add(i)
+        with self.store.transaction() as txn:
+            txn.pop(0)
+            txn.rollback()
+        self.assertEqual([record_id for record_id, _ in self.store.iter_from()], [0, 1, 2])
+
+    def test_transaction_rollback(self):
+        """Test that a rolled back transaction undoes its changes, revisions included, and publishes nothing."""
+        self.store.add({"key": "value"})
+        self.store.add({"key": "other"}, ttl=60)
+        revisions = [self.store.get_with_revision(record_id)[1] for record_id in (0, 1)]
+        last_seq = self.store.last_seq
+        with self.store.transaction() as txn:
+            txn.add({"key": "inserted"}, ttl=30)
+            txn.replace(0, {"key": "replaced"})
+            txn.update(0, lambda record: dict(record, extra=True))
+            txn.pop(1)
+            txn.rollback()
+        self.assertEqual(list(self.store.iter_from()), [(0, {"key": "value"}), (1, {"key": "other"})])
+        # Records get their revisions back, so conditional writes against them still succeed
+        self.assertEqual([self.store.get_with_revision(record_id)[1] for record_id in (0, 1)], revisions)
+        self.assertEqual(self.store.last_seq, last_seq)
+        self.assertEqual(self.store.add({"key": "next"}), 2)
+        # The rolled back insert's TTL went with it, so the new record 2 does not inherit it
+        self.assertNotIn(2, self.store._expires)
+        # The deleted record got its TTL back
+        self.assertIn(1, self.store._expires)
+
+    def test_version_bumps_on_every_change(self):
+        """Test that every kind of change moves the version forward, including clear()."""
+        versions = [self.store.version]
+        record_id = self.store.add({"key": "value"})
+        versions.append(self.store.version)
+        self.store.replace(record_id, {"key": "new_value"})
+        versions.append(self.store.version)
+        self.store.update(record_id, lambda record: dict(record, extra=True))
+        versions.append(self.store.version)
+        self.store.pop(record_id)
+        versions.append(self.store.version)
+        with self.store.transaction() as txn:
+            txn.add({"key": "value"})
+        versions.append(self.store.version)
+        self.store.clear()
+        versions.append(self.store.version)
+        self.assertEqual(versions, sorted(set(versions)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,23 @@
 import unittest
+import asyncio
+import codecs
+import gzip
 import json
-from local_server import app, data_storage  # Adjust the import to your service file name
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import local_server
+import local_server_codec as codec
+from local_server import app, data_storage, metrics, token_registry  # Adjust the import to your service file name
+from local_server_asgi import BLOCKING_THREADS, AsgiApp, TestClient as AsgiTestClient, app as asgi_app
+from local_server_auth import RateLimit
+from local_server_profile import RequestProfiler
+from local_server_shared import RemoteStore, StoreServer
+from local_server_store import RecordStore
+from local_server_wal import WriteAheadLog
 
 
 class FlaskServiceTests(unittest.TestCase):
@@ -8,6 +25,96 @@ class FlaskServiceTests(unittest.TestCase):
         self.app = app.test_client()
         self.app.testing = True
         data_storage.clear()  # Clear the data_storage list
+        metrics.reset()
+        token_registry.reset()
+
+    def changes(self, query=''):
+        response = self.app.get(f'/changes?{query}', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        return response
+
+    def test_changes_gap(self):
+        """Test that a position past the end of the feed asks the client to reload."""
+        last_seq = json.loads(self.changes('wait=0').data)["last_seq"]
+        response = self.changes(f'since={last_seq + 100}&wait=0')
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(json.loads(response.data)["last_seq"], last_seq)
+
+    def test_changes_invalid_parameters(self):
+        """Test that malformed feed parameters are rejected."""
+        for query in ('since=-1', 'since=abc', 'limit=0', 'wait=1000'):
+            response = self.changes(query)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("Invalid feed parameters", str(response.data))
+
+    def test_changes_long_poll_returns_deltas(self):
+        """Test that a long-poll returns every change after since, in order, and where to continue."""
+        last_seq = json.loads(self.changes('wait=0').data)["last_seq"]
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'Content-Type': 'application/json'
+        }
+        self.app.post('/post', headers=headers, data=json.dumps({"key": "value"}))
+        self.app.put('/put/0', headers=headers, data=json.dumps({"key": "new_value"}))
+        self.app.patch('/patch/0', headers=headers, data=json.dumps({"extra": True}))
+        self.app.delete('/delete/0', headers=headers)
+
+        response = self.changes(f'since={last_seq}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {
+            "changes": [
+                {"seq": last_seq + 1, "op": "set", "id": 0, "data": {"key": "value"}},
+                {"seq": last_seq + 2, "op": "set", "id": 0, "data": {"key": "new_value"}},
+                {"seq": last_seq + 3, "op": "set", "id": 0, "data": {"key": "new_value", "extra": True}},
+                {"seq": last_seq + 4, "op": "delete", "id": 0},
+            ],
+            "last_seq": last_seq + 4,
+        })
+
+        response = self.changes(f'since={last_seq + 1}&limit=1')
+        self.assertEqual(json.loads(response.data)["last_seq"], last_seq + 2)
+
+    def test_changes_long_poll_waits_for_write(self):
+        """Test that a long-poll with nothing new returns as soon as a write happens."""
+        last_seq = json.loads(self.changes('wait=0').data)["last_seq"]
+
+        # The store under test, which is not always the module-level one
+        store = local_server.data_storage
+
+        def write():
+            time.sleep(0.1)
+            store.add({"key": "late"})
+
+        writer = threading.Thread(target=write)
+        self.addCleanup(writer.join)
+        writer.start()
+        response = self.changes(f'since={last_seq}&wait=10')
+        self.assertEqual([change["data"] for change in json.loads(response.data)["changes"]], [{"key": "late"}])
+
+    def test_changes_sse_stream(self):
+        """Test that SSE subscribers get each change as an event with its sequence number as the ID."""
+        last_seq = json.loads(self.changes('wait=0').data)["last_seq"]
+        for i in range(2):
+            self.app.post('/post',
+                          headers={
+                              'X-Requested-With': 'XMLHttpRequest',
+                              'Authorization': 'Bearer your_token',
+                              'Content-Type': 'application/json'
+                          },
+                          data=json.dumps({"n": i}))
+
+        response = self.changes(f'since={last_seq}&stream=sse&limit=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/event-stream'))
+        events = response.get_data(as_text=True).strip().split('\n\n')
+        self.assertEqual(len(events), 2)
+        for i, event in enumerate(events):
+            lines = event.split('\n')
+            self.assertEqual(lines[:2], [f'id: {last_seq + i + 1}', 'event: change'])
+            self.assertEqual(json.loads(lines[2][len('data: '):])["data"], {"n": i})
 
     def test_delete_data_nonexistent(self):
         """Test DELETE request on nonexistent index."""
@@ -64,6 +171,161 @@ class FlaskServiceTests(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(response.data), {"message": "Data deleted", "data": {"key": "value"}})
 
+    def test_batch_data_atomic_rollback(self):
+        """Test that a failing operation rolls back an atomic batch."""
+        self.app.post('/post',
+                      headers={
+                          'X-Requested-With': 'XMLHttpRequest',
+                          'Authorization': 'Bearer your_token',
+                          'Content-Type': 'application/json'
+                      },
+                      data=json.dumps({"key": "value"}))
+        last_seq = json.loads(self.changes('wait=0').data)["last_seq"]
+        etag = self.app.get('/get/0', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        }).headers['ETag']
+
+        operations = [
+            {"op": "insert", "data": {"key": "inserted"}},
+            {"op": "patch", "id": 0, "data": {"key": "patched"}},
+            {"op": "delete", "id": 0},
+            {"op": "put", "id": 999, "data": {"key": "missing"}},
+        ]
+        response = self.app.post('/batch?atomic=true',
+                                 headers={
+                                     'X-Requested-With': 'XMLHttpRequest',
+                                     'Authorization': 'Bearer your_token',
+                                     'Content-Type': 'application/json'
+                                 },
+                                 data=json.dumps(operations))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.data)["results"][-1], {"status": 404, "error": "Not found"})
+
+        response = self.app.get('/get', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        self.assertEqual(json.loads(response.data), {"data": [{"key": "value"}]})
+
+        # Subscribers never hear of the aborted batch, and its insert's ID is handed out again
+        response = self.changes(f'since={last_seq}&wait=0')
+        self.assertEqual(json.loads(response.data), {"changes": [], "last_seq": last_seq})
+
+        # Record 0 is back at its old revision, so its ETag still matches
+        response = self.app.get('/get/0', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        self.assertEqual(response.headers['ETag'], etag)
+
+        response = self.app.post('/post',
+                                 headers={
+                                     'X-Requested-With': 'XMLHttpRequest',
+                                     'Authorization': 'Bearer your_token',
+                                     'Content-Type': 'application/json'
+                                 },
+                                 data=json.dumps({"key": "next"}))
+        self.assertEqual(json.loads(response.data)["id"], 1)
+
+    def test_batch_data_invalid_json(self):
+        """Test batch request with a body that is not a JSON array."""
+        response = self.app.post('/batch',
+                                 headers={
+                                     'X-Requested-With': 'XMLHttpRequest',
+                                     'Authorization': 'Bearer your_token',
+                                     'Content-Type': 'application/json'
+                                 },
+                                 data='[{"op": "insert"')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Invalid JSON", str(response.data))
+
+    def test_batch_data_mixed_operations(self):
+        """Test batch request mixing inserts, updates and deletes."""
+        operations = [
+            {"op": "insert", "data": {"key": "value_0"}},
+            {"op": "insert", "data": {"key": "value_1"}},
+            {"op": "put", "id": 0, "data": {"key": "new_value"}},
+            {"op": "patch", "id": 1, "data": {"extra": True}},
+            {"op": "delete", "id": 0},
+            {"op": "delete", "id": 999},
+            {"op": "unknown"},
+        ]
+        response = self.app.post('/batch',
+                                 headers={
+                                     'X-Requested-With': 'XMLHttpRequest',
+                                     'Authorization': 'Bearer your_token',
+                                     'Content-Type': 'application/json'
+                                 },
+                                 data=json.dumps(operations))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {"results": [
+            {"status": 201, "id": 0},
+            {"status": 201, "id": 1},
+            {"status": 200, "id": 0},
+            {"status": 200, "id": 1},
+            {"status": 200, "id": 0},
+            {"status": 404, "error": "Not found"},
+            {"status": 400, "error": "Invalid operation"},
+        ]})
+
+        response = self.app.get('/get', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        self.assertEqual(json.loads(response.data), {"data": [{"key": "value_1", "extra": True}]})
+
+    def test_batch_data_ndjson(self):
+        """Test batch request sent as NDJSON, one operation per line."""
+        body = "\n".join(json.dumps({"op": "insert", "data": {"key": f"value_{i}"}}) for i in range(3))
+        response = self.app.post('/batch',
+                                 headers={
+                                     'X-Requested-With': 'XMLHttpRequest',
+                                     'Authorization': 'Bearer your_token',
+                                     'Content-Type': 'application/x-ndjson'
+                                 },
+                                 data=body)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {"results": [{"status": 201, "id": i} for i in range(3)]})
+
+    def test_delete_data_keeps_ids_stable(self):
+        """Test that deleting a record does not shift the IDs of later records."""
+        for i in range(3):
+            self.app.post('/post',
+                          headers={
+                              'X-Requested-With': 'XMLHttpRequest',
+                              'Authorization': 'Bearer your_token',
+                              'Content-Type': 'application/json'
+                          },
+                          data=json.dumps({"key": f"value_{i}"}))
+
+        self.app.delete('/delete/0',
+                        headers={
+                            'X-Requested-With': 'XMLHttpRequest',
+                            'Authorization': 'Bearer your_token'
+                        })
+        response = self.app.put('/put/2',
+                                headers={
+                                    'X-Requested-With': 'XMLHttpRequest',
+                                    'Authorization': 'Bearer your_token',
+                                    'Content-Type': 'application/json'
+                                },
+                                data=json.dumps({"key": "new_value"}))
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.get('/get', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        self.assertEqual(json.loads(response.data), {"data": [{"key": "value_1"}, {"key": "new_value"}]})
+
+        response = self.app.delete('/delete/0',
+                                   headers={
+                                       'X-Requested-With': 'XMLHttpRequest',
+                                       'Authorization': 'Bearer your_token'
+                                   })
+        self.assertEqual(response.status_code, 404)
+
     def test_get_data_after_multiple_posts(self):
         """Test GET request after multiple POST requests to verify all data is returned."""
         for i in range(3):
@@ -92,6 +354,263 @@ class FlaskServiceTests(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(response.data), {"data": []})
 
+    def test_get_data_cache_follows_changes(self):
+        """Test that repeated GET requests see every change made in between."""
+        self.app.post('/post',
+                      headers={
+                          'X-Requested-With': 'XMLHttpRequest',
+                          'Authorization': 'Bearer your_token',
+                          'Content-Type': 'application/json'
+                      },
+                      data=json.dumps({"key": "value"}))
+        for _ in range(2):
+            response = self.app.get('/get', headers={
+                'X-Requested-With': 'XMLHttpRequest',
+                'Authorization': 'Bearer your_token'
+            })
+            self.assertEqual(json.loads(response.data), {"data": [{"key": "value"}]})
+
+        self.app.patch('/patch/0',
+                       headers={
+                           'X-Requested-With': 'XMLHttpRequest',
+                           'Authorization': 'Bearer your_token',
+                           'Content-Type': 'application/json'
+                       },
+                       data=json.dumps({"key": "updated_value"}))
+        response = self.app.get('/get', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        self.assertEqual(json.loads(response.data), {"data": [{"key": "updated_value"}]})
+
+    def test_get_data_cache_ignores_unused_params(self):
+        """Test that GET requests differing only in parameters /get ignores share one cached body."""
+        headers = {'X-Requested-With': 'XMLHttpRequest', 'Authorization': 'Bearer your_token'}
+        self.app.post('/post', headers=dict(headers, **{'Content-Type': 'application/json'}),
+                      data=json.dumps({"n": 1}))
+        local_server.response_cache.clear()
+        self.addCleanup(local_server.response_cache.clear)
+        for query in ('?_=1', '?_=2', '', '?n=1&_=3'):
+            response = self.app.get('/get' + query, headers=headers)
+            self.assertEqual(json.loads(response.data), {"data": [{"n": 1}]})
+        # Filters that compare equal in Python but not in JSON get their own bodies
+        for query, expected in (('?filter[n]=1&_=4', [{"n": 1}]), ('?filter[n]=true', [])):
+            response = self.app.get('/get' + query, headers=headers)
+            self.assertEqual(json.loads(response.data), {"data": expected})
+        self.assertEqual(len(local_server.response_cache), 3)
+
+    def test_get_data_compressed(self):
+        """Test that a large GET is compressed for clients that accept it, once per store version."""
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'Content-Type': 'application/json'
+        }
+        records = [{"key": f"value_{i}", "padding": "x" * 20} for i in range(50)]
+        for record in records:
+            self.app.post('/post', headers=headers, data=json.dumps(record))
+        calls = []
+
+        def counting_gzip(data):
+            calls.append(len(data))
+            return gzip.compress(data)
+        self.addCleanup(setattr, local_server, 'RESPONSE_ENCODINGS', local_server.RESPONSE_ENCODINGS)
+        local_server.RESPONSE_ENCODINGS = {'gzip': counting_gzip}
+
+        plain = self.app.get('/get', headers=headers)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+        for _ in range(2):
+            response = self.app.get('/get', headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(response.data), plain.data)
+            self.assertEqual(json.loads(gzip.decompress(response.data)), {"data": records})
+        self.assertEqual(len(calls), 1)
+        self.assertNotEqual(response.headers['ETag'], plain.headers['ETag'])
+        response = self.app.get('/get', headers=dict(headers, **{'Accept-Encoding': 'gzip',
+                                                                 'If-None-Match': response.headers['ETag']}))
+        self.assertEqual(response.status_code, 304)
+
+        # Small responses go out as they are
+        response = self.app.get('/get/0', headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(json.loads(response.data), {"id": 0, "data": records[0]})
+
+    def test_get_data_etag_not_modified(self):
+        """Test that GET request with a current If-None-Match returns 304 until the data changes."""
+        response = self.app.get('/get', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        etag = response.headers['ETag']
+
+        response = self.app.get('/get', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'If-None-Match': etag
+        })
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        self.app.post('/post',
+                      headers={
+                          'X-Requested-With': 'XMLHttpRequest',
+                          'Authorization': 'Bearer your_token',
+                          'Content-Type': 'application/json'
+                      },
+                      data=json.dumps({"key": "value"}))
+        response = self.app.get('/get', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'If-None-Match': etag
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(json.loads(response.data), {"data": [{"key": "value"}]})
+
+    def test_get_data_filtered(self):
+        """Test GET request with equality, range and in filters on top-level fields."""
+        for i in range(6):
+            self.app.post('/post',
+                          headers={
+                              'X-Requested-With': 'XMLHttpRequest',
+                              'Authorization': 'Bearer your_token',
+                              'Content-Type': 'application/json'
+                          },
+                          data=json.dumps({"kind": "even" if i % 2 == 0 else "odd", "age": i * 10}))
+
+        cases = {
+            'filter[kind]=even': [0, 20, 40],
+            'filter[age][gte]=20&filter[age][lt]=50': [20, 30, 40],
+            'filter[kind]=odd&filter[age][gt]=10': [30, 50],
+            'filter[age][in]=10,50,60': [10, 50],
+            'filter[missing]=x': [],
+        }
+        for query, ages in cases.items():
+            response = self.app.get(f'/get?{query}', headers={
+                'X-Requested-With': 'XMLHttpRequest',
+                'Authorization': 'Bearer your_token'
+            })
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([record["age"] for record in json.loads(response.data)["data"]], ages)
+
+    def test_get_data_filtered_with_indexes(self):
+        """Test that indexed filters return the same records and follow later changes."""
+        data_storage.create_index('kind', 'hash')
+        data_storage.create_index('age', 'sorted')
+        self.addCleanup(data_storage.drop_index, 'kind')
+        self.addCleanup(data_storage.drop_index, 'age')
+        for i in range(4):
+            self.app.post('/post',
+                          headers={
+                              'X-Requested-With': 'XMLHttpRequest',
+                              'Authorization': 'Bearer your_token',
+                              'Content-Type': 'application/json'
+                          },
+                          data=json.dumps({"kind": "a", "age": i}))
+        self.app.patch('/patch/1',
+                       headers={
+                           'X-Requested-With': 'XMLHttpRequest',
+                           'Authorization': 'Bearer your_token',
+                           'Content-Type': 'application/json'
+                       },
+                       data=json.dumps({"kind": "b"}))
+        self.app.delete('/delete/2',
+                        headers={
+                            'X-Requested-With': 'XMLHttpRequest',
+                            'Authorization': 'Bearer your_token'
+                        })
+
+        response = self.app.get('/get?filter[kind]=a&filter[age][gte]=1&limit=10', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        self.assertEqual(json.loads(response.data), {"data": [{"kind": "a", "age": 3}], "next_cursor": None})
+
+    def test_get_data_invalid_filter(self):
+        """Test GET request with an unknown filter operator or a range on a non-orderable value."""
+        for query in ('filter[age][between]=1', 'filter[age][gt]=null'):
+            response = self.app.get(f'/get?{query}', headers={
+                'X-Requested-With': 'XMLHttpRequest',
+                'Authorization': 'Bearer your_token'
+            })
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("Invalid filter", str(response.data))
+
+    def test_get_data_paginated(self):
+        """Test GET request with cursor/limit pagination."""
+        for i in range(5):
+            self.app.post('/post',
+                          headers={
+                              'X-Requested-With': 'XMLHttpRequest',
+                              'Authorization': 'Bearer your_token',
+                              'Content-Type': 'application/json'
+                          },
+                          data=json.dumps({"key": f"value_{i}"}))
+
+        response = self.app.get('/get?limit=2', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data),
+                         {"data": [{"key": "value_0"}, {"key": "value_1"}], "next_cursor": 2})
+
+        response = self.app.get('/get?cursor=4&limit=2', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {"data": [{"key": "value_4"}], "next_cursor": None})
+
+    def test_get_data_paginated_invalid_parameters(self):
+        """Test GET request with invalid pagination parameters."""
+        for query in ('limit=0', 'limit=abc', 'cursor=-1'):
+            response = self.app.get(f'/get?{query}', headers={
+                'X-Requested-With': 'XMLHttpRequest',
+                'Authorization': 'Bearer your_token'
+            })
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("Invalid pagination parameters", str(response.data))
+
+    def test_get_data_stream_json(self):
+        """Test GET request streaming an incrementally encoded JSON document."""
+        for i in range(3):
+            self.app.post('/post',
+                          headers={
+                              'X-Requested-With': 'XMLHttpRequest',
+                              'Authorization': 'Bearer your_token',
+                              'Content-Type': 'application/json'
+                          },
+                          data=json.dumps({"key": f"value_{i}"}))
+
+        response = self.app.get('/get?stream=json', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {"data": [{"key": f"value_{i}"} for i in range(3)]})
+
+    def test_get_data_stream_ndjson(self):
+        """Test GET request streaming records as NDJSON."""
+        for i in range(3):
+            self.app.post('/post',
+                          headers={
+                              'X-Requested-With': 'XMLHttpRequest',
+                              'Authorization': 'Bearer your_token',
+                              'Content-Type': 'application/json'
+                          },
+                          data=json.dumps({"key": f"value_{i}"}))
+
+        response = self.app.get('/get?stream=ndjson&cursor=1', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.data.decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [{"key": "value_1"}, {"key": "value_2"}])
+
     def test_get_data_with_invalid_header_value(self):
         """Test GET request with invalid header value."""
         response = self.app.get('/get', headers={
@@ -133,6 +652,79 @@ class FlaskServiceTests(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn("value", str(response.data))  # Adjust the check based on your logic
 
+    def test_get_record_nonexistent(self):
+        """Test single-record GET request on nonexistent ID."""
+        response = self.app.get('/get/999', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        self.assertEqual(response.status_code, 404)
+        self.assertIn("Not found", str(response.data))
+
+    def test_get_record_not_modified(self):
+        """Test that a single-record GET returns a per-record ETag and 304 while that record is unchanged."""
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'Content-Type': 'application/json'
+        }
+        self.app.post('/post', headers=headers, data=json.dumps({"key": "value"}))
+        self.app.post('/post', headers=headers, data=json.dumps({"key": "other"}))
+        etag = self.app.get('/get/0', headers=headers).headers['ETag']
+        self.assertNotEqual(etag, self.app.get('/get/1', headers=headers).headers['ETag'])
+
+        # Writes to other records leave this one's ETag alone
+        self.app.put('/put/1', headers=headers, data=json.dumps({"key": "changed"}))
+        response = self.app.get('/get/0', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        self.app.patch('/patch/0', headers=headers, data=json.dumps({"key": "updated_value"}))
+        response = self.app.get('/get/0', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(json.loads(response.data), {"id": 0, "data": {"key": "updated_value"}})
+
+    def test_get_record_success(self):
+        """Test single-record GET request by ID."""
+        for i in range(2):
+            self.app.post('/post',
+                          headers={
+                              'X-Requested-With': 'XMLHttpRequest',
+                              'Authorization': 'Bearer your_token',
+                              'Content-Type': 'application/json'
+                          },
+                          data=json.dumps({"key": f"value_{i}"}))
+
+        response = self.app.get('/get/1', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {"id": 1, "data": {"key": "value_1"}})
+
+    def test_metrics_counts_requests(self):
+        """Test that /metrics reports requests per route and status, rejections and store gauges."""
+        self.app.post('/post',
+                      headers={
+                          'X-Requested-With': 'XMLHttpRequest',
+                          'Authorization': 'Bearer your_token',
+                          'Content-Type': 'application/json'
+                      },
+                      data=json.dumps({"key": "value"}))
+        self.app.get('/get', headers={'X-Requested-With': 'XMLHttpRequest'})
+
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+        lines = response.data.decode().splitlines()
+        self.assertIn('local_server_requests_total{route="post_data",status="201"} 1', lines)
+        self.assertIn('local_server_requests_total{route="get_data",status="400"} 1', lines)
+        self.assertIn('local_server_header_rejections_total{route="get_data",header="Authorization"} 1', lines)
+        self.assertIn('local_server_request_duration_seconds_count{route="post_data"} 1', lines)
+        self.assertIn('local_server_records 1', lines)
+        self.assertIn('local_server_in_flight_requests 1', lines)
+
     def test_patch_data_invalid_json(self):
         """Test PATCH request with invalid JSON data."""
         self.app.post('/post',
@@ -153,6 +745,51 @@ class FlaskServiceTests(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertIn("Invalid JSON", str(response.data))
 
+    def test_patch_data_json_patch(self):
+        """Test PATCH with an RFC 6902 JSON patch, and that a failing or malformed patch changes nothing."""
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'Content-Type': 'application/json'
+        }
+        self.app.post('/post', headers=headers, data=json.dumps({"user": {"tags": ["a"]}, "count": 1}))
+        patch_headers = dict(headers, **{'Content-Type': 'application/json-patch+json'})
+
+        response = self.app.patch('/patch/0', headers=patch_headers, data=json.dumps([
+            {"op": "test", "path": "/count", "value": 1},
+            {"op": "add", "path": "/user/tags/-", "value": "b"},
+            {"op": "replace", "path": "/count", "value": 2},
+            {"op": "move", "from": "/count", "path": "/user/count"},
+        ]))
+        self.assertEqual(response.status_code, 200)
+        expected = {"user": {"tags": ["a", "b"], "count": 2}}
+        self.assertEqual(json.loads(response.data)["data"], expected)
+
+        response = self.app.patch('/patch/0', headers=patch_headers, data=json.dumps([
+            {"op": "remove", "path": "/user/tags/0"},
+            {"op": "test", "path": "/user/count", "value": 1},
+        ]))
+        self.assertEqual(response.status_code, 409)
+        response = self.app.patch('/patch/0', headers=patch_headers, data=json.dumps({"op": "remove", "path": "/user"}))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.data)["error"], "Invalid patch")
+        self.assertEqual(json.loads(self.app.get('/get/0', headers=headers).data)["data"], expected)
+
+    def test_patch_data_merge_patch(self):
+        """Test PATCH with an RFC 7396 merge patch, which merges nested objects and deletes members set to null."""
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'Content-Type': 'application/json'
+        }
+        self.app.post('/post', headers=headers, data=json.dumps({"user": {"name": "a", "age": 30}, "old": True}))
+        response = self.app.patch('/patch/0', headers=dict(headers, **{'Content-Type': 'application/merge-patch+json'}),
+                                  data=json.dumps({"user": {"age": 31}, "old": None}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)["data"], {"user": {"name": "a", "age": 31}})
+        self.assertEqual(json.loads(self.app.get('/get/0', headers=headers).data)["data"],
+                         {"user": {"name": "a", "age": 31}})
+
     def test_patch_data_nonexistent(self):
         """Test PATCH request on nonexistent index."""
         response = self.app.patch('/patch/999',
@@ -197,6 +834,45 @@ class FlaskServiceTests(unittest.TestCase):
         self.assertEqual(json.loads(response.data),
                          {"message": "Data patched/partially updated", "data": {"key": "updated_value"}})
 
+    def test_post_data_assigns_sequential_ids(self):
+        """Test that each POST request is assigned the next stable ID."""
+        for i in range(3):
+            response = self.app.post('/post',
+                                     headers={
+                                         'X-Requested-With': 'XMLHttpRequest',
+                                         'Authorization': 'Bearer your_token',
+                                         'Content-Type': 'application/json'
+                                     },
+                                     data=json.dumps({"key": f"value_{i}"}))
+            self.assertEqual(json.loads(response.data)["id"], i)
+
+    def test_post_data_compressed(self):
+        """Test that POST and batch bodies may be gzip compressed, and bad encodings are rejected."""
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip'
+        }
+        response = self.app.post('/post', headers=headers, data=gzip.compress(json.dumps({"key": "value"}).encode()))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.data), {"message": "Data received", "id": 0, "data": {"key": "value"}})
+
+        batch = '\n'.join(json.dumps({"op": "insert", "data": {"key": i}}) for i in range(3))
+        response = self.app.post('/batch', headers=dict(headers, **{'Content-Type': 'application/x-ndjson'}),
+                                 data=gzip.compress(batch.encode()))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result["id"] for result in json.loads(response.data)["results"]], [1, 2, 3])
+
+        for encoding, data, status in (('gzip', b'not gzip', 400), ('compress', b'{}', 415)):
+            response = self.app.post('/post', headers=dict(headers, **{'Content-Encoding': encoding}), data=data)
+            self.assertEqual(response.status_code, status)
+        self.addCleanup(setattr, local_server, 'MAX_BODY_BYTES', local_server.MAX_BODY_BYTES)
+        local_server.MAX_BODY_BYTES = 100
+        response = self.app.post('/post', headers=headers, data=gzip.compress(json.dumps({"key": "x" * 200}).encode()))
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(len(local_server.data_storage), 4)
+
     def test_post_data_duplicate(self):
         """Test posting duplicate data."""
         self.app.post('/post',
@@ -228,6 +904,55 @@ class FlaskServiceTests(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertIn("Invalid JSON", str(response.data))
 
+    def test_post_data_lone_surrogate(self):
+        """Test that a body with a lone surrogate is rejected before anything is stored."""
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'Content-Type': 'application/json'
+        }
+        etag = self.app.get('/get', headers=headers).headers['ETag']
+        response = self.app.post('/post', headers=headers, data=b'{"a":"\\ud800"}')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Invalid JSON", str(response.data))
+        self.assertEqual(self.app.put('/put/0', headers=headers, data=b'["\\udfff"]').status_code, 404)
+
+        response = self.app.get('/get', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(json.loads(response.data), {"data": []})
+
+    def test_post_data_pretty_printed(self):
+        """Test that a POST body spread over several lines still streams as one NDJSON line."""
+        self.app.post('/post',
+                      headers={
+                          'X-Requested-With': 'XMLHttpRequest',
+                          'Authorization': 'Bearer your_token',
+                          'Content-Type': 'application/json'
+                      },
+                      data=json.dumps({"key": "value", "nested": {"a": 1}}, indent=2))
+
+        response = self.app.get('/get?stream=ndjson', headers={
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        })
+        lines = response.data.decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [{"key": "value", "nested": {"a": 1}}])
+
+    def test_post_data_invalid_ttl(self):
+        """Test that a TTL that is not a positive number is rejected before anything is stored."""
+        for ttl in ('abc', '0', '-5', 'nan'):
+            response = self.app.post(f'/post?ttl={ttl}',
+                                     headers={
+                                         'X-Requested-With': 'XMLHttpRequest',
+                                         'Authorization': 'Bearer your_token',
+                                         'Content-Type': 'application/json'
+                                     },
+                                     data=json.dumps({"key": "value"}))
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("Invalid TTL", str(response.data))
+        self.assertEqual(len(local_server.data_storage), 0)
+
     def test_post_data_success(self):
         """Test successful POST request."""
         response = self.app.post('/post',
@@ -238,7 +963,34 @@ class FlaskServiceTests(unittest.TestCase):
                                  },
                                  data=json.dumps({"key": "value"}))
         self.assertEqual(response.status_code, 201)
-        self.assertEqual(json.loads(response.data), {"message": "Data received", "data": {"key": "value"}})
+        self.assertEqual(json.loads(response.data), {"message": "Data received", "id": 0, "data": {"key": "value"}})
+
+    def test_post_data_with_ttl(self):
+        """Test that a record POSTed with a TTL disappears from every route once it expires."""
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'Content-Type': 'application/json'
+        }
+        # The counter lives on the shared store, so earlier tests may have bumped it
+        expired = local_server.data_storage.expired
+        self.app.post('/post?ttl=0.05', headers=headers, data=json.dumps({"key": "short"}))
+        self.app.post('/post', headers=headers, data=json.dumps({"key": "kept"}))
+        self.assertEqual(self.app.get('/get/0', headers=headers).status_code, 200)
+        etag = self.app.get('/get', headers=headers).headers['ETag']
+        time.sleep(0.1)
+
+        response = self.app.get('/get', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {"data": [{"key": "kept"}]})
+        for response in (self.app.get('/get/0', headers=headers),
+                         self.app.put('/put/0', headers=headers, data=json.dumps({"key": "late"})),
+                         self.app.patch('/patch/0', headers=headers, data=json.dumps({"key": "late"})),
+                         self.app.delete('/delete/0', headers=headers)):
+            self.assertEqual(response.status_code, 404)
+            self.assertIn("Not found", str(response.data))
+        self.assertIn(f'local_server_expired_records_total {expired + 1}',
+                      self.app.get('/metrics').data.decode().splitlines())
 
     def test_post_data_with_identical_values(self):
         """Test multiple POST requests with identical values."""
@@ -329,6 +1081,40 @@ class FlaskServiceTests(unittest.TestCase):
         expected_data = [{"key": f"value_{i}"} for i in range(5)]
         self.assertEqual(json.loads(get_response.data), {"data": expected_data})
 
+    def test_put_data_if_match(self):
+        """Test that PUT, PATCH and DELETE with a stale If-Match get 412 and change nothing."""
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'Content-Type': 'application/json'
+        }
+        self.app.post('/post', headers=headers, data=json.dumps({"key": "value"}))
+        stale = self.app.get('/get/0', headers=headers).headers['ETag']
+
+        response = self.app.put('/put/0', headers=dict(headers, **{'If-Match': stale}),
+                                data=json.dumps({"key": "first"}))
+        self.assertEqual(response.status_code, 200)
+        current = response.headers['ETag']
+        self.assertNotEqual(current, stale)
+        self.assertEqual(self.app.get('/get/0', headers=headers).headers['ETag'], current)
+
+        for response in (self.app.put('/put/0', headers=dict(headers, **{'If-Match': stale}),
+                                      data=json.dumps({"key": "second"})),
+                         self.app.patch('/patch/0', headers=dict(headers, **{'If-Match': stale}),
+                                        data=json.dumps({"key": "second"})),
+                         self.app.delete('/delete/0', headers=dict(headers, **{'If-Match': stale}))):
+            self.assertEqual(response.status_code, 412)
+            self.assertEqual(json.loads(response.data), {"error": "Precondition failed"})
+        self.assertEqual(json.loads(self.app.get('/get/0', headers=headers).data)["data"], {"key": "first"})
+
+        response = self.app.patch('/patch/0', headers=dict(headers, **{'If-Match': current}),
+                                  data=json.dumps({"extra": True}))
+        self.assertEqual(response.status_code, 200)
+        response = self.app.delete('/delete/0', headers=dict(headers, **{'If-Match': response.headers['ETag']}))
+        self.assertEqual(response.status_code, 200)
+        response = self.app.delete('/delete/0', headers=dict(headers, **{'If-Match': '*'}))
+        self.assertEqual(response.status_code, 404)
+
     def test_put_data_invalid_json(self):
         """Test PUT request with invalid JSON data."""
         self.app.post('/post',
@@ -392,6 +1178,298 @@ class FlaskServiceTests(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(response.data), {"message": "Data updated", "data": {"key": "new_value"}})
 
+    def test_rate_limit_returns_retry_after(self):
+        """Test that a client over its route limit gets 429 with Retry-After, before its body is parsed."""
+        token_registry.add('second_token')
+        self.addCleanup(token_registry.remove, 'second_token')
+        token_registry.limits = {'post_data': RateLimit(0.5, 2)}
+        self.addCleanup(setattr, token_registry, 'limits', {})
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'Content-Type': 'application/json'
+        }
+
+        for _ in range(2):
+            self.assertEqual(self.app.post('/post', headers=headers, data=json.dumps({"key": "value"})).status_code, 201)
+        response = self.app.post('/post', headers=headers, data='not json')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '2')
+        self.assertEqual(json.loads(response.data), {"error": "Too many requests"})
+
+        # Buckets are per token and per route
+        self.assertEqual(self.app.get('/get', headers=headers).status_code, 200)
+        response = self.app.post('/post', headers=dict(headers, Authorization='Bearer second_token'),
+                                 data=json.dumps({"key": "value"}))
+        self.assertEqual(response.status_code, 201)
+
+    def test_slow_request_log(self):
+        """Test that a request over the threshold is logged with the time spent in each phase."""
+        self.addCleanup(setattr, local_server, 'SLOW_REQUEST_SECONDS', local_server.SLOW_REQUEST_SECONDS)
+        local_server.SLOW_REQUEST_SECONDS = 0
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'Content-Type': 'application/json'
+        }
+
+        with self.assertLogs('local_server.slow', 'WARNING') as logs:
+            self.assertEqual(self.app.post('/post', headers=headers, data=json.dumps({"key": "value"})).status_code,
+                             201)
+        self.assertEqual(len(logs.output), 1)
+        self.assertRegex(logs.output[0], r'slow request: POST /post route=post_data status=201 total=[\d.]+ms '
+                                         r'headers=[\d.]+ms body=[\d.]+ms parse=[\d.]+ms store=[\d.]+ms '
+                                         r'respond=[\d.]+ms$')
+
+        # Only requests over the threshold are logged
+        local_server.SLOW_REQUEST_SECONDS = 60
+        with self.assertNoLogs('local_server.slow', 'WARNING'):
+            self.assertEqual(self.app.get('/get', headers=headers).status_code, 200)
+
+    def test_profile_header(self):
+        """Test that the X-Profile header with the configured key profiles a request into its route's file."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(setattr, local_server, 'profiler', local_server.profiler)
+        local_server.profiler = RequestProfiler(directory, key='profile-key')
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        }
+
+        self.assertEqual(self.app.get('/get', headers=dict(headers, **{'X-Profile': 'wrong'})).status_code, 200)
+        self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(self.app.get('/get', headers=dict(headers, **{'X-Profile': 'profile-key'})).status_code,
+                         200)
+        self.assertEqual(os.listdir(directory), ['get_data.pstats'])
+        stats = pstats.Stats(os.path.join(directory, 'get_data.pstats'))
+        self.assertTrue(any(name == 'get_data' for _, _, name in stats.stats))
+
+
+class AsgiServiceTests(FlaskServiceTests):
+    """Runs every FlaskServiceTests case against the ASGI entry point."""
+
+    def setUp(self):
+        super().setUp()
+        self.app = AsgiTestClient(asgi_app)
+
+    def subscribe_and_leave(self, asgi, query):
+        # Subscribes to SSE through asgi, disconnects after the first event and returns what was sent
+        messages = []
+
+        async def subscribe():
+            left = asyncio.Event()
+            requested = False
+
+            async def receive():
+                nonlocal requested
+                if not requested:
+                    requested = True
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                await left.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                messages.append(message)
+                if message.get('body'):
+                    left.set()
+
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                'scheme': 'http', 'path': '/changes', 'raw_path': b'/changes', 'query_string': query.encode(),
+                'root_path': '', 'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+                'headers': [(b'x-requested-with', b'XMLHttpRequest'), (b'authorization', b'Bearer your_token')],
+            }
+            await asyncio.wait_for(asgi(scope, receive, send), 5)
+
+        asyncio.run(subscribe())
+        return messages
+
+    def test_changes_sse_stops_on_disconnect(self):
+        """Test that an SSE subscription ends, and gives its thread back, once the client disconnects."""
+        self.addCleanup(setattr, local_server, 'SSE_HEARTBEAT', local_server.SSE_HEARTBEAT)
+        local_server.SSE_HEARTBEAT = 0.05
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        }
+        last_seq = json.loads(self.changes('wait=0').data)["last_seq"]
+        local_server.data_storage.add({"n": 1})
+
+        # Waiting on the loop, and on a single pool thread as with a shared store
+        pooled = AsgiApp(app, blocking_threads=1)
+        for asgi in (asgi_app, pooled):
+            messages = self.subscribe_and_leave(asgi, f'since={last_seq}&stream=sse')
+            self.assertEqual(len([message for message in messages if message.get('body')]), 1)
+
+        # The pool's one thread is free again for the next request
+        response = AsgiTestClient(pooled).get(f'/changes?since={last_seq}&wait=0', headers=headers)
+        self.assertEqual(len(json.loads(response.data)["changes"]), 1)
+
+    def test_changes_long_polls_hold_no_thread(self):
+        """Test that more long-polls than there are pool threads all wake on one write."""
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token'
+        }
+        polls = BLOCKING_THREADS + 44
+
+        # Without since, each poll starts from wherever the feed is when it is handled
+        async def poll_all():
+            requests = [asyncio.ensure_future(self.app._request('GET', '/changes?wait=10', headers, None))
+                        for _ in range(polls)]
+            await asyncio.sleep(0.1)
+            local_server.data_storage.add({"key": "late"})
+            return await asyncio.wait_for(asyncio.gather(*requests), 5)
+
+        started = time.monotonic()
+        responses = asyncio.run(poll_all())
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(len(responses), polls)
+        for response in responses:
+            self.assertEqual([change["data"] for change in json.loads(response.data)["changes"]], [{"key": "late"}])
+
+    def test_chunked_upload(self):
+        """Test that a body sent in chunks, without a Content-Length, reaches the route whole."""
+        messages = []
+        chunks = [b'{"key": ', b'"value"}']
+
+        async def receive():
+            if chunks:
+                chunk = chunks.pop(0)
+                return {'type': 'http.request', 'body': chunk, 'more_body': bool(chunks)}
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+            'scheme': 'http', 'path': '/post', 'raw_path': b'/post', 'query_string': b'',
+            'root_path': '', 'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+            'headers': [(b'x-requested-with', b'XMLHttpRequest'), (b'authorization', b'Bearer your_token'),
+                        (b'content-type', b'application/json'), (b'transfer-encoding', b'chunked')],
+        }
+        asyncio.run(asgi_app(scope, receive, send))
+        self.assertEqual(messages[0]['status'], 201)
+        self.assertEqual(local_server.data_storage.get(0), {"key": "value"})
+
+    def test_slow_requests_leave_the_loop(self):
+        """Test that whole-store reads, and writes once the store is journaled, run on the store threads."""
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'Content-Type': 'application/json'
+        }
+        threads = []
+
+        def recording_app(environ, start_response):
+            threads.append(threading.current_thread().name)
+            return app(environ, start_response)
+
+        client = AsgiTestClient(AsgiApp(recording_app, offload=local_server.request_blocks))
+        self.assertEqual(client.post('/post', headers=headers, data=json.dumps({"n": 1})).status_code, 201)
+        self.assertEqual(json.loads(client.get('/get?limit=10', headers=headers).data)["data"], [{"n": 1}])
+        self.assertEqual(json.loads(client.get('/get', headers=headers).data), {"data": [{"n": 1}]})
+        self.assertEqual(client.get('/get?limit=10&stream=ndjson', headers=headers).data, b'{"n":1}\n')
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        journal = WriteAheadLog(directory)
+        journal.recover(local_server.data_storage)
+        self.addCleanup(journal.close)
+        self.assertEqual(client.post('/post', headers=headers, data=json.dumps({"n": 2})).status_code, 201)
+        self.assertEqual(json.loads(client.get('/get?limit=10', headers=headers).data)["data"], [{"n": 2}])
+
+        on_store_threads = [name.startswith('asgi-store') for name in threads]
+        self.assertEqual(on_store_threads, [False, False, True, True, True, False])
+
+
+class RawRecordServiceTests(FlaskServiceTests):
+    """Runs every FlaskServiceTests case with records kept as raw JSON bytes."""
+
+    def setUp(self):
+        super().setUp()
+        local_server.RAW_RECORDS = True
+        self.addCleanup(setattr, local_server, 'RAW_RECORDS', False)
+
+    def test_records_are_stored_raw(self):
+        """Test that POSTed records are kept as bytes and only decoded by PATCH."""
+        self.app.post('/post',
+                      headers={
+                          'X-Requested-With': 'XMLHttpRequest',
+                          'Authorization': 'Bearer your_token',
+                          'Content-Type': 'application/json'
+                      },
+                      data='{"key": "value"}')
+        self.assertEqual(data_storage.get(0), b'{"key": "value"}')
+
+        response = self.app.patch('/patch/0',
+                                  headers={
+                                      'X-Requested-With': 'XMLHttpRequest',
+                                      'Authorization': 'Bearer your_token',
+                                      'Content-Type': 'application/json'
+                                  },
+                                  data=json.dumps({"extra": True}))
+        self.assertEqual(json.loads(response.data)["data"], {"key": "value", "extra": True})
+        self.assertIsInstance(data_storage.get(0), bytes)
+
+    def test_lenient_bodies_are_encoded_again(self):
+        """Test that bodies the parser only accepts leniently are stored re-encoded, never as sent."""
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest',
+            'Authorization': 'Bearer your_token',
+            'Content-Type': 'application/json'
+        }
+        for body in ('{"b": 1}'.encode('utf-16'), codecs.BOM_UTF8 + b'{"c": 2}'):
+            response = self.app.post('/post', headers=headers, data=body)
+            self.assertEqual(response.status_code, 201)
+            self.assertIsInstance(data_storage.get(json.loads(response.data)["id"]), bytes)
+
+        # Both come back as strict UTF-8 JSON
+        response = self.app.get('/get', headers=headers)
+        self.assertEqual(codec.StdlibCodec().loads_strict(response.data), {"data": [{"b": 1}, {"c": 2}]})
+
+        for body in (b'{"a": NaN}', b'{"a": -Infinity}', b'{"a": 1e400}'):
+            response = self.app.post('/post', headers=headers, data=body)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(data_storage.get(json.loads(response.data)["id"]), codec.dumps(codec.loads(body)))
+
+
+class SharedStoreServiceTests(FlaskServiceTests):
+    """Runs every FlaskServiceTests case with the store owned by another StoreServer, as worker processes use it."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.server = StoreServer(RecordStore(), os.path.join(cls.directory, 'store.sock'))
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.store = RemoteStore(cls.server.address)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        super().setUp()
+        self.store.clear()
+        # Versions of the two stores overlap, so cached bodies must not carry over
+        local_server.response_cache.clear()
+        local_server.data_storage = self.store
+        self.addCleanup(setattr, local_server, 'data_storage', data_storage)
+        self.addCleanup(local_server.response_cache.clear)
+
+    def test_every_request_blocks(self):
+        """Test that the ASGI server sends reads as well as writes to a shared store off the event loop."""
+        page = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/get', 'QUERY_STRING': 'limit=10'}
+        write = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/post', 'QUERY_STRING': ''}
+        self.assertTrue(local_server.request_blocks(page))
+        self.assertTrue(local_server.request_blocks(write))
+        local_server.data_storage = data_storage
+        self.assertFalse(local_server.request_blocks(page))
+        self.assertFalse(local_server.request_blocks(write))
+
 
 if __name__ == '__main__':
     unittest.main()
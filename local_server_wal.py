@@ -0,0 +1,326 @@
+import json
+import mmap
+import os
+import re
+import threading
+
+import local_server_codec as codec
+
+FSYNC_ALWAYS = 'always'
+FSYNC_BATCHED = 'batched'
+FSYNC_OFF = 'off'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_BATCHED, FSYNC_OFF)
+
+# How often the background thread flushes (and, when batched, fsyncs) the log
+DEFAULT_FLUSH_INTERVAL = 0.01
+# Log bytes written since the last snapshot that trigger a new one
+DEFAULT_SNAPSHOT_BYTES = 64 * 1024 * 1024
+
+_SEGMENT_RE = re.compile(r'^wal-(\d{10})\.log$')
+_SNAPSHOT_RE = re.compile(r'^snapshot-(\d{10})\.snap$')
+
+
+class RecoveryError(Exception):
+    """The log holds an entry that cannot be read and is not a torn last write."""
+
+
+def _segment_name(seq):
+    return f'wal-{seq:010d}.log'
+
+
+def _snapshot_name(seq):
+    return f'snapshot-{seq:010d}.snap'
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _encode_entries(entries):
+    # One log line; built by hand so raw records are copied in without re-encoding
+    parts = []
+    for entry in entries:
+        if entry[0] == 's':
+            parts.append(b'["s",%d,%s]' % (entry[1], codec.encode_record(entry[2])))
+        elif entry[0] == 'd':
+            parts.append(b'["d",%d]' % entry[1])
+        elif entry[0] == 'x':
+            parts.append(b'["x",%d,%s]' % (entry[1], repr(entry[2]).encode()))
+        else:
+            parts.append(b'["c"]')
+    return b'[' + b','.join(parts) + b']\n'
+
+
+class WriteAheadLog:
+    """Append-only journal of every change made to a RecordStore.
+
+    The log is a series of segments, wal-<seq>.log, each holding one JSON
+    array of entries per line: ["s", id, record] sets a record, ["d", id]
+    deletes one, ["x", id, time] sets when a record expires and ["c"]
+    clears the store. A snapshot, snapshot-<seq>.snap, holds the full
+    store as it stood when segment <seq> was started, so recovery loads
+    the newest snapshot and replays only the segments from <seq> on.
+
+    fsync is one of:
+
+    * always  - a write returns only once it is on disk; concurrent writers
+      share a single fsync (group commit)
+    * batched - a background thread fsyncs every flush_interval seconds, so
+      a crash can lose at most that window
+    * off     - the log is handed to the OS but never fsynced
+
+    Records stored as raw JSON bytes are written out as they are, and with
+    raw_records recovery keeps snapshot records as bytes without decoding.
+    """
+
+    def __init__(self, directory, fsync=FSYNC_BATCHED, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 snapshot_bytes=DEFAULT_SNAPSHOT_BYTES, raw_records=False):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'Invalid fsync policy: {fsync}')
+        self.directory = directory
+        self.fsync = fsync
+        self.flush_interval = flush_interval
+        self.snapshot_bytes = snapshot_bytes
+        # Recover records as raw JSON bytes (see local_server_codec) rather than objects
+        self.raw_records = raw_records
+        self.store = None
+
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._file = None
+        self._segment = 0
+        self._bytes_since_snapshot = 0
+        # Tickets: _written counts appended lines, _durable those known to be on disk
+        self._written = 0
+        self._durable = 0
+        self._syncing = False
+
+        self._closed = threading.Event()
+        self._snapshot_wanted = threading.Event()
+        self._checkpoint_lock = threading.Lock()
+        self._threads = []
+
+    # Recovery
+
+    def recover(self, store):
+        """Load the snapshot and log tail into store and start journaling it."""
+        os.makedirs(self.directory, exist_ok=True)
+        snapshots = self._list(_SNAPSHOT_RE)
+        segments = self._list(_SEGMENT_RE)
+
+        records, expires, next_id, start = {}, {}, 0, 0
+        if snapshots:
+            start = snapshots[-1]
+            next_id, records, expires = self._read_snapshot(os.path.join(self.directory, _snapshot_name(start)),
+                                                            self.raw_records)
+        replayed = [seq for seq in segments if seq >= start]
+        for seq in replayed:
+            next_id = self._replay(os.path.join(self.directory, _segment_name(seq)), records, expires,
+                                   next_id, self.raw_records, last=seq == replayed[-1])
+
+        store.load(records, next_id, expires)
+        self.store = store
+        self._open_segment(max(segments + snapshots, default=-1) + 1)
+        store.journal = self
+
+        self._start_thread(self._flush_loop)
+        self._start_thread(self._snapshot_loop)
+        return store
+
+    def _list(self, pattern):
+        found = []
+        for name in os.listdir(self.directory):
+            match = pattern.match(name)
+            if match:
+                found.append(int(match.group(1)))
+        return sorted(found)
+
+    @staticmethod
+    def _read_snapshot(path, raw_records):
+        # The snapshot is memory-mapped and decoded line by line, so loading
+        # it never needs a second full copy of the file in memory
+        records = {}
+        loads = codec.loads
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = data.find(b'\n')
+            header = loads(data[:end])
+            next_id = header['next_id']
+            expires = {int(record_id): expires_at for record_id, expires_at in header.get('expires', {}).items()}
+            pos = end + 1
+            size = len(data)
+            while pos < size:
+                end = data.find(b'\n', pos)
+                if end == -1:
+                    end = size
+                space = data.find(b' ', pos, end)
+                record = data[space + 1:end]
+                records[int(data[pos:space])] = record if raw_records else loads(record)
+                pos = end + 1
+        return next_id, records, expires
+
+    @staticmethod
+    def _replay(path, records, expires, next_id, raw_records, last=False):
+        loads = codec.loads
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    entries = loads(line)
+                except ValueError:
+                    # A crash can only tear the last line of the newest segment; anything
+                    # else is damage, and replaying past it would silently drop what follows
+                    if not last or f.read():
+                        raise RecoveryError(f'Unreadable log entry at byte {offset} of {path}') from None
+                    torn = offset
+                    break
+                offset += len(line)
+                for entry in entries:
+                    if entry[0] == 's':
+                        records[entry[1]] = codec.dumps(entry[2]) if raw_records else entry[2]
+                        next_id = max(next_id, entry[1] + 1)
+                    elif entry[0] == 'd':
+                        records.pop(entry[1], None)
+                        expires.pop(entry[1], None)
+                        next_id = max(next_id, entry[1] + 1)
+                    elif entry[0] == 'x':
+                        expires[entry[1]] = entry[2]
+                    else:
+                        records.clear()
+                        expires.clear()
+                        next_id = 0
+            else:
+                return next_id
+        # Cut the torn line off, so once later segments are written it is not mistaken for damage
+        with open(path, 'r+b') as f:
+            f.truncate(torn)
+            os.fsync(f.fileno())
+        return next_id
+
+    # Writing
+
+    def append(self, entries):
+        """Write entries as one log line and return a ticket for wait().
+
+        Called by the store while it holds the locks for the records
+        involved, so the log order matches the order changes were applied.
+        """
+        line = _encode_entries(entries)
+        with self._lock:
+            self._file.write(line)
+            self._written += 1
+            self._bytes_since_snapshot += len(line)
+            ticket = self._written
+        if self._bytes_since_snapshot >= self.snapshot_bytes:
+            self._snapshot_wanted.set()
+        return ticket
+
+    def wait(self, ticket):
+        """Block until the entry behind ticket is durable, if the policy asks for it."""
+        if self.fsync != FSYNC_ALWAYS:
+            return
+        with self._lock:
+            while self._durable < ticket:
+                if self._syncing:
+                    # Another writer is already fsyncing; its sync may cover us too
+                    self._synced.wait()
+                else:
+                    self._sync_locked()
+
+    def _sync_locked(self, fsync=True):
+        # Group commit: flush everything written so far and fsync it without
+        # holding the lock, so other writers keep appending in the meantime
+        self._syncing = True
+        target = self._written
+        self._file.flush()
+        fd = self._file.fileno()
+        self._lock.release()
+        try:
+            if fsync:
+                os.fsync(fd)
+        finally:
+            self._lock.acquire()
+            self._syncing = False
+        self._durable = max(self._durable, target)
+        self._synced.notify_all()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            with self._lock:
+                if self._durable < self._written and not self._syncing:
+                    self._sync_locked(fsync=self.fsync != FSYNC_OFF)
+
+    def _open_segment(self, seq):
+        self._segment = seq
+        self._file = open(os.path.join(self.directory, _segment_name(seq)), 'ab')
+
+    def _rotate(self):
+        # Runs with every store lock held, so no entry can land on either side of the cut
+        with self._lock:
+            while self._syncing:
+                self._synced.wait()
+            self._file.flush()
+            if self.fsync != FSYNC_OFF:
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._durable = self._written
+            self._bytes_since_snapshot = 0
+            self._open_segment(self._segment + 1)
+            self._synced.notify_all()
+
+    # Snapshots
+
+    def checkpoint(self):
+        """Write a snapshot of the store and delete the log it makes redundant."""
+        with self._checkpoint_lock:
+            next_id, records, expires = self.store.snapshot(before=self._rotate)
+            seq = self._segment
+            path = os.path.join(self.directory, _snapshot_name(seq))
+            tmp_path = path + '.tmp'
+            encode_record = codec.encode_record
+            with open(tmp_path, 'wb') as f:
+                header = {'next_id': next_id}
+                if expires:
+                    header['expires'] = expires
+                f.write(json.dumps(header).encode() + b'\n')
+                for record_id in sorted(records):
+                    f.write(b'%d %s\n' % (record_id, encode_record(records[record_id])))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            _fsync_directory(self.directory)
+
+            for old in self._list(_SNAPSHOT_RE):
+                if old < seq:
+                    os.remove(os.path.join(self.directory, _snapshot_name(old)))
+            for old in self._list(_SEGMENT_RE):
+                if old < seq:
+                    os.remove(os.path.join(self.directory, _segment_name(old)))
+
+    def _snapshot_loop(self):
+        while not self._closed.is_set():
+            self._snapshot_wanted.wait()
+            self._snapshot_wanted.clear()
+            if not self._closed.is_set():
+                self.checkpoint()
+
+    def _start_thread(self, target):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def close(self):
+        self._closed.set()
+        self._snapshot_wanted.set()
+        for thread in self._threads:
+            thread.join()
+        with self._lock:
+            self._file.flush()
+            if self.fsync != FSYNC_OFF:
+                os.fsync(self._file.fileno())
+            self._file.close()
+        if self.store is not None:
+            self.store.journal = None
@@ -0,0 +1,175 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from local_server_store import RecordStore
+from local_server_wal import FSYNC_ALWAYS, FSYNC_OFF, RecoveryError, WriteAheadLog
+
+
+class WriteAheadLogTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.logs = []
+
+    def tearDown(self):
+        for wal in self.logs:
+            wal.close()
+        shutil.rmtree(self.directory)
+
+    def open_store(self, **kwargs):
+        wal = WriteAheadLog(self.directory, **kwargs)
+        self.logs.append(wal)
+        return wal.recover(RecordStore())
+
+    def restart(self, **kwargs):
+        for wal in self.logs:
+            wal.close()
+        self.logs = []
+        return self.open_store(**kwargs)
+
+    def test_checkpoint_compacts_log(self):
+        """Test that a snapshot replaces the log it covers and recovery replays only the tail."""
+        store = self.open_store()
+        for i in range(5):
+            store.add({"key": f"value_{i}"})
+        store.pop(1)
+        store.journal.checkpoint()
+        store.replace(4, {"key": "after_snapshot"})
+
+        names = sorted(os.listdir(self.directory))
+        self.assertEqual([name for name in names if name.startswith('snapshot-')], ['snapshot-0000000001.snap'])
+        self.assertEqual([name for name in names if name.startswith('wal-')], ['wal-0000000001.log'])
+
+        store = self.restart()
+        self.assertEqual(list(store.iter_from()), [
+            (0, {"key": "value_0"}),
+            (2, {"key": "value_2"}),
+            (3, {"key": "value_3"}),
+            (4, {"key": "after_snapshot"}),
+        ])
+
+    def test_concurrent_writers_with_fsync_always(self):
+        """Test that concurrent writers sharing group commits all reach the log."""
+        store = self.open_store(fsync=FSYNC_ALWAYS)
+
+        def insert():
+            for i in range(50):
+                store.add({"value": i})
+
+        threads = [threading.Thread(target=insert) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        store = self.restart()
+        self.assertEqual(len(store), 200)
+
+    def test_invalid_fsync_policy(self):
+        """Test that an unknown fsync policy is rejected."""
+        with self.assertRaises(ValueError):
+            WriteAheadLog(self.directory, fsync='sometimes')
+
+    def test_recover_ignores_torn_tail(self):
+        """Test that a partially written last entry is dropped on recovery."""
+        store = self.open_store(fsync=FSYNC_OFF)
+        store.add({"key": "value"})
+        store = self.restart()
+        with open(os.path.join(self.directory, 'wal-0000000001.log'), 'ab') as f:
+            f.write(b'[["s",1,{"key":')
+
+        store = self.restart()
+        self.assertEqual(list(store.iter_from()), [(0, {"key": "value"})])
+        self.assertEqual(store.add({"key": "next"}), 1)
+
+        # The torn line was cut off, so it is not taken for damage once a newer segment exists
+        store = self.restart()
+        self.assertEqual(list(store.iter_from()), [(0, {"key": "value"}), (1, {"key": "next"})])
+
+    def test_recover_rejects_damaged_entry(self):
+        """Test that an unreadable entry with more log after it stops recovery instead of dropping the rest."""
+        store = self.open_store(fsync=FSYNC_OFF)
+        store.add({"key": "value"})
+        store = self.restart()
+        with open(os.path.join(self.directory, 'wal-0000000001.log'), 'ab') as f:
+            f.write(b'[["s",1,\xff\xfe{\x00]]\n[["s",2,{"key":"later"}]]\n')
+        for wal in self.logs:
+            wal.close()
+        self.logs = []
+        with self.assertRaises(RecoveryError):
+            WriteAheadLog(self.directory).recover(RecordStore())
+
+        # Damage in an older segment is fatal even when it is that segment's last line
+        os.remove(os.path.join(self.directory, 'wal-0000000001.log'))
+        with open(os.path.join(self.directory, 'wal-0000000000.log'), 'ab') as f:
+            f.write(b'[["s",1,{"key":\n')
+        with open(os.path.join(self.directory, 'wal-0000000001.log'), 'wb') as f:
+            f.write(b'[["s",2,{"key":"later"}]]\n')
+        with self.assertRaises(RecoveryError):
+            WriteAheadLog(self.directory).recover(RecordStore())
+
+    def test_recover_replays_log(self):
+        """Test that every kind of change survives a restart and IDs keep counting up."""
+        store = self.open_store()
+        for i in range(3):
+            store.add({"key": f"value_{i}"})
+        store.replace(0, {"key": "new_value"})
+        store.update(1, lambda record: dict(record, extra=True))
+        store.pop(2)
+
+        store = self.restart()
+        self.assertEqual(list(store.iter_from()), [(0, {"key": "new_value"}), (1, {"key": "value_1", "extra": True})])
+        self.assertEqual(store.add({"key": "value_3"}), 3)
+
+    def test_recover_keeps_expiry(self):
+        """Test that TTLs survive a restart, from both a snapshot and the log."""
+        store = self.open_store()
+        store.add({"key": "snapshot"}, ttl=60)
+        store.journal.checkpoint()
+        store.add({"key": "tail"}, ttl=0.05)
+        store.add({"key": "kept"})
+        time.sleep(0.1)
+
+        store = self.restart()
+        self.assertEqual(list(store.iter_from()), [(0, {"key": "snapshot"}), (2, {"key": "kept"})])
+        store.expire_due()
+        self.assertGreater(store.next_expiry, time.time() + 30)
+
+    def test_recover_raw_records(self):
+        """Test that raw records are logged as they are and recovered as bytes."""
+        store = self.open_store(raw_records=True)
+        store.add(b'{"key":"value"}')
+        store.add({"key": "object"})
+        store.journal.checkpoint()
+        store.add(b'{"key":"tail"}')
+
+        store = self.restart(raw_records=True)
+        self.assertEqual(list(store.iter_from()), [
+            (0, b'{"key":"value"}'),
+            (1, b'{"key":"object"}'),
+            (2, b'{"key":"tail"}'),
+        ])
+
+    def test_rolled_back_transaction_is_not_logged(self):
+        """Test that a transaction undone with rollback() writes nothing to the log."""
+        store = self.open_store(fsync=FSYNC_OFF)
+        store.add({"key": "value"})
+        with store.transaction() as txn:
+            txn.add({"key": "inserted"})
+            txn.pop(0)
+            txn.rollback()
+        store.journal.close()
+        self.logs = []
+        with open(os.path.join(self.directory, 'wal-0000000000.log'), 'rb') as f:
+            self.assertEqual(f.read().count(b'\n'), 1)
+
+        store = self.restart()
+        self.assertEqual(list(store.iter_from()), [(0, {"key": "value"})])
+        self.assertEqual(store.add({"key": "next"}), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()